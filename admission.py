@@ -0,0 +1,216 @@
+import logging
+import re
+import time
+
+from telegram import Update
+from telegram.error import TelegramError
+
+from config import (
+    ADMISSION_USER_RATE, ADMISSION_USER_BURST, ADMISSION_CHAT_RATE, ADMISSION_CHAT_BURST,
+    ADMISSION_MAX_PENDING, ADMISSION_NOTICE_INTERVAL
+)
+from dispatcher import TokenBucket
+from metrics import metrics
+from webhook_server import reply_text
+
+logger = logging.getLogger(__name__)
+
+SHED_REASONS = ('overload', 'user_rate', 'chat_rate', 'collapsed')
+
+_ADMITTED = metrics.counter('bot_updates_admitted_total', 'Обновления, принятые к обработке')
+_SHED = {
+    reason: metrics.counter('bot_updates_shed_total', 'Отброшенные обновления', reason=reason)
+    for reason in SHED_REASONS
+}
+_NOTICES = metrics.counter('bot_admission_notices_total', 'Ответы «слишком часто»')
+
+NOTICE_TEXT = "⏳ Слишком много запросов. Подождите пару секунд и повторите."
+
+
+class Ticket:
+    """Принятое обновление, пока оно ждёт или идёт обработка."""
+
+    __slots__ = ('chat_id', 'message_key', 'data', 'group', 'started', 'superseded')
+
+    def __init__(self, chat_id, message_key=None, data=None, group=None):
+        self.chat_id = chat_id
+        self.message_key = message_key
+        self.data = data
+        self.group = group
+        self.started = False
+        self.superseded = False
+
+
+class AdmissionController:
+    """Допуск обновлений к обработчикам и сброс лишних под нагрузкой.
+
+    Каждый пользователь и групповой чат получают token bucket; обновления
+    сверх лимита, а также всё сверх max_pending принятых, но ещё не
+    обработанных, отбрасываются с редким ответом «слишком часто». Нажатия
+    кнопок одного сообщения, ещё ждущие очереди, схлопываются: из
+    однотипных подряд остаётся последнее, пара одинаковых переключателей
+    взаимно гасится. Так же из ждущих inline-запросов пользователя
+    остаётся только последний.
+    """
+
+    def __init__(self, user_rate=ADMISSION_USER_RATE, user_burst=ADMISSION_USER_BURST,
+                 chat_rate=ADMISSION_CHAT_RATE, chat_burst=ADMISSION_CHAT_BURST,
+                 max_pending=ADMISSION_MAX_PENDING, notice_interval=ADMISSION_NOTICE_INTERVAL,
+                 collapse_groups=(), toggle_pattern=None):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.notice_interval = notice_interval
+        # callback_data, совпавшие с одним шаблоном, заменяют друг друга
+        self.collapse_groups = tuple(re.compile(pattern) for pattern in collapse_groups)
+        self.toggle_pattern = re.compile(toggle_pattern) if toggle_pattern else None
+        self.pending = 0
+        self._user_buckets = {}
+        self._chat_buckets = {}
+        self._notified = {}
+        # chat_id -> последнее принятое и ещё не начатое обновление чата
+        self._last_queued = {}
+
+    @staticmethod
+    def _bucket(buckets, key, rate, burst, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) > 10000:
+                # Забываем тех, чьи лимиты давно восстановились
+                for stale in [k for k, b in buckets.items() if b.full(now)]:
+                    del buckets[stale]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _group(self, data):
+        for index, pattern in enumerate(self.collapse_groups):
+            if pattern.match(data):
+                return index
+        return data
+
+    def _collapsible(self, ticket):
+        """Ждущее очереди нажатие того же сообщения и той же группы, если оно последнее в чате."""
+        previous = self._last_queued.get(ticket.chat_id)
+        if (previous is None or previous.started or previous.superseded
+                or previous.message_key != ticket.message_key or previous.group != ticket.group):
+            return None
+        return previous
+
+    def _shed(self, reason):
+        _SHED[reason].inc()
+        return None, reason
+
+    def admit(self, update, now=None):
+        """(Ticket, None) — обрабатывать; (None, причина) — отбросить.
+
+        Для обновлений без чата и пользователя учёт не ведётся: (None, None).
+        """
+        if not isinstance(update, Update):
+            return None, None
+        chat = update.effective_chat
+        user = update.effective_user
+        chat_id = chat.id if chat is not None else (user.id if user is not None else None)
+        if chat_id is None:
+            return None, None
+        if self.max_pending and self.pending >= self.max_pending:
+            return self._shed('overload')
+        ticket = Ticket(chat_id)
+
+        previous = None
+        metered = True
+        query = update.callback_query
+        if query is not None and query.data and query.message is not None:
+            ticket.message_key = query.message.message_id
+            ticket.data = query.data
+            ticket.group = self._group(query.data)
+            previous = self._collapsible(ticket)
+            if (previous is not None and self.toggle_pattern is not None
+                    and self.toggle_pattern.match(ticket.data)):
+                # Два одинаковых переключения подряд ничего не меняют: гасим оба,
+                # не тратя токенов
+                previous.superseded = True
+                del self._last_queued[chat_id]
+                return self._shed('collapsed')
+        elif update.inline_query is not None:
+            # Каждая буква — новый запрос; нужен только последний. Токенов не
+            # тратит: схлопывание и так оставляет пользователю один ждущий
+            ticket.message_key = ticket.group = 'inline'
+            previous = self._collapsible(ticket)
+            metered = False
+
+        now = time.monotonic() if now is None else now
+        if metered and user is not None and not self._bucket(
+            self._user_buckets, user.id, self.user_rate, self.user_burst, now
+        ).take(now):
+            return self._shed('user_rate')
+        if metered and chat is not None and (user is None or chat.id != user.id) and not self._bucket(
+            self._chat_buckets, chat.id, self.chat_rate, self.chat_burst, now
+        ).take(now):
+            return self._shed('chat_rate')
+
+        if previous is not None:
+            # Из однотипных нажатий подряд важно только последнее
+            previous.superseded = True
+        self.pending += 1
+        self._last_queued[chat_id] = ticket
+        _ADMITTED.inc()
+        return ticket, None
+
+    def start(self, ticket):
+        """Обновление дождалось очереди. False — его заменило более новое.
+
+        Заменённое считается отброшенным здесь, а не при замене: так каждое
+        обновление попадает в bot_updates_shed_total ровно один раз.
+        """
+        if self._last_queued.get(ticket.chat_id) is ticket:
+            del self._last_queued[ticket.chat_id]
+        ticket.started = True
+        if ticket.superseded:
+            _SHED['collapsed'].inc()
+            return False
+        return True
+
+    def finish(self, ticket):
+        self.pending -= 1
+        if self._last_queued.get(ticket.chat_id) is ticket:
+            del self._last_queued[ticket.chat_id]
+
+    def _may_notify(self, user_id, now):
+        last = self._notified.get(user_id)
+        if last is not None and now - last < self.notice_interval:
+            return False
+        if len(self._notified) > 10000:
+            self._notified = {
+                uid: t for uid, t in self._notified.items() if now - t < self.notice_interval
+            }
+        self._notified[user_id] = now
+        return True
+
+    async def notify(self, update, reason):
+        """Дешёвый ответ на отброшенное обновление — не чаще раза в notice_interval."""
+        if not isinstance(update, Update) or update.inline_query is not None:
+            # На inline-запрос ответит следующий, уже набранный
+            return
+        if reason == 'collapsed':
+            # Погашенное или заменённое нажатие: просто убрать «часики» с кнопки
+            if update.callback_query is None:
+                return
+            try:
+                await update.callback_query.answer()
+            except TelegramError as e:
+                logger.warning(f"Не удалось ответить на нажатие: {e}")
+            return
+        user = update.effective_user
+        if user is None or not self._may_notify(user.id, time.monotonic()):
+            return
+        _NOTICES.inc()
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(NOTICE_TEXT)
+            elif update.message is not None:
+                # Под вебхуком ответ уходит в теле HTTP-ответа, без запроса к API
+                await reply_text(update.message, NOTICE_TEXT)
+        except TelegramError as e:
+            logger.warning(f"Не удалось ответить на отброшенное обновление: {e}")
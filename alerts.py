@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import re
+from bisect import bisect_left, bisect_right
+from itertools import count
+
+from config import ALERTS_PATH, MAX_ALERTS_PER_CHAT
+
+logger = logging.getLogger(__name__)
+
+# '>' — курс поднялся выше порога, '<' — опустился ниже
+ALERT_OPERATORS = ('>', '<')
+
+_ALERT_RE = re.compile(r'^\s*(\S+?)\s*([<>])\s*(\d+(?:[.,]\d+)?)\s*$')
+
+
+def parse_alert(text):
+    """'USD > 95' → ('USD', '>', 95.0), код валюты ещё не проверен."""
+    match = _ALERT_RE.match(text)
+    if not match:
+        return None
+    currency, operator, threshold = match.groups()
+    return currency, operator, float(threshold.replace(',', '.'))
+
+
+class _ThresholdIndex:
+    """Пороги одной валюты и одного направления, отсортированные по значению."""
+
+    __slots__ = ('thresholds', 'ids')
+
+    def __init__(self):
+        self.thresholds = []
+        self.ids = []
+
+    def add(self, threshold, alert_id):
+        pos = bisect_right(self.thresholds, threshold)
+        self.thresholds.insert(pos, threshold)
+        self.ids.insert(pos, alert_id)
+
+    def remove(self, threshold, alert_id):
+        pos = bisect_left(self.thresholds, threshold)
+        while pos < len(self.thresholds) and self.thresholds[pos] == threshold:
+            if self.ids[pos] == alert_id:
+                del self.thresholds[pos]
+                del self.ids[pos]
+                return
+            pos += 1
+
+    def pop_crossed(self, operator, old, new):
+        """Извлечь id подписок, чьи пороги лежат в пересечённом интервале.
+
+        Такие пороги идут подряд, поэтому удаляются одним срезом.
+        """
+        if operator == '>':
+            # Было <= порога, стало выше
+            lo = bisect_left(self.thresholds, old)
+            hi = bisect_left(self.thresholds, new)
+        else:
+            # Было >= порога, стало ниже
+            lo = bisect_right(self.thresholds, new)
+            hi = bisect_right(self.thresholds, old)
+        if lo >= hi:
+            return []
+        ids = self.ids[lo:hi]
+        del self.thresholds[lo:hi]
+        del self.ids[lo:hi]
+        return ids
+
+
+class AlertBook:
+    """Подписки на пересечение курсом порога.
+
+    Для каждой пары (валюта, направление) пороги хранятся отсортированными,
+    поэтому при обновлении курсов бинарный поиск находит только сработавшие
+    подписки, не перебирая остальные. Сработавшая подписка удаляется.
+    """
+
+    def __init__(self, path=ALERTS_PATH):
+        self.path = path
+        self.alerts = {}  # id -> (chat_id, code, operator, threshold)
+        self._by_chat = {}
+        self._indexes = {}
+        self._ids = count(1)
+        self.dirty = False
+        self.load()
+
+    def _index(self, code, operator):
+        key = (code, operator)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = _ThresholdIndex()
+        return index
+
+    def add(self, chat_id, code, operator, threshold):
+        if operator not in ALERT_OPERATORS:
+            raise ValueError(f"Неизвестное условие: {operator}")
+        chat_alerts = self._by_chat.setdefault(chat_id, set())
+        if len(chat_alerts) >= MAX_ALERTS_PER_CHAT:
+            return None
+        alert_id = next(self._ids)
+        self.alerts[alert_id] = (chat_id, code, operator, threshold)
+        chat_alerts.add(alert_id)
+        self._index(code, operator).add(threshold, alert_id)
+        self.dirty = True
+        return alert_id
+
+    def remove(self, alert_id, chat_id=None):
+        alert = self.alerts.get(alert_id)
+        if alert is None or (chat_id is not None and alert[0] != chat_id):
+            return False
+        _, code, operator, threshold = alert
+        self._forget(alert_id)
+        self._index(code, operator).remove(threshold, alert_id)
+        return True
+
+    def _forget(self, alert_id):
+        owner = self.alerts.pop(alert_id)[0]
+        chat_alerts = self._by_chat[owner]
+        chat_alerts.discard(alert_id)
+        if not chat_alerts:
+            del self._by_chat[owner]
+        self.dirty = True
+
+    def for_chat(self, chat_id):
+        return sorted(
+            (alert_id, self.alerts[alert_id]) for alert_id in self._by_chat.get(chat_id, ())
+        )
+
+    def match(self, old, new):
+        """Сработавшие подписки при переходе между снимками курсов.
+
+        Возвращает [(id, chat_id, code, operator, threshold, rate), ...] и
+        удаляет эти подписки.
+        """
+        if old is None or new is None:
+            return []
+        triggered = []
+        for (code, operator), index in self._indexes.items():
+            old_rate = old.rates.get(code)
+            new_rate = new.rates.get(code)
+            if old_rate is None or new_rate is None or old_rate == new_rate:
+                continue
+            if (operator == '>') != (new_rate > old_rate):
+                continue
+            for alert_id in index.pop_crossed(operator, old_rate, new_rate):
+                chat_id, _, _, threshold = self.alerts[alert_id]
+                triggered.append((alert_id, chat_id, code, operator, threshold, new_rate))
+                self._forget(alert_id)
+        return triggered
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось загрузить подписки: {e}")
+            return
+
+        grouped = {}
+        max_id = 0
+        for alert_id, chat_id, code, operator, threshold in rows:
+            self.alerts[alert_id] = (chat_id, code, operator, threshold)
+            self._by_chat.setdefault(chat_id, set()).add(alert_id)
+            grouped.setdefault((code, operator), []).append((threshold, alert_id))
+            max_id = max(max_id, alert_id)
+        # Индексы строим одной сортировкой, а не вставками по одной
+        for key, pairs in grouped.items():
+            pairs.sort()
+            index = self._index(*key)
+            index.thresholds = [threshold for threshold, _ in pairs]
+            index.ids = [alert_id for _, alert_id in pairs]
+        self._ids = count(max_id + 1)
+        logger.info(f"Загружено подписок на курсы: {len(self.alerts)}")
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        rows = [[alert_id, *alert] for alert_id, alert in self.alerts.items()]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(rows, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            logger.error(f"Не удалось сохранить подписки: {e}")
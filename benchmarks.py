@@ -0,0 +1,1624 @@
+"""Микробенчмарки и проверки отдельных частей бота, без Telegram и сети.
+
+    python benchmarks.py parser [--fuzz 200000] [--seed 1]
+    python benchmarks.py resolver
+    python benchmarks.py render
+    python benchmarks.py alerts [--alerts 1000000]
+    python benchmarks.py warmstart
+    python benchmarks.py stall [--stall 5]
+    python benchmarks.py dispatch
+    python benchmarks.py persistence [--users 100000]
+    python benchmarks.py bulk [--rows 1000000] [--xlsx 200000]
+    python benchmarks.py history [--years 5] [--interval 60]
+    python benchmarks.py providers
+    python benchmarks.py inline [--users 5000]
+    python benchmarks.py updates [--chats 100] [--latency 20]
+    python benchmarks.py metrics [--calls 1000000]
+
+parser — разбор запросов: закреплённый корпус (запрос → ожидаемый разбор),
+дифференциальный фазз-прогон против прежнего parse_convert_input (запросы
+его грамматики новый разбор принимает с тем же результатом), случайный мусор
+(без исключений и бесконечных сумм) и время разбора до/после. Ненулевой код
+выхода — если корпус или сравнение не сошлись.
+
+resolver — поиск кода валюты: корпус реального ввода (коды, словоформы,
+опечатки) с ожидаемыми кодами, расхождения с прежним find_currency_code
+и время поиска: прежний линейный просмотр, индекс без кэша, с кэшем.
+
+render — клавиатуры и тексты на одно нажатие до/после render.py; вывод
+сверяется с прежними функциями.
+
+alerts — AlertBook.match на миллионе подписок: время на обновление курсов
+и сверка с полным перебором подписок.
+
+warmstart — бот стартует с сохранённым снимком курсов при недоступном
+провайдере (фейковый Bot API из loadtest.py): время от импорта до первой
+отданной конвертации; без снимка для сравнения. Ненулевой код выхода —
+если по снимку конвертация не отдана.
+
+stall — API курсов отвечает через 5 с, а в это время каждые 10 мс приходит
+запрос другого пользователя, которому сеть не нужна: p50/p99 его задержки
+при прежнем блокирующем запросе и при httpx.AsyncClient.
+
+dispatch — MessageDispatcher шлёт рассылку в фейковый Bot API, который, как
+настоящий, отвечает 429 сверх лимитов (loadtest.py): проверяются лимит на
+чат, склейка сообщений одному чату, пауза на retry_after и доставка всего
+ровно один раз. Ненулевой код выхода — если что-то из этого нарушено.
+
+persistence — 100 тыс. пользователей (40% без данных, 40% с выбором валют,
+20% с брошенным /convert): память до (всё в словарях навсегда) и после
+(в памяти только активные, остальное в SQLite), размер базы, скорость
+пакетной записи и подгрузки выгруженного пользователя.
+
+bulk — CSV на 1 млн строк (10% неизвестных валют, у части строк лишние
+разделители) через bulk.convert_file: строк в секунду, прирост пикового
+RSS и проверка, что результат стоит под заголовком.
+
+history — HistoryStore с замерами за 5 лет раз в час: время дозаписи и
+range_stats за 7/30/365 дней против перебора всех замеров, со сверкой.
+
+providers — ProviderPool против двух локальных заглушек open.er-api:
+хеджирование медленного основного, условный запрос только источнику
+данных в кэше, NOT_MODIFIED по ETag (304) и по метке версии, размыкание
+цепи после ошибок и единственная проба полуоткрытой цепи. Ненулевой код
+выхода — если какая-то проверка не прошла.
+
+inline — пользователи набирают inline-запрос, и на каждое нажатие приходит
+префикс: ответов в секунду и p50/p99 у inline.build_results без кэша и на
+пути inline_query_handler через inline_cache (со сбросом при смене курсов).
+
+updates — обновления многих чатов приходят разом, обработчик ждёт Bot API:
+обновлений в секунду у последовательной обработки (как без
+concurrent_updates) и у ChatOrderedUpdateProcessor, с проверкой, что в
+каждом чате обновления обработаны по порядку и не пересекаясь. Ненулевой
+код выхода — если порядок нарушен или что-то потеряно.
+
+metrics — цена инструментирования: пустой обработчик с обёрткой timed() и
+без, Counter.inc, Histogram.observe, выгрузка размером с настоящую; и что
+/metrics с METRICS_TOKEN без верного Bearer-токена отвечает 403.
+"""
+import argparse
+import math
+import random
+import re
+import sys
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import CURRENCY_NAMES, CURRENCY_SHORTCUTS
+
+
+def _percentile(ordered, percentile):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+def _compared(before, after, inputs, repeat):
+    """Как _timed для двух функций, замеры вперемешку: шум машины достаётся обеим."""
+    best_before = best_after = None
+    for _ in range(repeat):
+        elapsed_before = _timed(before, inputs, 1)
+        elapsed_after = _timed(after, inputs, 1)
+        best_before = elapsed_before if best_before is None else min(best_before, elapsed_before)
+        best_after = elapsed_after if best_after is None else min(best_after, elapsed_after)
+    return best_before, best_after
+
+
+def _timed(func, inputs, repeat):
+    """Лучшее из repeat время одного вызова func, мкс."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for value in inputs:
+            func(value)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(inputs) * 1e6
+
+
+# --- прежние реализации (базовая версия) для сравнения ---
+
+def _reference_find_currency_code(user_input):
+    if not user_input or not isinstance(user_input, str):
+        return None
+
+    clean = user_input.lower().strip()
+    if len(clean) == 3 and clean.isalpha():
+        code = clean.upper()
+        if code in CURRENCY_NAMES:
+            return code
+
+    if clean in CURRENCY_SHORTCUTS:
+        return CURRENCY_SHORTCUTS[clean]
+
+    for code, name in CURRENCY_NAMES.items():
+        if clean in name.lower():
+            return code
+
+    return None
+
+
+def _reference_parse(text, find_currency_code=_reference_find_currency_code):
+    if not text.strip():
+        return None
+
+    clean_text = re.sub(r'\s+', ' ', text.strip())
+    lower_text = clean_text.lower()
+    if re.search(r'\s+(в|to|in)\s+', lower_text):
+        parts = re.split(r'\s+(в|to|in)\s+', lower_text)
+        if len(parts) < 3:
+            return None
+        sources = parts[0]
+        target_str = parts[2].strip()
+        target_code = find_currency_code(target_str)
+        if not target_code:
+            return None
+
+        tokens = sources.split()
+        items = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if re.match(r'^-?[\d\.,]+$', token.replace(',', '.')):
+                if i + 1 >= len(tokens):
+                    return None
+                try:
+                    amount = float(token.replace(',', '.'))
+                except ValueError:
+                    return None
+                curr_code = find_currency_code(tokens[i + 1])
+                if not curr_code:
+                    return None
+                items.append((amount, curr_code))
+                i += 2
+            else:
+                i += 1
+        if not items:
+            return None
+        return {'type': 'multi', 'items': items, 'to_currency': target_code}
+
+    parts = clean_text.split()
+    if len(parts) == 1:
+        code = find_currency_code(parts[0])
+        if code:
+            return {'type': 'rate_only', 'currency': code}
+
+    if len(parts) >= 3 and len(parts) % 2 == 1:
+        target_code = find_currency_code(parts[-1])
+        if not target_code:
+            return None
+        items = []
+        for i in range(0, len(parts) - 1, 2):
+            try:
+                amount = float(parts[i].replace(',', '.'))
+            except ValueError:
+                return None
+            curr_code = find_currency_code(parts[i + 1])
+            if not curr_code:
+                return None
+            items.append((amount, curr_code))
+        return {'type': 'multi', 'items': items, 'to_currency': target_code}
+
+    return None
+
+
+def _reference_currency_list(mode):
+    buttons = []
+    currencies = list(CURRENCY_NAMES.keys())
+    for i in range(0, len(currencies), 4):
+        row = []
+        for code in currencies[i:i+4]:
+            name = CURRENCY_NAMES[code]
+            label = f"{code} ({name})"
+            cb_data = f"conv_{mode}_{code}"
+            row.append(InlineKeyboardButton(label, callback_data=cb_data))
+        buttons.append(row)
+    text = "Выберите валюту *в*:" if mode == "to" else "Выберите валюту *из*:"
+    return text, InlineKeyboardMarkup(buttons)
+
+
+def _reference_currency_buttons(selected_currencies):
+    buttons = []
+    row = []
+    for code, name in CURRENCY_NAMES.items():
+        prefix = "✅ " if code in selected_currencies else ""
+        button = InlineKeyboardButton(f"{prefix}{code} ({name})", callback_data=f"toggle_{code}")
+        row.append(button)
+        if len(row) == 2:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton("📈 Получить курс", callback_data="get_selected_courses")])
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_courses")])
+    return buttons
+
+
+def _reference_selection_view(selected):
+    text = f"Выберите валюты для отображения (выбрано: {len(selected)}):"
+    return text, InlineKeyboardMarkup(_reference_currency_buttons(selected))
+
+
+def _reference_format_rates(rates):
+    message = "📈 *Курсы валют к RUB:*\n\n"
+    for currency, rate in rates.items():
+        name = CURRENCY_NAMES.get(currency, currency)
+        message += f"• {name} ({currency}): *{rate:.4f}*\n"
+        message += f"  1 {currency} = {rate:.2f} RUB\n"
+        message += f"  1 RUB = {1/rate:.4f} {currency}\n\n"
+    return message
+
+
+# --- parser ---
+
+# Запрос → ожидаемый разбор: (целевая валюта, [(сумма, код), ...]),
+# ('rate', код) для запроса курса или None, если запрос должен отклоняться
+PARSER_CORPUS = (
+    ('100 usd rub', ('RUB', [(100, 'USD')])),
+    ('100 usd в rub', ('RUB', [(100, 'USD')])),
+    ('50 евро в рубли', ('RUB', [(50, 'EUR')])),
+    ('30usd 40 eur 50byn в rub', ('RUB', [(30, 'USD'), (40, 'EUR'), (50, 'BYN')])),
+    ('30 usd и 20 eur в rub', ('RUB', [(30, 'USD'), (20, 'EUR')])),
+    ('1,5к cny в kzt', ('KZT', [(1500, 'CNY')])),
+    ('2 млн руб в usd', ('USD', [(2e6, 'RUB')])),
+    ('(50 eur + 30 usd) * 3 в rub', ('RUB', [(150, 'EUR'), (90, 'USD')])),
+    ('100 usd + 2500 rub - 20 eur в kzt', ('KZT', [(100, 'USD'), (2500, 'RUB'), (-20, 'EUR')])),
+    ('usd', ('rate', 'USD')),
+    ('доллар сша', ('rate', 'USD')),
+    # Дробь с ведущей точкой и экспонента, как у float() в прежнем разборе
+    ('.5 usd rub', ('RUB', [(0.5, 'USD')])),
+    ('2.5 eur .5 byn в rub', ('RUB', [(2.5, 'EUR'), (0.5, 'BYN')])),
+    ('1e5 usd rub', ('RUB', [(1e5, 'USD')])),
+    ('1E-2 usd в rub', ('RUB', [(0.01, 'USD')])),
+    ('1e999 usd rub', None),
+    ('1e300 млрд usd rub', None),
+    ('-5 usd в rub', ('RUB', [(-5, 'USD')])),
+    # «в» последним словом — целевая валюта, как раньше
+    ('100 usd в', ('EUR', [(100, 'USD')])),
+    ('100 usd 50 eur в', ('EUR', [(100, 'USD'), (50, 'EUR')])),
+    # Ключевое слово между суммой и валютой валютой не становится
+    ('100 usd - 5 в rub', None),
+    ('5м в rub', None),
+    # Слагаемое без валюты отклоняется при любом разделителе
+    ('100 и 5 usd rub', None),
+    ('100 + 5 usd в rub', None),
+    ('100 usd и 5 в rub', None),
+    ('100 usd + 5 в rub', None),
+    ('100 usd * 2 + 5 в rub', None),
+    ('100 usd и 5 rub eur', ('EUR', [(100, 'USD'), (5, 'RUB')])),
+    # Лишняя валюта не отбрасывается молча
+    ('100 usd rub eur', None),
+    ('100 usd в rub eur', None),
+    ('100 австралийских долларов в евро', ('EUR', [(100, 'AUD')])),
+    ('привет', None),
+    ('100', None),
+)
+
+
+def _normalized(result):
+    """Разбор без различия simple/multi/expression: сравниваются суммы и валюты."""
+    if result is None:
+        return None
+    if result['type'] == 'rate_only':
+        return 'rate', result['currency']
+    if result['type'] == 'simple':
+        items = [(result['amount'], result['from_currency'])]
+    else:
+        items = result['items']
+    return result['to_currency'], [(float(amount), code) for amount, code in items]
+
+
+def _same(left, right):
+    if left is None or right is None or left[0] == 'rate' or right[0] == 'rate':
+        return left == right
+    return (left[0] == right[0] and len(left[1]) == len(right[1]) and all(
+        a_code == b_code and math.isclose(a_amount, b_amount, rel_tol=1e-9)
+        for (a_amount, a_code), (b_amount, b_code) in zip(left[1], right[1])
+    ))
+
+
+# Суммы в записи, которую принимал прежний разбор. В форме с «в» он брал
+# только то, что совпадало с -?[\d.,]+, поэтому экспоненты там нет
+_NUMBERS = ('100', '5', '0', '007', '1.5', '1,5', '.5', ',5', '5.', '-5', '1,000', '0.01')
+_NUMBERS_NO_TO = _NUMBERS + ('1e3', '2E-1', '-1.5e2')
+_CURRENCIES = (
+    'usd', 'USD', 'Eur', 'rub', 'byn', 'kzt', 'cny', 'доллар', 'долларов', 'евро', 'рубли',
+    'рублей', 'тенге', 'бакс', 'баксов', 'юань', 'лари', 'драм', 'франк', 'фунт',
+)
+# Последним словом прежний разбор принимал и «в»/«и» (они входят в названия)
+_TRAILING = _CURRENCIES + ('в', 'и', 'на')
+_SEPARATORS = ('', '', 'и', '+', 'and', 'плюс')
+_JUNK = _NUMBERS_NO_TO + _CURRENCIES + (
+    '1.5к', '2k', '3kk', '10м', 'млн', 'тыс', 'привет', 'сколько', 'xyz', 'сша',
+    'в', 'to', 'in', 'и', 'and', '+', ',', '-', '*', '/', '=', '(', ')', '->', 'на', 'nan', '1e999',
+)
+
+
+def _grammar_query(rng):
+    """Запрос одной из форм прежней грамматики: курс, «N cur ... cur», «N cur ... в cur»."""
+    shape = rng.random()
+    if shape < 0.1:
+        return rng.choice(_TRAILING)
+    count = rng.randint(1, 4)
+    if shape < 0.5:
+        pairs = [f"{rng.choice(_NUMBERS_NO_TO)} {rng.choice(_CURRENCIES)}" for _ in range(count)]
+        return ' '.join(pairs + [rng.choice(_TRAILING)])
+    text = f"{rng.choice(_NUMBERS)} {rng.choice(_CURRENCIES)}"
+    for _ in range(count - 1):
+        separator = rng.choice(_SEPARATORS)
+        text += f" {separator + ' ' if separator else ''}{rng.choice(_NUMBERS)} {rng.choice(_CURRENCIES)}"
+    return f"{text} {rng.choice(('в', 'to', 'in', 'В', 'TO'))} {rng.choice(_CURRENCIES)}"
+
+
+def _junk_query(rng):
+    """Случайная смесь кусков, иногда склеенных: «30usd», «eur)*3»."""
+    pieces = [rng.choice(_JUNK) for _ in range(rng.randint(1, 7))]
+    text = pieces[0]
+    for piece in pieces[1:]:
+        text += piece if rng.random() < 0.15 else ' ' + piece
+    return text
+
+
+def bench_parser(args):
+    from query_parser import parse_query
+    from resolver import resolver
+
+    failed = 0
+    for text, expected in PARSER_CORPUS:
+        got = _normalized(parse_query(text))
+        if not _same(got, expected):
+            failed += 1
+            print(f"КОРПУС  {text!r}: ожидалось {expected}, получено {got}")
+    print(f"Корпус: {len(PARSER_CORPUS) - failed}/{len(PARSER_CORPUS)} совпало")
+
+    # Прежний разбор с тем же resolver: сравнивается грамматика, а не поиск
+    # валют. Мусор вокруг запроса («привет 100 usd в rub 5») прежний молча
+    # пропускал, новый отклоняет — такие запросы только проверяются на
+    # отсутствие исключений и конечные суммы
+    rng = random.Random(args.seed)
+    mismatched = 0
+    for _ in range(args.fuzz):
+        text = _grammar_query(rng)
+        expected = _normalized(_reference_parse(text, resolver.resolve))
+        got = _normalized(parse_query(text))
+        if not _same(got, expected):
+            mismatched += 1
+            if mismatched <= 20:
+                print(f"ФАЗЗ    {text!r}: прежний {expected}, новый {got}")
+    broken = 0
+    for _ in range(args.fuzz):
+        text = _junk_query(rng)
+        try:
+            got = _normalized(parse_query(text))
+        except Exception as e:
+            got = e
+        if isinstance(got, Exception) or got is not None and got[0] != 'rate' and not all(
+            math.isfinite(amount) for amount, _ in got[1]
+        ):
+            broken += 1
+            if broken <= 20:
+                print(f"МУСОР   {text!r}: {got!r}")
+    print(f"Фазз: {args.fuzz} запросов прежней грамматики, расхождений {mismatched}; "
+          f"{args.fuzz} случайных, сбоев {broken}")
+
+    rng = random.Random(args.seed)
+    texts = [_grammar_query(rng) for _ in range(2000)]
+    before, after = _compared(_reference_parse, parse_query, texts, args.repeat)
+    print(f"Разбор {len(texts)} запросов прежней грамматики: до {before:.1f} мкс, "
+          f"после {after:.1f} мкс на запрос ({before / after:.2f}×)")
+    return 1 if failed or mismatched or broken else 0
+
+
+# --- resolver ---
+
+# Ввод пользователей → ожидаемый код (None — не валюта)
+RESOLVER_CORPUS = (
+    ('usd', 'USD'), ('USD', 'USD'), ('eur', 'EUR'), ('rub', 'RUB'), ('kzt', 'KZT'),
+    ('доллар', 'USD'), ('доллары', 'USD'), ('долларов', 'USD'), ('доллара', 'USD'),
+    ('бакс', 'USD'), ('баксов', 'USD'), ('доллар сша', 'USD'), ('долл', 'USD'),
+    ('евро', 'EUR'), ('евры', 'EUR'), ('рубль', 'RUB'), ('рубли', 'RUB'), ('рублей', 'RUB'),
+    ('руб', 'RUB'), ('юань', 'CNY'), ('юаней', 'CNY'), ('тенге', 'KZT'), ('фунт', 'GBP'),
+    ('фунтов', 'GBP'), ('йена', 'JPY'), ('йен', 'JPY'), ('франк', 'CHF'), ('франков', 'CHF'),
+    ('лира', 'TRY'), ('лиры', 'TRY'), ('гривна', 'UAH'), ('гривен', 'UAH'), ('драм', 'AMD'),
+    ('драмов', 'AMD'), ('лари', 'GEL'), ('ларей', 'GEL'), ('дирхам', 'AED'), ('бат', 'THB'),
+    ('батов', 'THB'), ('тайских', 'THB'), ('вона', 'KRW'), ('рупия', 'INR'), ('реал', 'BRL'),
+    ('белорусский рубль', 'BYN'), ('белорусских', 'BYN'), ('китайских', 'CNY'),
+    ('канадский доллар', 'CAD'), ('австралийских долларов', 'AUD'),
+    # Опечатки
+    ('долар', 'USD'), ('доллор', 'USD'), ('еврр', 'EUR'), ('рублль', 'RUB'), ('тенеге', 'KZT'),
+    ('привет', None), ('сколько', None), ('xyz', None),
+)
+
+
+def bench_resolver(args):
+    from resolver import normalize as resolver_normalize, resolver
+
+    failed = 0
+    for text, expected in RESOLVER_CORPUS:
+        got = resolver.resolve(text)
+        if got != expected:
+            failed += 1
+            print(f"КОРПУС  {text!r}: ожидалось {expected}, получено {got}")
+    print(f"Корпус: {len(RESOLVER_CORPUS) - failed}/{len(RESOLVER_CORPUS)} совпало")
+
+    # Прежний поиск находил всё, что находит и новый, кроме словоформ и опечаток
+    changed = [(text, _reference_find_currency_code(text), resolver.resolve(text))
+               for text, _ in RESOLVER_CORPUS]
+    changed = [row for row in changed if row[1] is not None and row[1] != row[2]]
+    for text, before, after in changed:
+        print(f"ИНАЧЕ   {text!r}: прежний {before}, новый {after}")
+
+    # Три вида ввода: находимый и прежним поиском; словоформы, которые
+    # находят основы; опечатки и не валюты — для них нужен нечёткий поиск,
+    # которого у прежнего не было (он на них просто возвращал None)
+    known = [text for text, _ in RESOLVER_CORPUS if _reference_find_currency_code(text)]
+    stems = [text for text, _ in RESOLVER_CORPUS
+             if text not in known and resolver._resolve_word(resolver_normalize(text), fuzzy=False)]
+    rest = [text for text, _ in RESOLVER_CORPUS if text not in known and text not in stems]
+    for title, texts in (("находимый прежним", known), ("словоформы", stems),
+                         ("опечатки и не валюты", rest)):
+        before, cold = _compared(_reference_find_currency_code, resolver._resolve, texts, args.repeat)
+        cached = _timed(resolver.resolve, texts, args.repeat)
+        print(f"Поиск валюты, {title} ({len(texts)}): прежний {before:.2f} мкс, "
+              f"индекс без кэша {cold:.2f} мкс, с кэшем {cached:.2f} мкс")
+    return 1 if failed else 0
+
+
+# --- render ---
+
+def _keyboard_rows(markup):
+    return [[(button.text, button.callback_data) for button in row] for row in markup.inline_keyboard]
+
+
+def bench_render(args):
+    import render
+
+    rng = random.Random(args.seed)
+    codes = render.SELECTABLE_CODES
+    selections = [frozenset(rng.sample(codes, rng.randint(0, len(codes)))) for _ in range(200)]
+    rates = {code: rng.uniform(0.01, 150) for code in codes}
+
+    # Результат тот же, что у прежних функций
+    failed = 0
+    for selected in selections:
+        before = _reference_selection_view(selected)
+        after = render.selection_view(render.selection_mask(selected))
+        if before[0] != after[0] or _keyboard_rows(before[1]) != _keyboard_rows(after[1]):
+            failed += 1
+    for mode in ('from', 'to'):
+        before = _reference_currency_list(mode)
+        if (before[0] != render.CURRENCY_LIST_TEXTS[mode]
+                or _keyboard_rows(before[1]) != _keyboard_rows(render.CURRENCY_LIST_MARKUPS[mode])):
+            failed += 1
+    if _reference_format_rates(rates) != render.format_rates(rates):
+        failed += 1
+    print(f"Совпадение с прежним выводом: {'да' if not failed else f'нет, расхождений {failed}'}")
+
+    masks = [render.selection_mask(selected) for selected in selections]
+    uncached = render.selection_view.__wrapped__
+    rows = (
+        ("клавиатура выбора валют",
+         _timed(_reference_selection_view, selections, args.repeat),
+         _timed(render.selection_view, masks, args.repeat),
+         _timed(uncached, masks, args.repeat)),
+        ("список валют «из/в»",
+         _timed(_reference_currency_list, ['from', 'to'] * 100, args.repeat),
+         _timed(lambda mode: (render.CURRENCY_LIST_TEXTS[mode], render.CURRENCY_LIST_MARKUPS[mode]),
+                ['from', 'to'] * 100, args.repeat),
+         None),
+        (f"список курсов, {len(rates)} валют",
+         _timed(_reference_format_rates, [rates] * 100, args.repeat),
+         _timed(render.format_rates, [rates] * 100, args.repeat),
+         None),
+    )
+    for title, before, after, cold in rows:
+        extra = f" (маска не из кэша — {cold:.1f} мкс)" if cold is not None else ""
+        print(f"{title}: до {before:.1f} мкс, после {after:.2f} мкс{extra}")
+    return 1 if failed else 0
+
+
+# --- alerts ---
+
+def _reference_match(alerts, old, new):
+    """Прежний способ: проверить каждую подписку."""
+    crossed = []
+    for alert_id, (_, code, operator, threshold) in alerts.items():
+        old_rate = old.rates.get(code)
+        new_rate = new.rates.get(code)
+        if old_rate is None or new_rate is None:
+            continue
+        if operator == '>' and old_rate <= threshold < new_rate:
+            crossed.append(alert_id)
+        elif operator == '<' and new_rate < threshold <= old_rate:
+            crossed.append(alert_id)
+    return crossed
+
+
+def bench_alerts(args):
+    from alerts import AlertBook
+    from config import MAX_ALERTS_PER_CHAT
+    from currency_api import RateSnapshot
+
+    rng = random.Random(args.seed)
+    rates = {code: rng.uniform(1, 150) for code in CURRENCY_NAMES}
+    rates['RUB'] = 1.0
+    codes = [code for code in CURRENCY_NAMES if code != 'RUB']
+
+    book = AlertBook(path=None)
+    started = time.perf_counter()
+    for i in range(args.alerts):
+        code = rng.choice(codes)
+        # Пороги в пределах ±10% от курса — там, где их и ставят
+        book.add(i // MAX_ALERTS_PER_CHAT, code, rng.choice('<>'), rates[code] * rng.uniform(0.9, 1.1))
+    print(f"{len(book.alerts)} подписок добавлено за {time.perf_counter() - started:.1f} с")
+
+    old = RateSnapshot(rates, 0)
+    costs = []
+    fired = 0
+    mismatched = 0
+    reference_costs = []
+    for refresh in range(args.refreshes):
+        # Обычное обновление: курсы сдвигаются на доли процента
+        new = RateSnapshot({code: rate * (1 + rng.gauss(0, args.move / 100)) if code != 'RUB' else rate
+                            for code, rate in old.rates.items()}, refresh + 1)
+        if refresh < args.check:
+            started = time.perf_counter()
+            expected = _reference_match(book.alerts, old, new)
+            reference_costs.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        triggered = book.match(old, new)
+        costs.append(time.perf_counter() - started)
+        if refresh < args.check and sorted(expected) != sorted(row[0] for row in triggered):
+            mismatched += 1
+        fired += len(triggered)
+        old = new
+
+    costs.sort()
+    print(f"Обновлений: {args.refreshes}, сработало в среднем {fired / args.refreshes:.0f} подписок, "
+          f"осталось {len(book.alerts)}")
+    print(f"Поиск сработавших: медиана {costs[len(costs) // 2] * 1000:.2f} мс, "
+          f"максимум {costs[-1] * 1000:.2f} мс на обновление")
+    if reference_costs:
+        print(f"Проверка каждой подписки (прежний способ, {len(reference_costs)} обновлений): "
+              f"{sum(reference_costs) / len(reference_costs) * 1000:.0f} мс на обновление, "
+              f"расхождений {mismatched}")
+    return 1 if mismatched else 0
+
+
+# --- warmstart ---
+
+_WARMSTART_PORT = 18090
+
+
+async def _warmstart_child():
+    """Запуск бота при недоступном провайдере и первая конвертация; печатает JSON."""
+    import json
+
+    import loadtest
+
+    api_server, api_state = loadtest.start_fake_services(_WARMSTART_PORT)
+    started = time.perf_counter()
+    import bot
+    from telegram import Update
+
+    imported = time.perf_counter()
+    application = bot.build_application(updater=False)
+    await application.initialize()
+    await application.start()
+    ready = time.perf_counter()
+    update = Update.de_json(loadtest.UpdateFactory().message(1, '100 usd rub'), application.bot)
+    await application.update_processor.process_update(update, application.process_update(update))
+    replied = time.perf_counter()
+    print(json.dumps({
+        'import': imported - started,
+        'ready': ready - started,
+        'first_reply': replied - started,
+        'reply': api_state['texts'][-1] if api_state['texts'] else '',
+        'stale': bool(bot.currency_api.current() and bot.currency_api.current().stale),
+    }, ensure_ascii=False))
+    await application.stop()
+    await application.shutdown()
+    api_server.stop()
+
+
+def bench_warmstart(args):
+    import asyncio
+    import json
+    import os
+    import subprocess
+    import tempfile
+
+    if args.child:
+        asyncio.run(_warmstart_child())
+        return 0
+
+    import loadtest
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='warmstart-') as workdir:
+        snapshot_path = os.path.join(workdir, 'rates.json')
+        now = time.time()
+        with open(snapshot_path, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': now - 3600, 'data': {
+                'rates': {'RUB': 1.0, **{code: 1 / rate for code, rate in loadtest._STUB_RATES.items()}},
+                'timestamp': now - 3600, 'date': 'снимок для проверки', 'next_update': None,
+            }}, f)
+        env = dict(
+            os.environ,
+            TELEGRAM_BOT_TOKEN=loadtest.TOKEN,
+            TELEGRAM_API_URL=f"http://127.0.0.1:{_WARMSTART_PORT}/bot",
+            # Провайдер лежит: на этом порту никто не слушает
+            RATE_PROVIDERS=f"open.er-api=http://127.0.0.1:{_WARMSTART_PORT + 1}/rates",
+            HISTORY_DIR=os.path.join(workdir, 'history'),
+            ALERTS_PATH='', PERSISTENCE_PATH='', METRICS_PATH='',
+        )
+        for name, path in (('с снимком', snapshot_path), ('без снимка', '')):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'warmstart', '--child'],
+                env=dict(env, RATES_SNAPSHOT_PATH=path), capture_output=True, text=True, check=True,
+            ).stdout
+            results[name] = result = json.loads(output.strip().splitlines()[-1])
+            print(f"{name}: импорт {result['import'] * 1000:.0f} мс, готов к обновлениям "
+                  f"{result['ready'] * 1000:.0f} мс, первый ответ {result['first_reply'] * 1000:.0f} мс "
+                  f"от начала импорта; ответ: {result['reply'].splitlines()[0] if result['reply'] else '—'}")
+
+    warm = results['с снимком']
+    # По снимку бот сразу конвертирует (курсы помечены устаревшими), без снимка — нет
+    ok = warm['stale'] and 'недоступны' not in warm['reply'] and 'USD' in warm['reply']
+    print(f"Тёплый старт при лежащем провайдере: {'конвертация отдана' if ok else 'НЕ отдана'}")
+    return 0 if ok else 1
+
+
+# --- stall ---
+
+def _start_stalled_rates(stall):
+    """Заглушка open.er-api в отдельном потоке, отвечающая через stall секунд."""
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import loadtest
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(stall)
+            now = int(time.time())
+            body = json.dumps({
+                'result': 'success', 'base_code': 'RUB', 'rates': {'RUB': 1, **loadtest._STUB_RATES},
+                'time_last_update_unix': now, 'time_next_update_unix': now + 86400,
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/rates"
+
+
+async def _stall_run(fetch, snapshot, duration, interval):
+    """Задержки обработчиков других пользователей, пока fetch ждёт курсы."""
+    import asyncio
+
+    from query_parser import parse_query
+
+    loop = asyncio.get_running_loop()
+    latencies = []
+
+    async def unrelated(scheduled):
+        # Обычный обработчик при курсах в кэше: разбор и пересчёт, без сети
+        result = parse_query('100 usd rub')
+        snapshot.convert(float(result['amount']), 'USD', 'RUB')
+        await asyncio.sleep(0)
+        latencies.append(loop.time() - scheduled)
+
+    stalled = asyncio.ensure_future(fetch())
+    tasks = []
+    started = loop.time()
+    tick = 0
+    while True:
+        scheduled = started + tick * interval
+        if scheduled - started >= duration:
+            break
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        tasks.append(asyncio.ensure_future(unrelated(scheduled)))
+        tick += 1
+    await asyncio.gather(stalled, *tasks)
+    return sorted(latencies)
+
+
+def bench_stall(args):
+    import asyncio
+
+    import httpx
+
+    import loadtest
+    from currency_api import CurrencyAPI, RateSnapshot
+    from providers import OpenErApiProvider, _normalize_er_api
+
+    server, url = _start_stalled_rates(args.stall)
+    snapshot = RateSnapshot({'RUB': 1.0, **{code: 1 / rate for code, rate in loadtest._STUB_RATES.items()}},
+                            time.time())
+    duration = args.stall + 1
+
+    async def blocking_fetch():
+        # Как было: синхронный запрос прямо в корутине обработчика
+        with httpx.Client(timeout=10) as client:
+            response = client.get(url)
+        return _normalize_er_api(response.json())
+
+    async def async_fetch():
+        api = CurrencyAPI(providers=[OpenErApiProvider(url)])
+        api.snapshot_path = ''
+        try:
+            return await api.get_rates()
+        finally:
+            await api.close()
+
+    for name, fetch in (('до (блокирующий запрос)', blocking_fetch), ('после (httpx.AsyncClient)', async_fetch)):
+        latencies = asyncio.run(_stall_run(fetch, snapshot, duration, args.interval / 1000))
+        print(f"{name}: {len(latencies)} обработчиков, задержка p50 {_percentile(latencies, 50) * 1000:.2f} мс, "
+              f"p99 {_percentile(latencies, 99) * 1000:.2f} мс, max {latencies[-1] * 1000:.2f} мс")
+    server.shutdown()
+    return 0
+
+
+# --- dispatch ---
+
+_DISPATCH_PORT = 18092
+
+
+async def _dispatch_run(limits, dispatcher_rate, chats, per_chat):
+    """Рассылка через MessageDispatcher в фейковый Bot API с лимитами."""
+    import asyncio
+
+    from telegram import Bot
+
+    import dispatcher as dispatcher_module
+    import loadtest
+
+    api_server, state = loadtest.start_fake_services(_DISPATCH_PORT, limits=limits)
+    state['texts'] = []
+    # Окно скорости отправки — секунда, чтобы проверить, что оно не растёт
+    dispatcher_module.THROUGHPUT_WINDOW = 1
+    queue = dispatcher_module.MessageDispatcher(global_rate=dispatcher_rate, chat_rate=1, chat_burst=1)
+    expected = set()
+    async with Bot(loadtest.TOKEN, base_url=f"http://127.0.0.1:{_DISPATCH_PORT}/bot") as bot:
+        started = time.monotonic()
+        queue.start(bot)
+        for round_no in range(per_chat):
+            for chat_id in range(1, chats + 1):
+                text = f"m{chat_id}-{round_no}"
+                expected.add(text)
+                queue.send(chat_id, text)
+            # Следующие сообщения приходят, пока предыдущие ещё в очереди
+            await asyncio.sleep(0.05)
+        while queue.queue_depth or queue._in_flight:
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+        await asyncio.sleep(1.1)
+        queue.send(chats + 1, 'last')
+        while queue.queue_depth or queue._in_flight:
+            await asyncio.sleep(0.05)
+        await queue.stop()
+    api_server.stop()
+    delivered = [text for message in state['texts'] for text in message.split('\n\n')]
+    return queue, state['log'], expected, delivered, elapsed
+
+
+def _pause_violations(log, retry_after):
+    """Запросы, пришедшие, пока отправка должна была стоять после 429."""
+    violations = 0
+    for limited_at, _, status in log:
+        if status != 429:
+            continue
+        # Запросы, уже бывшие в полёте, доходят в первые миллисекунды паузы
+        violations += sum(1 for at, _, _ in log if limited_at + 0.1 < at < limited_at + retry_after - 0.05)
+    return violations
+
+
+def bench_dispatch(args):
+    import asyncio
+    import logging
+
+    # Ответы 429 ожидаемы, журнал доступа tornado о них не нужен
+    logging.getLogger('tornado.access').setLevel(logging.ERROR)
+
+    failed = False
+    for title, limits, rate, expect_limited in (
+        # Token bucket бота пропускает за секунду до 2 × rate (запас плюс
+        # пополнение): при таком лимите API 429 быть не должно
+        ("в пределах лимитов", {'global_rate': 50, 'chat_rate': 1, 'retry_after': 1}, 25, False),
+        # Общий лимит бота выше, чем у API: 429, пауза на retry_after, повтор
+        ("сверх общего лимита", {'global_rate': 20, 'chat_rate': 1, 'retry_after': 1}, 80, True),
+    ):
+        queue, log, expected, delivered, elapsed = asyncio.run(
+            _dispatch_run(limits, rate, args.chats, args.per_chat)
+        )
+        limited = sum(1 for _, _, status in log if status == 429)
+        requests = sum(1 for _, _, status in log if status == 200)
+        lost = len(expected - set(delivered))
+        duplicated = len(delivered) - len(set(delivered))
+        violations = _pause_violations(log, limits['retry_after'])
+        print(f"{title}: {len(expected)} сообщений в {args.chats} чатов за {elapsed:.1f} с, "
+              f"запросов sendMessage {requests}, склеено {queue.stats['coalesced']}, "
+              f"ответов 429 {limited}, запросов во время паузы {violations}, "
+              f"потеряно {lost}, повторов {duplicated}, "
+              f"записей о скорости после паузы {len(queue._sent_times)}")
+        failed |= bool(lost or duplicated or violations or len(queue._sent_times) != 1)
+        failed |= bool(queue.stats['rate_limited']) != expect_limited
+        # Сообщения одному чату склеиваются: запросов меньше, чем сообщений
+        failed |= requests - 1 >= len(expected)
+    return 1 if failed else 0
+
+
+# --- persistence ---
+
+def _simulated_users(rng, count):
+    """count пользователей: 40% без данных, 40% с выбором валют, 20% с брошенным /convert."""
+    from render import SELECTABLE_CODES
+
+    users = []
+    for user_id in range(1, count + 1):
+        kind = rng.random()
+        selected = rng.sample(SELECTABLE_CODES, rng.randint(1, 6)) if kind >= 0.4 else []
+        items = [(rng.choice(SELECTABLE_CODES), rng.choice((None, round(rng.uniform(1, 1000), 2))))
+                 for _ in range(rng.randint(1, 3))] if kind >= 0.8 else []
+        users.append((user_id, selected, items, rng.choice(SELECTABLE_CODES) if items else None))
+    return users
+
+
+def _trace_start():
+    import gc
+    import tracemalloc
+
+    gc.collect()
+    tracemalloc.start()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def _trace_stop(started):
+    """Байт выделено и не освобождено с _trace_start()."""
+    import tracemalloc
+
+    size = tracemalloc.get_traced_memory()[0] - started
+    tracemalloc.stop()
+    return size
+
+
+def _baseline_state(users):
+    # Как было до SqlitePersistence: множества кодов и списки словарей у всех
+    # пользователей навсегда, плюс состояния разговоров
+    user_data = {}
+    conversations = {}
+    for user_id, selected, items, to_code in users:
+        data = user_data[user_id] = {}
+        if selected:
+            data['selected_currencies'] = set(selected)
+        if items:
+            data['conv_items'] = [{'from': code, 'amount': amount} for code, amount in items]
+            data['conv_to'] = to_code
+            conversations[(user_id, user_id)] = 1
+    return user_data, conversations
+
+
+async def _persistence_run(users, active, path):
+    from persistence import SqlitePersistence
+    from render import selection_mask
+
+    store = SqlitePersistence(path, ttl=3600)
+    started = time.perf_counter()
+    for user_id, selected, items, to_code in users:
+        data = {}
+        if selected:
+            data['selected_currencies'] = selection_mask(selected)
+        if items:
+            data['conv_items'] = [{'from': code, 'amount': amount} for code, amount in items]
+            data['conv_to'] = to_code
+            await store.update_conversation('convert', (user_id, user_id), 1)
+        await store.update_user_data(user_id, data)
+    await store._commit_task
+    write_seconds = time.perf_counter() - started
+    rows = store.stats['rows_written']
+
+    # В памяти только активные за ttl: Application поднимает их данные из
+    # базы через refresh_user_data при первом обновлении; разговоры — у тех,
+    # кто сейчас в /convert
+    traced = _trace_start()
+    user_data = {}
+    conversations = {}
+    for user_id, _, items, _ in active:
+        data = user_data[user_id] = {}
+        await store.refresh_user_data(user_id, data)
+        if items:
+            conversations[(user_id, user_id)] = 1
+    in_memory = _trace_stop(traced)
+    loaded = store.stats['loaded']
+
+    # Ленивая подгрузка выгруженного пользователя — без tracemalloc
+    sample = [user_id for user_id, *_ in users[len(active):len(active) + 2000]]
+    started = time.perf_counter()
+    for user_id in sample:
+        await store.refresh_user_data(user_id, {})
+    reload_seconds = (time.perf_counter() - started) / len(sample)
+    await store.flush()
+    return rows, write_seconds, in_memory, loaded, reload_seconds
+
+
+def bench_persistence(args):
+    import asyncio
+    import os
+    import tempfile
+
+    rng = random.Random(args.seed)
+    users = _simulated_users(rng, args.users)
+    rng.shuffle(users)
+    active = users[:int(len(users) * args.active)]
+
+    traced = _trace_start()
+    baseline = _baseline_state(users)
+    before = _trace_stop(traced)
+    del baseline
+    print(f"До: {args.users} пользователей в памяти навсегда — {before / 1e6:.1f} МБ, "
+          f"{before / args.users:.0f} Б на пользователя")
+
+    with tempfile.TemporaryDirectory(prefix='persistence-') as workdir:
+        path = os.path.join(workdir, 'state.sqlite3')
+        rows, write_seconds, after, loaded, reload_seconds = asyncio.run(
+            _persistence_run(users, active, path)
+        )
+        on_disk = sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir))
+    print(f"После: в памяти {len(active)} активных ({args.active:.0%}) — {after / 1e6:.2f} МБ, "
+          f"{after / max(len(active), 1):.0f} Б на активного, {after / args.users:.1f} Б на пользователя; "
+          f"из базы подняты данные {loaded} из них")
+    print(f"Диск: {on_disk / 1e6:.1f} МБ; запись {rows} строк одной пачкой — "
+          f"{rows / write_seconds:.0f} строк/с (вместе с постановкой в очередь); "
+          f"подгрузка выгруженного пользователя {reload_seconds * 1e6:.0f} мкс")
+    return 0
+
+
+# --- bulk ---
+
+def _write_bulk_csv(path, rows, rng):
+    """CSV с заголовком сумма;валюта; 10% валют неизвестны, у части строк лишние «;»."""
+    import csv
+
+    from render import SELECTABLE_CODES
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['id', 'сумма', 'валюта'])
+        for i in range(rows):
+            currency = rng.choice(SELECTABLE_CODES) if rng.random() >= 0.1 else 'XXX'
+            row = [i, f"{rng.uniform(1, 10000):.2f}".replace('.', ','), currency]
+            if i % 7 == 0:
+                row += ['', '']
+            writer.writerow(row)
+
+
+def bench_bulk(args):
+    import csv
+    import os
+    import resource
+    import tempfile
+
+    import bulk
+    import loadtest
+    from currency_api import RateSnapshot
+
+    rates = RateSnapshot({'RUB': 1.0, **{code: 1 / rate for code, rate in loadtest._STUB_RATES.items()}},
+                         time.time())
+    with tempfile.TemporaryDirectory(prefix='bulk-') as workdir:
+        src = os.path.join(workdir, 'table.csv')
+        dst = os.path.join(workdir, 'output.csv')
+        _write_bulk_csv(src, args.rows, random.Random(args.seed))
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats = bulk.convert_file(src, dst, 'csv', rates, 'RUB')
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"CSV {args.rows} строк ({os.path.getsize(src) / 1e6:.0f} МБ): {stats.seconds:.1f} с, "
+              f"{stats.rows_per_sec:.0f} строк/с, с ошибками {stats.errors}; "
+              f"пик RSS вырос на {(rss_after - rss_before) / 1024:.1f} МБ")
+
+        # Результат — ровно под заголовком, в том числе у строк с лишними «;»
+        misplaced = 0
+        with open(dst, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f, delimiter=';')
+            width = len(next(reader))
+            for row in reader:
+                misplaced += len(row) != width
+        print(f"Строк вывода не по ширине заголовка: {misplaced}")
+        failed = misplaced or stats.rows != args.rows
+
+        if args.xlsx and bulk.xlsx_supported():
+            import openpyxl
+
+            src = os.path.join(workdir, 'table.xlsx')
+            workbook = openpyxl.Workbook(write_only=True)
+            sheet = workbook.create_sheet()
+            with open(os.path.join(workdir, 'table.csv'), newline='', encoding='utf-8') as f:
+                for i, row in enumerate(csv.reader(f, delimiter=';')):
+                    if i > args.xlsx:
+                        break
+                    sheet.append(row)
+            workbook.save(src)
+            stats = bulk.convert_file(src, os.path.join(workdir, 'output.xlsx'), 'xlsx', rates, 'RUB')
+            print(f"XLSX {args.xlsx} строк: {stats.seconds:.1f} с, {stats.rows_per_sec:.0f} строк/с")
+    return 1 if failed else 0
+
+
+# --- history ---
+
+def bench_history(args):
+    import os
+    import tempfile
+    from array import array
+
+    import loadtest
+    from currency_api import RateSnapshot
+    from history import TIMESTAMP_TYPE, VALUE_TYPE, HistoryStore
+
+    rng = random.Random(args.seed)
+    codes = tuple(loadtest._STUB_RATES)
+    step = args.interval * 60
+    count = int(args.years * 365 * 86400 // step)
+    now = int(time.time())
+    timestamps = [now - (count - i) * step for i in range(count)]
+    columns = {code: [] for code in codes}
+    for code, rate in loadtest._STUB_RATES.items():
+        value = 1 / rate
+        for _ in range(count):
+            value *= 1 + rng.gauss(0, 0.002)
+            columns[code].append(value)
+
+    with tempfile.TemporaryDirectory(prefix='history-') as workdir:
+        # Годы замеров пишем в файлы хранилища напрямую: через append() это
+        # десятки тысяч открытий файлов
+        with open(os.path.join(workdir, 'timestamps.bin'), 'wb') as f:
+            array(TIMESTAMP_TYPE, timestamps).tofile(f)
+        for code, values in columns.items():
+            with open(os.path.join(workdir, f"{code}.bin"), 'wb') as f:
+                array(VALUE_TYPE, values).tofile(f)
+        store = HistoryStore(workdir, codes=codes)
+
+        started = time.perf_counter()
+        appended = 200
+        for i in range(appended):
+            store.append(RateSnapshot({code: columns[code][-1] for code in codes}, now + (i + 1) * step))
+        append_us = (time.perf_counter() - started) / appended * 1e6
+        print(f"Хранилище: {store.count} замеров по {len(codes)} валютам "
+              f"(каждые {args.interval} мин), дозапись замера {append_us:.0f} мкс")
+
+        failed = 0
+        for days in (7, 30, 365):
+            start = now - days * 86400
+            stats = store.range_stats('USD', start, now)
+            # Проверка по полному перебору тех же float32
+            expected = [value for ts, value in zip(timestamps, array(VALUE_TYPE, columns['USD']))
+                        if start <= ts <= now]
+            if stats is None or stats['samples'] != len(expected) or stats['max'] != max(expected):
+                failed += 1
+            query_us = _timed(lambda _: store.range_stats('USD', start, now), range(100), args.repeat)
+            scan_us = _timed(
+                lambda _: [value for ts, value in zip(timestamps, columns['USD']) if start <= ts <= now],
+                range(3), 3,
+            )
+            print(f"/history за {days} дн. ({len(expected)} замеров): range_stats {query_us:.0f} мкс, "
+                  f"перебор всех замеров в памяти {scan_us:.0f} мкс")
+        store.close()
+    return 1 if failed else 0
+
+
+# --- providers ---
+
+def _start_rates_stub():
+    """Заглушка open.er-api с управляемым поведением: задержка, код ответа,
+    ETag и метка версии данных. Заголовки запросов копятся в state['requests']."""
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import loadtest
+
+    state = {'delay': 0.0, 'status': 200, 'etag': None, 'version': 1700000000, 'requests': []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state['requests'].append(dict(self.headers))
+            time.sleep(state['delay'])
+            try:
+                self._respond()
+            except (BrokenPipeError, ConnectionResetError):
+                # Проигравший хедж: клиент уже отменил запрос
+                pass
+
+        def _respond(self):
+            if state['status'] != 200:
+                self.send_error(state['status'])
+                return
+            etag = state['etag']
+            if etag and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            body = json.dumps({
+                'result': 'success', 'base_code': 'RUB', 'rates': {'RUB': 1, **loadtest._STUB_RATES},
+                'time_last_update_unix': state['version'],
+                'time_next_update_unix': state['version'] + 86400,
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/rates", state
+
+
+async def _providers_run(primary_url, primary, backup_url, backup, cooldown):
+    import asyncio
+
+    import httpx
+
+    from providers import NOT_MODIFIED, OpenErApiProvider, ProviderHealth, ProviderPool
+
+    checks = []
+
+    def check(title, ok):
+        checks.append((title, bool(ok)))
+
+    first, second = OpenErApiProvider(primary_url), OpenErApiProvider(backup_url)
+    pool = ProviderPool([first, second], hedge_delay_min=0.1, hedge_delay_max=0.1)
+    async with httpx.AsyncClient(timeout=5) as client:
+        # Хеджирование
+        primary['etag'] = '"v1"'
+        result = await pool.fetch(client)
+        check("быстрый основной: ответ от него, резервный не запрошен",
+              result is not NOT_MODIFIED and pool.source is first and not backup['requests'])
+
+        primary['delay'] = 1.0
+        started = time.monotonic()
+        result = await pool.fetch(client)
+        elapsed = time.monotonic() - started
+        check(f"основной медлит 1 с: ответ резервного через {elapsed * 1000:.0f} мс",
+              result is not NOT_MODIFIED and pool.source is second and elapsed < 0.5
+              and len(backup['requests']) == 1)
+
+        # Условный запрос — только источнику данных в кэше
+        primary['delay'] = 0.0
+        primary['requests'].clear()
+        backup['requests'].clear()
+        result = await pool.fetch(client, conditional=True)
+        check("источник — резервный: основной спрошен без If-None-Match и прислал данные",
+              result is not NOT_MODIFIED and pool.source is first
+              and 'If-None-Match' not in primary['requests'][0] and not backup['requests'])
+
+        primary['requests'].clear()
+        result = await pool.fetch(client, conditional=True)
+        check("тот же ETag: 304 → NOT_MODIFIED",
+              result is NOT_MODIFIED and primary['requests'][0].get('If-None-Match') == '"v1"')
+
+        # Сервер без ETag: данные те же, если не сменилась метка версии
+        primary['etag'] = None
+        first.etag = None
+        result = await pool.fetch(client, conditional=True)
+        check("без ETag, та же метка версии → NOT_MODIFIED", result is NOT_MODIFIED)
+        primary['version'] += 3600
+        result = await pool.fetch(client, conditional=True)
+        check("без ETag, новая метка версии → новые курсы",
+              result is not NOT_MODIFIED and result['timestamp'] == primary['version'])
+
+        # Автомат-предохранитель
+        for provider in pool.providers:
+            pool.health[provider] = ProviderHealth(failure_threshold=2, cooldown=cooldown)
+        health = pool.health[first]
+        primary['status'] = 500
+        for _ in range(2):
+            await pool.fetch(client)
+        check("2 ошибки подряд → цепь основного разомкнута", health.state == 'open')
+
+        primary['requests'].clear()
+        backup['requests'].clear()
+        await pool.fetch(client)
+        check("разомкнутая цепь: основной не запрошен, ответил резервный",
+              not primary['requests'] and len(backup['requests']) == 1)
+
+        await asyncio.sleep(cooldown)
+        primary['status'] = 200
+        primary['delay'] = 0.3
+        primary['requests'].clear()
+        pool.hedge_delay_min = pool.hedge_delay_max = 1.0
+        check("после паузы цепь полуоткрыта", health.state == 'half-open')
+        await asyncio.gather(*(pool.fetch(client) for _ in range(5)))
+        check(f"полуоткрытая цепь, 5 одновременных запросов: к основному "
+              f"{len(primary['requests'])} (одна проба)", len(primary['requests']) == 1)
+        check("удачная проба замыкает цепь", health.state == 'closed')
+
+        primary['status'] = 500
+        primary['delay'] = 0.0
+        for _ in range(2):
+            await pool.fetch(client)
+        await asyncio.sleep(cooldown)
+        await pool.fetch(client)
+        check("неудачная проба сразу размыкает цепь снова", health.state == 'open')
+    return checks
+
+
+def bench_providers(args):
+    import asyncio
+    import logging
+
+    # Ошибки и хеджи здесь вызваны нарочно
+    logging.getLogger('providers').setLevel(logging.CRITICAL)
+
+    primary_server, primary_url, primary = _start_rates_stub()
+    backup_server, backup_url, backup = _start_rates_stub()
+    try:
+        checks = asyncio.run(_providers_run(primary_url, primary, backup_url, backup, args.cooldown))
+    finally:
+        primary_server.shutdown()
+        backup_server.shutdown()
+    failed = 0
+    for title, ok in checks:
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {title}")
+    return 1 if failed else 0
+
+
+# --- inline ---
+
+_INLINE_QUERIES = (
+    '{} usd в rub', '{} usd', '{} евро', '{} рублей в доллары', '{} eur to usd',
+    '{} юаней', 'курс доллара', '{} usd 50 eur в rub', '({} eur + 30 usd) * 3 в rub',
+    '{} тыс тенге в рубли', 'usd', '{},5 фунтов в евро', '{}к иен в usd', '{} лир в рубли',
+)
+# Круглые суммы набирают чаще, остальные — почти всегда разные
+_INLINE_AMOUNTS = (1, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def _keystrokes(rng, users):
+    """Тексты inline-запросов по мере набора: каждый пользователь печатает запрос
+    по шаблону из _INLINE_QUERIES, и Telegram присылает каждый его префикс."""
+    for _ in range(users):
+        amount = rng.choice(_INLINE_AMOUNTS) if rng.random() < 0.7 else rng.randint(1, 100000)
+        query = rng.choice(_INLINE_QUERIES).format(amount)
+        for end in range(1, len(query) + 1):
+            yield query[:end]
+
+
+def bench_inline(args):
+    import inline
+    import loadtest
+    from config import INLINE_CACHE_SIZE
+    from currency_api import RateSnapshot
+    from response_cache import ResponseCache
+
+    def snapshot():
+        return RateSnapshot({'RUB': 1.0, **{code: 1 / rate for code, rate in loadtest._STUB_RATES.items()}},
+                            time.time())
+
+    texts = list(_keystrokes(random.Random(args.seed), args.users))
+    rates_data = snapshot()
+
+    # Без кэша: каждое нажатие разбирается и превращается в статьи заново
+    answered = 0
+    latencies = []
+    started = time.perf_counter()
+    for text in texts:
+        begin = time.perf_counter()
+        results = inline.build_results(inline.normalize_query(text), rates_data)
+        latencies.append(time.perf_counter() - begin)
+        answered += bool(results)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{len(texts)} нажатий ({args.users} пользователей), с вариантами ответа "
+          f"{answered / len(texts):.0%}")
+    print(f"build_results без кэша: {len(texts) / elapsed:,.0f} ответов/с, "
+          f"p50 {_percentile(latencies, 50) * 1e6:.0f} мкс, p99 {_percentile(latencies, 99) * 1e6:.0f} мкс")
+
+    # Путь inline_query_handler: нормализованный текст → inline_cache, при
+    # промахе build_results и to_dict статей; курсы обновляются каждые
+    # --refresh нажатий, и кэш сбрасывается по версии снимка
+    cache = ResponseCache(INLINE_CACHE_SIZE)
+    started = time.perf_counter()
+    for i, text in enumerate(texts):
+        if args.refresh and i and i % args.refresh == 0:
+            rates_data = snapshot()
+        key = inline.normalize_query(text)
+        response = cache.get(key, rates_data.version)
+        if response is None:
+            results = inline.build_results(key, rates_data)
+            cache.put(key, rates_data.version, (results, [result.to_dict() for result in results]))
+    elapsed = time.perf_counter() - started
+    hits = cache.stats['hits']
+    print(f"через inline_cache: {len(texts) / elapsed:,.0f} ответов/с, попаданий "
+          f"{hits / len(texts):.1%}, сбросов по курсам {cache.stats['invalidations']}")
+    return 0
+
+
+# --- updates ---
+
+async def _updates_run(processor, updates):
+    """Все обновления приходят разом; обработчик «ходит в Bot API» заданное время.
+    Возвращает время и по чатам — (номер, начало, конец) в порядке начала."""
+    import asyncio
+
+    handled = {}
+
+    async def handler(chat_id, number, latency):
+        started = time.monotonic()
+        await asyncio.sleep(latency)
+        handled.setdefault(chat_id, []).append((number, started, time.monotonic()))
+
+    await processor.initialize()
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        processor.process_update(update, handler(update.effective_chat.id, number, latency))
+        for update, number, latency in updates
+    ))
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+    return elapsed, handled
+
+
+def _order_violations(handled):
+    """Сколько обновлений начали обрабатываться раньше предыдущего в своём чате
+    или до его окончания."""
+    violations = 0
+    for items in handled.values():
+        items.sort(key=lambda item: item[1])
+        for (number, _, end), (next_number, next_start, _) in zip(items, items[1:]):
+            violations += next_number < number or next_start < end
+    return violations
+
+
+def bench_updates(args):
+    import asyncio
+
+    from telegram import Update
+    from telegram.ext import SimpleUpdateProcessor
+
+    import loadtest
+    from update_processor import ChatOrderedUpdateProcessor
+
+    rng = random.Random(args.seed)
+    factory = loadtest.UpdateFactory()
+    # Чаты вперемешку, как из вебхука, порядок внутри чата сохранён; время
+    # обработчика — от половины до полутора --latency
+    arrivals = [chat for chat in range(args.chats) for _ in range(args.per_chat)]
+    rng.shuffle(arrivals)
+    numbers = [0] * args.chats
+    updates = []
+    for chat in arrivals:
+        update = Update.de_json(factory.message(100 + chat, f"{numbers[chat]} usd rub"), None)
+        updates.append((update, numbers[chat], args.latency / 1000 * rng.uniform(0.5, 1.5)))
+        numbers[chat] += 1
+    variants = (
+        ('последовательно (concurrent_updates=False)', SimpleUpdateProcessor(1), True),
+        (f'ChatOrderedUpdateProcessor({args.concurrency})',
+         ChatOrderedUpdateProcessor(max_concurrent=args.concurrency), True),
+        # Для сравнения: параллельность PTB без порядка в чате — проверка
+        # порядка должна находить нарушения
+        (f'SimpleUpdateProcessor({args.concurrency}), без порядка',
+         SimpleUpdateProcessor(args.concurrency), False),
+    )
+    print(f"{len(updates)} обновлений: {args.chats} чатов по {args.per_chat}, "
+          f"обработчик в среднем {args.latency:g} мс")
+    failed = 0
+    baseline = None
+    for title, processor, ordered in variants:
+        elapsed, handled = asyncio.run(_updates_run(processor, updates))
+        violations = _order_violations(handled)
+        total = sum(len(items) for items in handled.values())
+        baseline = baseline or elapsed
+        print(f"{title}: {total / elapsed:,.0f} обновлений/с ({baseline / elapsed:.1f}×), "
+              f"нарушений порядка в чате {violations}")
+        if total != len(updates) or ordered and violations:
+            failed += 1
+    return 1 if failed else 0
+
+
+# --- metrics ---
+
+def _metrics_status(port, headers=None):
+    import urllib.error
+    import urllib.request
+
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/metrics", headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def bench_metrics(args):
+    import asyncio
+    import logging
+    import threading
+
+    import tornado.web
+    from tornado.httpserver import HTTPServer
+
+    from metrics import MetricsRegistry, timed
+    from webhook_server import MetricsHandler
+
+    async def handler(update, context):
+        return None
+
+    async def run(callback, calls):
+        started = time.perf_counter()
+        for _ in range(calls):
+            await callback(None, None)
+        return (time.perf_counter() - started) / calls * 1e9
+
+    registry = MetricsRegistry()
+    wrapped = timed(handler,
+                    registry.histogram('bot_handler_seconds', 'bench', handler='noop'),
+                    registry.counter('bot_handler_errors_total', 'bench', handler='noop'))
+    bare_ns = wrapped_ns = None
+    for _ in range(args.repeat):
+        # Вперемешку, как в _compared: шум машины достаётся обоим вариантам
+        elapsed = asyncio.run(run(handler, args.calls))
+        bare_ns = elapsed if bare_ns is None else min(bare_ns, elapsed)
+        elapsed = asyncio.run(run(wrapped, args.calls))
+        wrapped_ns = elapsed if wrapped_ns is None else min(wrapped_ns, elapsed)
+    print(f"Пустой async-обработчик, {args.calls} вызовов: без обёртки {bare_ns:.0f} нс, "
+          f"с timed() {wrapped_ns:.0f} нс, накладные {wrapped_ns - bare_ns:.0f} нс на вызов")
+
+    counter = registry.counter('bench_total', 'bench')
+    histogram = registry.histogram('bench_seconds', 'bench')
+    inc_us = _timed(lambda _: counter.inc(), range(args.calls // 10), args.repeat)
+    observe_us = _timed(lambda _: histogram.observe(0.012), range(args.calls // 10), args.repeat)
+    print(f"Counter.inc {inc_us * 1000:.0f} нс, Histogram.observe {observe_us * 1000:.0f} нс")
+
+    # Выгрузка размером с настоящую: гистограмма и счётчик ошибок на каждый
+    # обработчик, счётчики из stats компонентов и гауги
+    for i in range(args.handlers):
+        registry.histogram('bot_handler_seconds', 'bench', handler=f'handler_{i}').observe(0.01)
+        registry.counter('bot_handler_errors_total', 'bench', handler=f'handler_{i}')
+    for component in ('cache', 'guard', 'dispatch', 'persistence', 'providers'):
+        registry.register_stats(f'bot_{component}', {f'key_{i}': i for i in range(8)}, 'bench')
+    for i in range(10):
+        registry.gauge(f'bot_gauge_{i}', 'bench', lambda: 1.5)
+    text = registry.render()
+    render_us = _timed(lambda _: registry.render(), range(20), args.repeat)
+    print(f"Выгрузка {len(text.splitlines())} строк ({len(text)} байт): {render_us / 1000:.2f} мс")
+
+    # Выгрузка с METRICS_TOKEN: без токена и с чужим токеном — 403
+    logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+    token = 'bench-token'
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    holder = {}
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        server = HTTPServer(tornado.web.Application([
+            (r"/metrics/?", MetricsHandler, {'registry': registry, 'token': token}),
+        ]))
+        server.listen(0, address='127.0.0.1')
+        holder['port'] = next(iter(server._sockets.values())).getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait(5)
+    port = holder['port']
+    checks = {
+        'без заголовка': (_metrics_status(port), 403),
+        'чужой токен': (_metrics_status(port, {'Authorization': 'Bearer wrong'}), 403),
+        'не Bearer': (_metrics_status(port, {'Authorization': token}), 403),
+        'верный токен': (_metrics_status(port, {'Authorization': f'Bearer {token}'}), 200),
+    }
+    loop.call_soon_threadsafe(loop.stop)
+    failed = 0
+    for title, (status, expected) in checks.items():
+        ok = status == expected
+        failed += not ok
+        print(f"/metrics с METRICS_TOKEN, {title}: {status} {'ok' if ok else f'ожидалось {expected}'}")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки частей бота")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('parser', help="корпус, фазз и скорость разбора запросов")
+    command.add_argument('--fuzz', type=int, default=200000, help="сколько случайных запросов")
+    command.add_argument('--seed', type=int, default=1)
+    command.add_argument('--repeat', type=int, default=20)
+    command.set_defaults(run=bench_parser)
+
+    command = commands.add_parser('resolver', help="корпус и скорость поиска кода валюты")
+    command.add_argument('--repeat', type=int, default=200)
+    command.set_defaults(run=bench_resolver)
+
+    command = commands.add_parser('render', help="стоимость клавиатур и текстов на одно нажатие")
+    command.add_argument('--seed', type=int, default=1)
+    command.add_argument('--repeat', type=int, default=20)
+    command.set_defaults(run=bench_render)
+
+    command = commands.add_parser('alerts', help="поиск сработавших подписок среди 1M")
+    command.add_argument('--alerts', type=int, default=1000000)
+    command.add_argument('--refreshes', type=int, default=100)
+    command.add_argument('--move', type=float, default=0.1, help="сдвиг курса за обновление, %% (σ)")
+    command.add_argument('--check', type=int, default=3, help="сколько обновлений сверить с полным перебором")
+    command.add_argument('--seed', type=int, default=1)
+    command.set_defaults(run=bench_alerts)
+
+    command = commands.add_parser('warmstart', help="время от запуска до первой конвертации по снимку")
+    command.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    command.set_defaults(run=bench_warmstart)
+
+    command = commands.add_parser('stall', help="p99 задержки других пользователей при зависшем API курсов")
+    command.add_argument('--stall', type=float, default=5, help="на сколько секунд зависает API курсов")
+    command.add_argument('--interval', type=float, default=10, help="интервал между обработчиками, мс")
+    command.set_defaults(run=bench_stall)
+
+    command = commands.add_parser('dispatch', help="очередь рассылок против Bot API с лимитами и 429")
+    command.add_argument('--chats', type=int, default=40)
+    command.add_argument('--per-chat', type=int, default=3)
+    command.set_defaults(run=bench_dispatch)
+
+    command = commands.add_parser('persistence', help="память на пользователя до и после SqlitePersistence")
+    command.add_argument('--users', type=int, default=100000)
+    command.add_argument('--active', type=float, default=0.05, help="доля активных за USER_STATE_TTL")
+    command.add_argument('--seed', type=int, default=1)
+    command.set_defaults(run=bench_persistence)
+
+    command = commands.add_parser('bulk', help="конвертация таблицы на 1 млн строк: скорость и память")
+    command.add_argument('--rows', type=int, default=1000000)
+    command.add_argument('--xlsx', type=int, default=0, help="ещё XLSX из первых N строк (нужен openpyxl)")
+    command.add_argument('--seed', type=int, default=1)
+    command.set_defaults(run=bench_bulk)
+
+    command = commands.add_parser('history', help="запрос /history по годам замеров")
+    command.add_argument('--years', type=float, default=5)
+    command.add_argument('--interval', type=float, default=60, help="минут между замерами")
+    command.add_argument('--repeat', type=int, default=20)
+    command.add_argument('--seed', type=int, default=1)
+    command.set_defaults(run=bench_history)
+
+    command = commands.add_parser('providers', help="ProviderPool против заглушек: хедж, предохранитель, 304")
+    command.add_argument('--cooldown', type=float, default=0.3, help="пауза разомкнутой цепи, с")
+    command.set_defaults(run=bench_providers)
+
+    command = commands.add_parser('inline', help="inline-ответов в секунду по префиксам набора")
+    command.add_argument('--users', type=int, default=5000, help="сколько пользователей набирают запрос")
+    command.add_argument('--refresh', type=int, default=20000, help="обновление курсов каждые N нажатий")
+    command.add_argument('--seed', type=int, default=1)
+    command.set_defaults(run=bench_inline)
+
+    command = commands.add_parser('updates', help="параллельная обработка с порядком в чате против последовательной")
+    command.add_argument('--chats', type=int, default=100)
+    command.add_argument('--per-chat', type=int, default=5)
+    command.add_argument('--latency', type=float, default=20, help="среднее время обработчика, мс")
+    command.add_argument('--concurrency', type=int, default=64)
+    command.add_argument('--seed', type=int, default=1)
+    command.set_defaults(run=bench_updates)
+
+    command = commands.add_parser('metrics', help="накладные расходы метрик и защита /metrics токеном")
+    command.add_argument('--calls', type=int, default=1000000)
+    command.add_argument('--handlers', type=int, default=20, help="обработчиков в выгрузке")
+    command.add_argument('--repeat', type=int, default=5)
+    command.set_defaults(run=bench_metrics)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,44 @@
+import asyncio
 import logging
 import os
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+import tempfile
+import time
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    filters, ContextTypes, ConversationHandler
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler,
+    InlineQueryHandler, filters, ContextTypes, ConversationHandler
 )
-from config import TOKEN, MAIN_CURRENCIES, CURRENCY_NAMES
+from config import (
+    TOKEN, MAIN_CURRENCIES, CURRENCY_NAMES, ALERTS_SAVE_INTERVAL, EDIT_DEBOUNCE, WEBHOOK_REPLY,
+    WEBHOOK_REPLY_TIMEOUT,
+    RATES_FOLLOW, SNAPSHOT_POLL_INTERVAL, TELEGRAM_API_URL, TELEGRAM_FILE_URL, PERSISTENCE_PATH,
+    USER_STATE_EVICT_INTERVAL, CONVERSATION_TIMEOUT, ADMIN_IDS, ADMISSION_USER_RATE,
+    INLINE_CACHE_SIZE, INLINE_CACHE_TIME_MIN, BULK_MAX_FILE_SIZE, BULK_CONCURRENCY
+)
+from admission import AdmissionController
+from alerts import AlertBook, parse_alert
+import bulk
+from dispatcher import MessageDispatcher, PRIORITY_HIGH
+from edit_guard import EditGuard
+from metrics import metrics, instrument_application, format_stats
+from persistence import SqlitePersistence
+from update_processor import ChatOrderedUpdateProcessor
+import webhook_server
 from currency_api import CurrencyAPI
+from history import HistoryStore
+import inline
+from response_cache import ResponseCache
+from render import (
+    WELCOME_TEMPLATE, HELP_TEXT, COURSES_MENU_TEXT, COURSES_MENU_MARKUP,
+    BACK_TO_COURSES_MARKUP, BACK_TO_SELECTION_MARKUP, CONVERT_DO_MARKUP,
+    CONVERT_NEXT_MARKUP, CURRENCY_LIST_TEXTS, CURRENCY_LIST_MARKUPS, CODE_BITS,
+    codes_from_mask, selection_view
+)
 from utils import (
     parse_convert_input, find_currency_code,
-    format_currency_message, format_multiple_currencies
+    format_currency_message, format_multiple_currencies,
+    parse_history_period, format_history, format_alert, format_alert_triggered,
+    format_expression, format_conversion, format_multi_conversion
 )
 
 
@@ -32,26 +60,24 @@ CONV_AMOUNT = 11
 CONV_TO = 12
 
 currency_api = CurrencyAPI()
+# Создаётся в build_application: импорт bot не должен трогать диск
+history_store = None
+# Готовые ответы на популярные запросы для текущего снимка курсов
+response_cache = ResponseCache()
+# Готовые результаты inline-запросов: ключ — нормализованный текст запроса
+inline_cache = ResponseCache(INLINE_CACHE_SIZE)
+alert_book = AlertBook()
+dispatcher = MessageDispatcher()
+# Все правки сообщений по кнопкам идут через него
+edit_guard = EditGuard()
+# Конвертация таблиц занимает процессор, поэтому их не больше BULK_CONCURRENCY сразу
+bulk_slots = asyncio.Semaphore(BULK_CONCURRENCY)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    welcome_text = (
-        f"Привет, {user.first_name}! 👋\n\n"
-        "🤖 *Я бот для отслеживания курсов валют*\n\n"
-        "📊 *Доступные команды:*\n"
-        "• /start - Начальное сообщение\n"
-        "• /courses - Курсы основных валют\n"
-        "• /convert - Конвертер валют\n"
-        "• /help - Помощь и инструкции\n\n"
-        "💡 *Примеры использования:*\n"
-        "`/courses USD` - курс доллара\n"
-        "`/convert 100 USD RUB` - конвертация\n"
-        "`30 USD и 40 EUR в RUB` - множественная конвертация\n\n"
-        "🔍 *Подсказка:* Можно вводить частичные названия валют.\n"
-        "Например: 'руб', 'дол', 'евр'"
-    )
-    
+    welcome_text = WELCOME_TEMPLATE.format(first_name=user.first_name)
+
     await update.message.reply_text(
         welcome_text, 
         parse_mode='Markdown',
@@ -59,46 +85,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = (
-        "📖 *Справочная информация*\n\n"
-        "🔹 *Основные команды:*\n"
-        "• `/courses` :\n 1.Курсы основных валют (USD, EUR, CNY, BYN, KZT)\n 2.Курсы выбранных валют\n"
-        "• `/courses [код]` - курс конкретной валюты\n"
-        "• `/convert [сумма] [из] [в]` - конвертация\n\n"
-        "🔹 *Примеры запросов:*\n"
-        "`/courses EUR`\n"
-        "`/convert 150 USD RUB`\n"
-        "`50 EUR и 100 USD в RUB`\n\n"
-        "🔹 *Поддерживаемые валюты:*\n"
-    )
-    
-    currencies_list = list(CURRENCY_NAMES.items())
-    for i in range(0, len(currencies_list), 5):
-        chunk = currencies_list[i:i+5]
-        help_text += " | ".join([f"{code}" for code, _ in chunk]) + "\n"
-    
-    help_text += "\n🔹 *Быстрая конвертация:*\n"
-    help_text += "Просто отправьте сообщение вида:\n"
-    help_text += "`100 USD в RUB` или `30 EUR и 50 USD в RUB`"
-    
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Только для администраторов, остальным команда не отвечает
+    if update.effective_user is None or update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(format_stats())
 async def show_currency_list(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str):
-    buttons = []
-    currencies = list(CURRENCY_NAMES.keys())
-    for i in range(0, len(currencies), 4):
-        row = []
-        for code in currencies[i:i+4]:
-            name = CURRENCY_NAMES[code]
-            label = f"{code} ({name})"
-            cb_data = f"conv_{mode}_{code}"
-            row.append(InlineKeyboardButton(label, callback_data=cb_data))
-        buttons.append(row)
-
-    text = "Выберите валюту *в*:" if mode == "to" else "Выберите валюту *из*:"
-    reply_markup = InlineKeyboardMarkup(buttons)
+    text = CURRENCY_LIST_TEXTS[mode]
+    reply_markup = CURRENCY_LIST_MARKUPS[mode]
 
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+        await edit_guard.edit(update.callback_query, text, parse_mode='Markdown', reply_markup=reply_markup)
     else:
         await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 async def courses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -112,31 +111,30 @@ async def courses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 await update.message.reply_text(f"❌ Валюта '{arg}' не найдена.Попробуйте USD,EUR")
                 return
-        rates_data = currency_api.get_rates()
+        rates_data = await currency_api.get_rates()
         if not rates_data:
             await update.message.reply_text("⚠️ Данные недоступны. Попробуйте позже.")
             return
 
-        selected_rates = {
-            code: rates_data['rates'][code]
-            for code in selected_codes
-            if code in rates_data['rates']
-        }
-
-        if not selected_rates:
-            await update.message.reply_text("❌ Не удалось получить курсы для указанных валют.")
-            return
+        key = ('courses', tuple(selected_codes))
+        response = response_cache.get(key, rates_data.version)
+        if response is None:
+            selected_rates = {
+                code: rates_data.rates[code]
+                for code in selected_codes
+                if code in rates_data.rates
+            }
+
+            if not selected_rates:
+                await update.message.reply_text("❌ Не удалось получить курсы для указанных валют.")
+                return
 
-        message = format_multiple_currencies(selected_rates)
-        await update.message.reply_text(message, parse_mode='Markdown')
+            message = format_multiple_currencies(selected_rates, rates_data.stale)
+            response = response_cache.put(key, rates_data.version, (message, None))
+        await webhook_server.reply_text(update.message, response[0], parse_mode='Markdown')
         return 
 
-    keyboard = [
-        [InlineKeyboardButton("📊 Основные валюты", callback_data="main_courses")],
-        [InlineKeyboardButton("🔍 Выбрать валюты", callback_data="select_currencies")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите, какие курсы показать:", reply_markup=reply_markup)
+    await update.message.reply_text(COURSES_MENU_TEXT, reply_markup=COURSES_MENU_MARKUP)
 
 async def handle_course_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -144,69 +142,187 @@ async def handle_course_selection(update: Update, context: ContextTypes.DEFAULT_
     data = query.data
 
     if data == "main_courses":
-        rates_data = currency_api.get_rates()
+        rates_data = await currency_api.get_rates()
         if not rates_data:
-            await query.edit_message_text("⚠️ Данные недоступны.")
+            await edit_guard.edit(query, "⚠️ Данные недоступны.")
             return
 
-        main_rates = {
-            curr: rates_data['rates'][curr]
-            for curr in MAIN_CURRENCIES
-            if curr in rates_data['rates']
-        }
-
-        message = format_multiple_currencies(main_rates)
-        back_keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_courses")]]
-        reply_markup = InlineKeyboardMarkup(back_keyboard)
-        await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+        key = ('main_courses',)
+        response = response_cache.get(key, rates_data.version)
+        if response is None:
+            main_rates = {
+                curr: rates_data.rates[curr]
+                for curr in MAIN_CURRENCIES
+                if curr in rates_data.rates
+            }
+
+            message = format_multiple_currencies(main_rates, rates_data.stale)
+            response = response_cache.put(
+                key, rates_data.version, (message, BACK_TO_COURSES_MARKUP)
+            )
+        message, reply_markup = response
+        await edit_guard.edit(query, message, parse_mode='Markdown', reply_markup=reply_markup)
 
     elif data == "select_currencies":
-        context.user_data['selected_currencies'] = set()
+        context.user_data['selected_currencies'] = 0
         await show_currency_selection(update, context)
 
     elif data == "get_selected_courses":
-        selected = context.user_data.get('selected_currencies', set())
+        # Битовая маска выбранных валют (см. render.CODE_BITS)
+        selected = codes_from_mask(context.user_data.get('selected_currencies', 0))
         if not selected:
             await query.answer("❌ Вы не выбрали ни одной валюты!", show_alert=True)
             return
 
-        rates_data = currency_api.get_rates()
+        rates_data = await currency_api.get_rates()
         if not rates_data:
-            await query.edit_message_text("⚠️ Данные недоступны.")
+            await edit_guard.edit(query, "⚠️ Данные недоступны.")
             return
 
-        selected_rates = {
-            curr: rates_data['rates'][curr]
-            for curr in selected
-            if curr in rates_data['rates']
-        }
-
-        if not selected_rates:
-            await query.edit_message_text("❌ Не удалось получить курсы.")
-            return
+        key = ('selected_courses', selected)
+        response = response_cache.get(key, rates_data.version)
+        if response is None:
+            selected_rates = {
+                curr: rates_data.rates[curr]
+                for curr in selected
+                if curr in rates_data.rates
+            }
+
+            if not selected_rates:
+                await edit_guard.edit(query, "❌ Не удалось получить курсы.")
+                return
 
-        message = format_multiple_currencies(selected_rates)
-        back_keyboard = [[InlineKeyboardButton("⬅️ Назад к выбору", callback_data="select_currencies")]]
-        reply_markup = InlineKeyboardMarkup(back_keyboard)
-        await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+            message = format_multiple_currencies(selected_rates, rates_data.stale)
+            response = response_cache.put(
+                key, rates_data.version, (message, BACK_TO_SELECTION_MARKUP)
+            )
+        message, reply_markup = response
+        await edit_guard.edit(query, message, parse_mode='Markdown', reply_markup=reply_markup)
 
     elif data == "back_to_courses":
-        keyboard = [
-            [InlineKeyboardButton("📊 Основные валюты", callback_data="main_courses")],
-            [InlineKeyboardButton("🔍 Выбрать валюты", callback_data="select_currencies")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите, какие курсы показать:", reply_markup=reply_markup)
+        await edit_guard.edit(query, COURSES_MENU_TEXT, reply_markup=COURSES_MENU_MARKUP)
 
     elif data.startswith("toggle_"):
-        currency = data[7:]
-        selected = context.user_data.setdefault('selected_currencies', set())
-        if currency in selected:
-            selected.remove(currency)
-        else:
-            selected.add(currency)
-        await show_currency_selection(update, context)
+        bit = CODE_BITS.get(data[7:], 0)
+        context.user_data['selected_currencies'] = context.user_data.get('selected_currencies', 0) ^ bit
+        # Серия быстрых нажатий уходит одной правкой с итоговым выбором
+        await show_currency_selection(update, context, delay=EDIT_DEBOUNCE)
+
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args
+    if not args or len(args) > 2:
+        await update.message.reply_text("❌ Пример: `/history USD 30`", parse_mode='Markdown')
+        return
+
+    code = find_currency_code(args[0])
+    if not code:
+        await update.message.reply_text(f"❌ Валюта '{args[0]}' не найдена.Попробуйте USD,EUR")
+        return
+
+    days = parse_history_period(args[1]) if len(args) == 2 else 30
+    if not days:
+        await update.message.reply_text("❌ Период: 7, 30 или 365 дней.")
+        return
+
+    now = time.time()
+    stats = history_store.range_stats(code, now - days * 86400, now)
+    await update.message.reply_text(format_history(code, days, stats), parse_mode='Markdown')
+
+
+async def alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    args = context.args
 
+    if not args:
+        alerts = alert_book.for_chat(chat_id)
+        if not alerts:
+            await update.message.reply_text(
+                "🔔 Подписок нет.\nПример: `/alert USD > 95`", parse_mode='Markdown'
+            )
+            return
+        lines = [
+            f"{alert_id}. {format_alert(operator, code, threshold)}"
+            for alert_id, (_, code, operator, threshold) in alerts
+        ]
+        await update.message.reply_text(
+            "🔔 Ваши подписки:\n" + "\n".join(lines) + "\n\nУдалить: /alert del [номер]"
+        )
+        return
+
+    if args[0].lower() in ('del', 'удалить') and len(args) == 2:
+        try:
+            alert_id = int(args[1])
+        except ValueError:
+            alert_id = None
+        if alert_id is None or not alert_book.remove(alert_id, chat_id):
+            await update.message.reply_text("❌ Подписка не найдена.")
+            return
+        await update.message.reply_text("✅ Подписка удалена.")
+        return
+
+    parsed = parse_alert(" ".join(args))
+    if not parsed:
+        await update.message.reply_text("❌ Пример: `/alert USD > 95`", parse_mode='Markdown')
+        return
+    currency, operator, threshold = parsed
+    code = find_currency_code(currency)
+    if not code or code == 'RUB':
+        await update.message.reply_text(f"❌ Валюта '{currency}' не найдена.Попробуйте USD,EUR")
+        return
+
+    alert_id = alert_book.add(chat_id, code, operator, threshold)
+    if alert_id is None:
+        await update.message.reply_text("❌ Слишком много подписок. Удалите ненужные: /alert")
+        return
+    await update.message.reply_text(
+        f"✅ Подписка {alert_id}: сообщу, когда {format_alert(operator, code, threshold)}"
+    )
+
+
+async def reply_expression(update: Update, result):
+    """Ответ на «100 usd + 2500 rub - 20 eur в kzt»: все слагаемые по одному снимку."""
+    to_curr = result['to_currency'].upper()
+    items = [(amount, code.upper()) for amount, code in result['items']]
+    rates_data = await currency_api.get_rates()
+    if not rates_data:
+        await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
+        return
+
+    key = ('expression', tuple(items), to_curr)
+    response = response_cache.get(key, rates_data.version)
+    if response is None:
+        converted_list = rates_data.convert_many(items, to_curr)
+        if None in converted_list:
+            await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
+            return
+        message = format_expression(items, converted_list, to_curr)
+        response = response_cache.put(key, rates_data.version, (message, None))
+    await update.message.reply_text(response[0], parse_mode='Markdown')
+
+
+async def reply_conversion(update: Update, amount, from_curr, to_curr):
+    """Ответ на конвертацию одной суммы; валюты уже проверены."""
+    if from_curr == to_curr:
+        await update.message.reply_text(f"✅ Валюты совпадают: {amount:.2f} {from_curr}")
+        return
+    rates_data = await currency_api.get_rates()
+    if not rates_data:
+        await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
+        return
+
+    key = ('convert', amount, from_curr, to_curr)
+    response = response_cache.get(key, rates_data.version)
+    if response is None:
+        converted = rates_data.convert(amount, from_curr, to_curr)
+        if converted is None:
+            await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
+            return
+
+        message = format_conversion(amount, from_curr, to_curr, converted)
+        response = response_cache.put(key, rates_data.version, (message, None))
+    await webhook_server.reply_text(update.message, response[0], parse_mode='Markdown')
 
 
 async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -232,24 +348,7 @@ async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if to_curr not in CURRENCY_NAMES:
                 await update.message.reply_text(f"❌ Валюта '{to_curr}' не поддерживается.")
                 return
-            if from_curr == to_curr:
-                await update.message.reply_text(f"✅ Валюты совпадают: {amount:.2f} {from_curr}")
-                return
-            converted = currency_api.convert_currency(amount, from_curr, to_curr)
-            if converted is None:
-                await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
-                return
-
-            from_name = CURRENCY_NAMES.get(from_curr, from_curr)
-            to_name = CURRENCY_NAMES.get(to_curr, to_curr)
-
-            response = (
-                f"💱 *Результат:*\n"
-                f"• {amount:.2f} {from_name} ({from_curr}) =\n"
-                f"• *{converted:.2f} {to_name} ({to_curr})*\n\n"
-                f"📊 Курс: 1 {from_curr} = {converted/amount:.4f} {to_curr}"
-            )
-            await update.message.reply_text(response, parse_mode='Markdown')
+            await reply_conversion(update, amount, from_curr, to_curr)
             return
         input_text = " ".join(context.args)
         result = parse_convert_input(input_text)
@@ -278,24 +377,7 @@ async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if to_curr not in CURRENCY_NAMES:
                 await update.message.reply_text(f"❌ Валюта '{to_curr}' не поддерживается.")
                 return
-            if from_curr == to_curr:
-                await update.message.reply_text(f"✅ Валюты совпадают: {amount:.2f} {from_curr}")
-                return
-
-            converted = currency_api.convert_currency(amount, from_curr, to_curr)
-            if converted is None:
-                await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
-                return
-
-            from_name = CURRENCY_NAMES.get(from_curr, from_curr)
-            to_name = CURRENCY_NAMES.get(to_curr, to_curr)
-            response = (
-                f"💱 *Результат:*\n"
-                f"• {amount:.2f} {from_name} ({from_curr}) =\n"
-                f"• *{converted:.2f} {to_name} ({to_curr})*\n\n"
-                f"📊 Курс: 1 {from_curr} = {converted/amount:.4f} {to_curr}"
-            )
-            await update.message.reply_text(response, parse_mode='Markdown')
+            await reply_conversion(update, amount, from_curr, to_curr)
 
         elif result['type'] == 'multi':
             items = result['items']
@@ -305,8 +387,7 @@ async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(f"❌ Валюта '{to_curr}' не поддерживается.")
                 return
 
-            total = 0.0
-            details = []
+            checked_items = []
             for amount, from_curr in items:
                 from_curr = from_curr.upper()
 
@@ -321,51 +402,47 @@ async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if from_curr not in CURRENCY_NAMES:
                     await update.message.reply_text(f"❌ Валюта '{from_curr}' не поддерживается.")
                     return
+                checked_items.append((amount, from_curr))
 
-                converted = currency_api.convert_currency(amount, from_curr, to_curr)
-                if converted is None:
-                    await update.message.reply_text(f"⚠️ Ошибка для {from_curr}")
-                    return
+            # Все позиции считаются по одному снимку курсов
+            rates_data = await currency_api.get_rates()
+            if not rates_data:
+                await update.message.reply_text("⚠️ Ошибка конвертации. Попробуйте позже.")
+                return
 
-                total += converted
-                from_name = CURRENCY_NAMES.get(from_curr, from_curr)
-                details.append(f"• {amount:.2f} {from_name} = {converted:.2f} {to_curr}")
+            key = ('multi', tuple(checked_items), to_curr)
+            response = response_cache.get(key, rates_data.version)
+            if response is None:
+                converted_list = rates_data.convert_many(checked_items, to_curr)
+                for (amount, from_curr), converted in zip(checked_items, converted_list):
+                    if converted is None:
+                        await update.message.reply_text(f"⚠️ Ошибка для {from_curr}")
+                        return
 
-            to_name = CURRENCY_NAMES.get(to_curr, to_curr)
-            response = (
-                f"💱 *Множественная конвертация:*\n\n"
-                f"{chr(10).join(details)}\n\n"
-                f"📊 *Итого:* {total:.2f} {to_name} ({to_curr})"
-            )
-            await update.message.reply_text(response, parse_mode='Markdown')
+                message = format_multi_conversion(checked_items, converted_list, to_curr)
+                response = response_cache.put(key, rates_data.version, (message, None))
+            await update.message.reply_text(response[0], parse_mode='Markdown')
+
+        elif result['type'] == 'expression':
+            await reply_expression(update, result)
 
         return
 
-    for key in list(context.user_data.keys()):
-        if key.startswith('conv_'):
-            del context.user_data[key]
+    clear_convert_state(context.user_data)
 
     await update.message.reply_text("💱 Выберите валюту, *из* которой конвертировать:", parse_mode='Markdown')
     await show_currency_list(update, context, mode="from")
     return CONV_FROM
 
 
-def build_currency_buttons(selected_currencies):
-    buttons = []
-    row = []
-    for code, name in CURRENCY_NAMES.items():
-        prefix = "✅ " if code in selected_currencies else ""
-        button = InlineKeyboardButton(f"{prefix}{code} ({name})", callback_data=f"toggle_{code}")
-        row.append(button)
-        if len(row) == 2:  # 2 кнопки в строке
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)    
-    buttons.append([InlineKeyboardButton("📈 Получить курс", callback_data="get_selected_courses")])
-    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_courses")])
-    
-    return buttons
+def clear_convert_state(user_data):
+    for key in list(user_data.keys()):
+        if key.startswith('conv_'):
+            del user_data[key]
+
+async def convert_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Брошенный /convert: не держим его пункты в памяти и в базе
+    clear_convert_state(context.user_data)
 
 async def handle_select_to_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -373,15 +450,11 @@ async def handle_select_to_currency(update: Update, context: ContextTypes.DEFAUL
     await show_currency_list(update, context, mode="to")
     return SELECTING_TO_CURRENCY
 
-async def show_currency_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_currency_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, delay=0):
     query = update.callback_query
-    selected = context.user_data.get('selected_currencies', set())
-    keyboard = build_currency_buttons(selected)
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    text = f"Выберите валюты для отображения (выбрано: {len(selected)}):"
+    text, reply_markup = selection_view(context.user_data.get('selected_currencies', 0))
     if query:
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await edit_guard.edit(query, text, delay=delay, reply_markup=reply_markup)
     else:
         await update.message.reply_text(text, reply_markup=reply_markup)
 
@@ -392,12 +465,12 @@ async def handle_convert_callback(update: Update, context: ContextTypes.DEFAULT_
     logger.info(f"✅ Получен callback: {data}")
 
     if data == "conv_add_more":
-        await query.edit_message_text("➕ Выберите ещё одну валюту *из* которой конвертировать:")
+        await edit_guard.edit(query, "➕ Выберите ещё одну валюту *из* которой конвертировать:")
         await show_currency_list(update, context, mode="from")
         return CONV_FROM
 
     elif data == "conv_select_to":
-        await query.edit_message_text("➡️ Выберите валюту, *в* которую конвертировать:")
+        await edit_guard.edit(query, "➡️ Выберите валюту, *в* которую конвертировать:")
         await show_currency_list(update, context, mode="to")
         return CONV_TO
 
@@ -405,7 +478,7 @@ async def handle_convert_callback(update: Update, context: ContextTypes.DEFAULT_
         currency = data[10:]  
         logger.info(f"🔧 Выбрана валюта 'из': {currency}")
         context.user_data.setdefault('conv_items', []).append({'from': currency, 'amount': None})
-        await query.edit_message_text(f"Введите сумму в {currency}:")
+        await edit_guard.edit(query, f"Введите сумму в {currency}:")
         return CONV_AMOUNT
 
     elif data.startswith("conv_to_"):
@@ -414,22 +487,21 @@ async def handle_convert_callback(update: Update, context: ContextTypes.DEFAULT_
         context.user_data['conv_to'] = to_curr
         items = context.user_data.get('conv_items', [])
         if not items:
-            await query.edit_message_text("❌ Сначала выберите хотя бы одну валюту 'из'.")
+            await edit_guard.edit(query, "❌ Сначала выберите хотя бы одну валюту 'из'.")
             return CONV_FROM
 
         text = "✅ Выбрано:\n" + "\n".join(
             f"• {item['from']}: {item['amount'] or '?'}" for item in items
         )
         text += f"\n\nВалюта: {to_curr}\n\nНажмите 'Конвертировать'."
-        keyboard = [[InlineKeyboardButton("✅ Конвертировать", callback_data="conv_do")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_guard.edit(query, text, reply_markup=CONVERT_DO_MARKUP)
         return CONV_TO
 
     elif data == "conv_do":
         items = context.user_data.get('conv_items', [])
         to_curr = context.user_data.get('conv_to')
         if not items or not to_curr:
-            await query.edit_message_text("❌ Недостаточно данных.")
+            await edit_guard.edit(query, "❌ Недостаточно данных.")
             return ConversationHandler.END
 
         to_curr = to_curr.upper()
@@ -440,12 +512,18 @@ async def handle_convert_callback(update: Update, context: ContextTypes.DEFAULT_
             await query.answer("❌ Введите все суммы!", show_alert=True)
             return CONV_TO
 
+        converted_list = await currency_api.convert_many(
+            [(item['amount'], item['from']) for item in items], to_curr
+        )
+        if converted_list is None:
+            await edit_guard.edit(query, "⚠️ Данные недоступны. Попробуйте позже.")
+            return ConversationHandler.END
+
         total = 0.0
         details = []
-        for item in items:
-            converted = currency_api.convert_currency(item['amount'], item['from'], to_curr)
+        for item, converted in zip(items, converted_list):
             if converted is None:
-                await query.edit_message_text(f"⚠️ Ошибка конвертации {item['from']}.")
+                await edit_guard.edit(query, f"⚠️ Ошибка конвертации {item['from']}.")
                 return ConversationHandler.END
             total += converted
             details.append(f"• {item['amount']:.2f} {item['from']} = {converted:.2f} {to_curr}")
@@ -455,7 +533,7 @@ async def handle_convert_callback(update: Update, context: ContextTypes.DEFAULT_
             f"{chr(10).join(details)}\n\n"
             f"📊 *Итого:* {total:.2f} {to_curr}"
         )
-        await query.edit_message_text(response, parse_mode='Markdown')
+        await edit_guard.edit(query, response, parse_mode='Markdown')
         return ConversationHandler.END
 
     else:
@@ -475,13 +553,9 @@ async def handle_convert_amount(update: Update, context: ContextTypes.DEFAULT_TY
         if item['amount'] is None:
             item['amount'] = amount
             break
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить ещё", callback_data="conv_add_more")],
-        [InlineKeyboardButton("➡️ Выбрать 'в'", callback_data="conv_select_to")]
-    ]
     await update.message.reply_text(
         f"Сумма {amount} сохранена.\nЧто дальше?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=CONVERT_NEXT_MARKUP
     )
     return CONV_FROM
 
@@ -512,6 +586,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             "• 100 usd rub\n"
             "• 50 евро в рубли\n"
             "• 30 usd и 20 eur в rub\n"
+            "• (50 eur + 30 usd) * 3 в rub\n"
             "• usd` → курс доллара"
         )
         return
@@ -529,6 +604,8 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         fake_args.append(result['to_currency'])
         context.args = fake_args
         await convert_command(update, context)
+    elif result['type'] == 'expression':
+        await reply_expression(update, result)
 
     elif result['type'] == 'multi':
         await update.message.reply_text(
@@ -539,6 +616,79 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         await update.message.reply_text("Не удалось распознать запрос.")
 
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """«@bot 100 usd rub» из любого чата: только текущий снимок, без сети."""
+    query = update.inline_query
+    rates_data = currency_api.current()
+    if rates_data is None:
+        await query.answer([], cache_time=INLINE_CACHE_TIME_MIN)
+        return
+
+    key = inline.normalize_query(query.query)
+    response = inline_cache.get(key, rates_data.version)
+    if response is None:
+        results = inline.build_results(key, rates_data)
+        response = inline_cache.put(
+            key, rates_data.version, (results, [result.to_dict() for result in results])
+        )
+    await webhook_server.answer_inline_query(
+        query, *response, cache_time=inline.cache_time(rates_data)
+    )
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Таблица сумм в разных валютах → та же таблица со столбцом в одной валюте и итогом."""
+    document = update.message.document
+    kind = bulk.file_kind(document.file_name)
+    if kind == 'xlsx' and not bulk.xlsx_supported():
+        await update.message.reply_text("❌ Таблицы .xlsx здесь не поддерживаются, пришлите CSV.")
+        return
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"❌ Файл больше {BULK_MAX_FILE_SIZE // (1024 * 1024)} МБ. Разбейте таблицу на части."
+        )
+        return
+
+    to_curr = 'RUB'
+    if update.message.caption:
+        to_curr = find_currency_code(update.message.caption)
+        if not to_curr:
+            await update.message.reply_text(
+                f"❌ Валюта '{update.message.caption}' не найдена. Попробуйте USD, EUR"
+            )
+            return
+
+    # Все строки считаются по одному снимку курсов
+    rates_data = await currency_api.get_rates()
+    if not rates_data:
+        await update.message.reply_text("⚠️ Данные недоступны. Попробуйте позже.")
+        return
+
+    await update.message.reply_text("⏳ Обрабатываю таблицу…")
+    # Имя от пользователя идёт только в ответ Telegram, на диске — свои имена
+    name = os.path.splitext(os.path.basename(document.file_name))[0] or 'table'
+    with tempfile.TemporaryDirectory(prefix='bulk-') as workdir:
+        src_path = os.path.join(workdir, f"input.{kind}")
+        dst_path = os.path.join(workdir, f"output.{kind}")
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(src_path)
+        try:
+            async with bulk_slots:
+                # В отдельном потоке, чтобы не останавливать обработку других чатов
+                stats = await asyncio.to_thread(
+                    bulk.convert_file, src_path, dst_path, kind, rates_data, to_curr
+                )
+        except bulk.BulkError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        logger.info(
+            f"Таблица {document.file_name}: {stats.rows} строк за {stats.seconds:.2f} с "
+            f"({stats.rows_per_sec:.0f} строк/с)"
+        )
+        with open(dst_path, 'rb') as f:
+            await update.message.reply_document(
+                f, filename=f"{name}_{to_curr}.{kind}", caption=bulk.format_summary(stats)
+            )
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка: {context.error}", exc_info=context.error)
@@ -550,16 +700,141 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
-def main():
-    # Получаем переменные из окружения
-    WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # например: https://my-bot.onrender.com
-    PORT = int(os.environ.get("PORT", "8443"))   # Render задаёт PORT автоматически
-    SECRET_PATH = os.environ.get("SECRET_PATH", TOKEN)  # путь для безопасности
+async def refresh_rates_job(context: ContextTypes.DEFAULT_TYPE):
+    failures = context.job.data or 0
+    if await currency_api.refresh():
+        failures = 0
+    else:
+        failures += 1
+    delay = currency_api.next_refresh_delay(failures)
+    logger.info(f"Следующее обновление курсов через {delay:.0f} с (ошибок подряд: {failures})")
+    context.job_queue.run_once(refresh_rates_job, delay, data=failures, name="refresh_rates")
+
+async def evict_idle_users_job(context: ContextTypes.DEFAULT_TYPE):
+    await context.application.persistence.evict_idle(context.application)
+
+async def sync_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    await currency_api.sync_snapshot()
+
+def record_history(old, new):
+    history_store.append(new)
+
+def check_alerts(old, new):
+    triggered = alert_book.match(old, new)
+    if triggered:
+        logger.info(f"Сработало подписок: {len(triggered)}")
+    # Рассылка идёт через очередь и не задерживает обновление курсов
+    for _, chat_id, code, operator, threshold, rate in triggered:
+        dispatcher.send(
+            chat_id, format_alert_triggered(code, operator, threshold, rate),
+            priority=PRIORITY_HIGH, parse_mode='Markdown'
+        )
+
+async def save_alerts_job(context: ContextTypes.DEFAULT_TYPE):
+    alert_book.save()
+
+async def post_init(application: Application):
+    dispatcher.start(application.bot)
+    if currency_api.follow_only:
+        # Не принимать обновления, пока нет курсов из снимка ведущего
+        await currency_api.sync_snapshot()
+
+async def post_shutdown(application: Application):
+    await dispatcher.stop()
+    await currency_api.close()
+    if history_store is not None:
+        history_store.close()
+    alert_book.save()
+
+def register_metrics(application, conv_handler):
+    processor = application.update_processor
+    metrics.counter_func('bot_updates_processed_total', 'Обработанные обновления',
+                         lambda: processor.stats['processed'])
+    metrics.gauge('bot_updates_waiting', 'Обновления в очереди своего чата',
+                  lambda: processor.waiting)
+    metrics.gauge('bot_updates_active', 'Обновления в обработке', lambda: processor.active)
+    if processor.admission is not None:
+        metrics.gauge('bot_admission_pending', 'Принятые и ещё не обработанные обновления',
+                      lambda: processor.admission.pending)
+    metrics.gauge('bot_update_wait_p95_seconds', 'p95 ожидания обработки обновления',
+                  lambda: processor.wait_percentile(95))
+    # У ConversationHandler нет публичного счётчика разговоров
+    metrics.gauge('bot_active_conversations', 'Незавершённые /convert',
+                  lambda: len(conv_handler._conversations))
+
+    def rates_age():
+        data = currency_api.cache['data']
+        return time.time() - data.timestamp if data else None
+
+    def refresh_age():
+        fetched_at = currency_api.cache['timestamp']
+        return time.time() - fetched_at if fetched_at else None
+
+    metrics.gauge('bot_rates_age_seconds', 'Возраст отдаваемых курсов по данным провайдера',
+                  rates_age)
+    metrics.gauge('bot_rates_refresh_age_seconds', 'Сколько секунд назад обновлялись курсы',
+                  refresh_age)
+    metrics.register_stats('bot_rates', currency_api.stats, 'Обновления курсов')
+    metrics.register_stats('bot_response_cache', response_cache.stats, 'Кэш ответов')
+    metrics.register_stats('bot_inline_cache', inline_cache.stats, 'Кэш inline-ответов')
+    metrics.register_stats('bot_edit_guard', edit_guard.stats, 'Правки сообщений')
+    metrics.register_stats('bot_dispatch', dispatcher.stats, 'Очередь рассылок')
+    metrics.gauge('bot_dispatch_queue_depth', 'Сообщения в очереди рассылок',
+                  lambda: dispatcher.queue_depth)
+    metrics.gauge('bot_dispatch_throughput', 'Отправлено рассылок в секунду за последнюю минуту',
+                  dispatcher.throughput)
+    if application.persistence is not None:
+        metrics.register_stats('bot_persistence', application.persistence.stats,
+                               'Хранилище состояния')
+    for provider, health in currency_api.providers.health.items():
+        metrics.counter_func('bot_provider_successes_total', 'Успешные ответы провайдера',
+                             lambda health=health: health.successes, provider=provider.name)
+        metrics.counter_func('bot_provider_failures_total', 'Ошибки провайдера',
+                             lambda health=health: health.failures, provider=provider.name)
+        metrics.gauge('bot_provider_circuit_open', 'Предохранитель провайдера разомкнут',
+                      lambda health=health: int(health.state == 'open'), provider=provider.name)
+
+def build_admission():
+    if ADMISSION_USER_RATE <= 0:
+        return None
+    return AdmissionController(
+        # Из нескольких нажатий подряд, ещё ждущих очереди, важно только последнее
+        collapse_groups=(
+            r"conv_from_", r"conv_to_",
+            r"(main_courses|select_currencies|get_selected_courses|back_to_courses)$",
+        ),
+        toggle_pattern=r"toggle_",
+    )
+
 
-    application = Application.builder().token(TOKEN).build()
+def build_application(updater=True):
+    global history_store
+    # Воркер кластера только читает историю, которую пишет ведущий процесс
+    history_store = HistoryStore(read_only=RATES_FOLLOW)
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Чаты обрабатываются параллельно, сообщения одного чата — по порядку
+        .concurrent_updates(ChatOrderedUpdateProcessor(admission=build_admission()))
+    )
+    if PERSISTENCE_PATH:
+        builder = builder.persistence(SqlitePersistence())
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if TELEGRAM_FILE_URL:
+        builder = builder.base_file_url(TELEGRAM_FILE_URL)
+    if not updater:
+        # Вебхук обслуживает webhook_server, встроенный Updater не нужен
+        builder = builder.updater(None)
+    application = builder.build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("courses", courses_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("alert", alert_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("convert", convert_command)],
@@ -579,10 +854,14 @@ def main():
                     pattern=r"^(conv_to_.+|conv_do)$"
                 )
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, convert_timeout)],
         },
         fallbacks=[CommandHandler("convert", convert_command)],
         allow_reentry=True,
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="convert",
+        persistent=bool(PERSISTENCE_PATH)
     )
     application.add_handler(conv_handler)   
     application.add_handler(
@@ -592,19 +871,63 @@ def main():
         )
     )  
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("csv") | filters.Document.FileExtension("xlsx"),
+        handle_document
+    ))
     application.add_error_handler(error_handler)
-    
+    instrument_application(application)
+    register_metrics(application, conv_handler)
+
+    currency_api.add_listener(check_alerts)
+    currency_api.add_listener(response_cache.invalidate)
+    currency_api.add_listener(inline_cache.invalidate)
+    if RATES_FOLLOW:
+        # Курсы получает и сохраняет ведущий процесс (cluster.py), мы только
+        # подхватываем его снимок и никогда не ходим к провайдерам
+        currency_api.follow_only = True
+        application.job_queue.run_repeating(
+            sync_snapshot_job, SNAPSHOT_POLL_INTERVAL, first=0, name="sync_snapshot"
+        )
+    else:
+        # Курсы обновляются только фоновой задачей, первый раз — сразу при старте.
+        # До первого обновления отвечаем по сохранённому снимку.
+        currency_api.load_snapshot()
+        currency_api.add_listener(record_history)
+        currency_api.background_refresh = True
+        application.job_queue.run_once(refresh_rates_job, 0, data=0, name="refresh_rates")
+    application.job_queue.run_repeating(save_alerts_job, ALERTS_SAVE_INTERVAL, name="save_alerts")
+    if PERSISTENCE_PATH:
+        application.job_queue.run_repeating(
+            evict_idle_users_job, USER_STATE_EVICT_INTERVAL, name="evict_idle_users"
+        )
+    return application
+
+
+def main():
+    # Получаем переменные из окружения
+    WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # например: https://my-bot.onrender.com
+    PORT = int(os.environ.get("PORT", "8443"))   # Render задаёт PORT автоматически
+    SECRET_PATH = os.environ.get("SECRET_PATH", TOKEN)  # путь для безопасности
+
+    application = build_application(updater=False)
+
     # ЗАПУСК ЧЕРЕЗ ВЕБХУК (не polling!)
     print("🤖 Запуск бота через вебхук...")
     print(f"   Webhook URL: {WEBHOOK_URL}/{SECRET_PATH}")
     print(f"   Port: {PORT}")
-    
-    application.run_webhook(
+
+    # Свой сервер вебхука: на нём же /metrics; без WEBHOOK_REPLY ответы
+    # в теле HTTP-ответа выключены, и он ведёт себя как встроенный в PTB
+    asyncio.run(webhook_server.run_webhook(
+        application,
         listen="0.0.0.0",
         port=PORT,
         url_path=SECRET_PATH,
-        webhook_url=f"{WEBHOOK_URL}/{SECRET_PATH}"
-    )
+        webhook_url=f"{WEBHOOK_URL}/{SECRET_PATH}",
+        reply_timeout=WEBHOOK_REPLY_TIMEOUT if WEBHOOK_REPLY else 0
+    ))
 if __name__ == '__main__':
     main() 
 
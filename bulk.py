@@ -0,0 +1,306 @@
+import csv
+import itertools
+import os
+import time
+
+try:
+    import openpyxl
+except ImportError:
+    # Без openpyxl принимаем только CSV
+    openpyxl = None
+
+from config import BULK_BATCH_SIZE
+from metrics import metrics
+from resolver import resolver
+
+_ROWS = metrics.counter('bot_bulk_rows_total', 'Строки загруженных таблиц')
+_SECONDS = metrics.histogram(
+    'bot_bulk_seconds', 'Время конвертации таблицы',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+AMOUNT_HEADERS = {'amount', 'sum', 'value', 'сумма', 'количество', 'значение'}
+CURRENCY_HEADERS = {'currency', 'ccy', 'code', 'валюта', 'код', 'код валюты'}
+
+# Сколько разных строк валюты помнить (в колонке их обычно единицы)
+_MEMO_SIZE = 10000
+_SNIFF_BYTES = 64 * 1024
+
+
+class BulkError(Exception):
+    """Таблицу нельзя обработать; текст — для пользователя."""
+
+
+def file_kind(file_name):
+    ext = os.path.splitext(file_name or '')[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext == '.xlsx':
+        return 'xlsx'
+    return None
+
+
+def xlsx_supported():
+    return openpyxl is not None
+
+
+def parse_amount(value):
+    """Число из ячейки: 1234.5, «1 234,5», «1,234.5». None — не число."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        amount = float(value)
+    elif isinstance(value, str):
+        text = value.strip().replace('\xa0', '').replace(' ', '')
+        if ',' in text:
+            text = text.replace(',', '.') if '.' not in text else text.replace(',', '')
+        try:
+            amount = float(text)
+        except ValueError:
+            return None
+    else:
+        return None
+    # NaN и бесконечность в сумме не нужны
+    return amount if amount - amount == 0 else None
+
+
+class _CodeMemo:
+    """find_currency_code для ячеек с запоминанием по исходной строке."""
+
+    def __init__(self):
+        self._codes = {}
+
+    def __call__(self, value):
+        if value is None:
+            return None
+        try:
+            return self._codes[value]
+        except KeyError:
+            pass
+        if len(self._codes) >= _MEMO_SIZE:
+            self._codes.clear()
+        code = self._codes[value] = resolver.resolve(str(value).strip())
+        return code
+
+
+def _header_columns(row):
+    amount = currency = None
+    for index, cell in enumerate(row):
+        name = str(cell).strip().lower() if cell is not None else ''
+        if amount is None and name in AMOUNT_HEADERS:
+            amount = index
+        elif currency is None and name in CURRENCY_HEADERS:
+            currency = index
+    if amount is None or currency is None:
+        return None
+    return amount, currency
+
+
+def _detect_columns(row, resolve):
+    amount = next((i for i, cell in enumerate(row) if parse_amount(cell) is not None), None)
+    if amount is None:
+        return None
+    currency = next(
+        (i for i, cell in enumerate(row)
+         if i != amount and isinstance(cell, str) and resolve(cell) is not None),
+        None
+    )
+    if currency is None:
+        return None
+    return amount, currency
+
+
+# --- чтение и запись по строкам ---
+
+def _open_csv(path):
+    with open(path, 'rb') as f:
+        sample = f.read(_SNIFF_BYTES)
+    try:
+        sample.decode('utf-8')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # Обрезанный на границе выборки символ — ещё не повод для cp1251
+        encoding = 'utf-8-sig' if e.start >= len(sample) - 3 else 'cp1251'
+    text = sample.decode(encoding, errors='ignore')
+    try:
+        dialect = csv.Sniffer().sniff(text.split('\n', 1)[0], delimiters=',;\t|')
+        delimiter = dialect.delimiter
+    except csv.Error:
+        delimiter = ','
+    f = open(path, newline='', encoding=encoding)
+    return f, csv.reader(f, delimiter=delimiter), delimiter
+
+
+class _CsvWriter:
+    def __init__(self, path, delimiter):
+        # BOM — чтобы Excel открыл UTF-8 без вопросов
+        self._file = open(path, 'w', newline='', encoding='utf-8-sig')
+        self._writer = csv.writer(self._file, delimiter=delimiter)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _XlsxWriter:
+    def __init__(self, path):
+        self._path = path
+        # write_only: строки сразу уходят во временный XML, а не копятся в памяти
+        self._workbook = openpyxl.Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet()
+
+    def write(self, rows):
+        for row in rows:
+            self._sheet.append(row)
+
+    def close(self):
+        self._workbook.save(self._path)
+
+
+def _xlsx_rows(workbook):
+    for row in workbook.active.iter_rows(values_only=True):
+        yield list(row)
+
+
+class BulkStats:
+    __slots__ = ('rows', 'converted', 'errors', 'total', 'to_code', 'seconds', 'rates_date')
+
+    def __init__(self, to_code, rates_date):
+        self.rows = 0
+        self.converted = 0
+        self.errors = 0
+        self.total = 0.0
+        self.to_code = to_code
+        self.seconds = 0.0
+        self.rates_date = rates_date
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def convert_rows(rows, writer, rates_data, to_code, batch_size=BULK_BATCH_SIZE):
+    """Дописать к каждой строке сумму в to_code, в конце — строку «Итого».
+
+    rows — итератор строк (списков ячеек), writer — объект с write(строки).
+    Строки идут пачками по batch_size: все пачки считаются по одному снимку
+    курсов, в памяти одновременно только одна пачка.
+    """
+    started = time.perf_counter()
+    stats = BulkStats(to_code, rates_data.date)
+    resolve = _CodeMemo()
+    rows = iter(rows)
+
+    first = next(rows, None)
+    if first is None:
+        raise BulkError("Таблица пустая.")
+    pending = []
+    columns = _header_columns(first)
+    header = first if columns else None
+    if columns is None:
+        columns = _detect_columns(first, resolve)
+        if columns is not None:
+            pending.append(first)
+        else:
+            # Первая строка — заголовок с незнакомыми названиями
+            header = first
+            second = next(rows, None)
+            columns = _detect_columns(second, resolve) if second is not None else None
+            if columns is None:
+                raise BulkError(
+                    "Не нашёл столбцы суммы и валюты. Назовите их «сумма» и «валюта» "
+                    "или «amount» и «currency»."
+                )
+            pending.append(second)
+    amount_col, currency_col = columns
+    width = len(header) if header is not None else len(pending[0])
+
+    if header is not None:
+        writer.write([list(header) + [f"Сумма в {to_code}"]])
+
+    batch, amounts, codes = [], [], []
+
+    def flush():
+        converted = rates_data.convert_batch(amounts, codes, to_code)
+        for row, value in zip(batch, converted):
+            if value is None:
+                row.append(None)
+                stats.errors += 1
+            else:
+                row.append(value)
+                stats.total += value
+                stats.converted += 1
+        writer.write(batch)
+        stats.rows += len(batch)
+        batch.clear()
+        amounts.clear()
+        codes.clear()
+
+    for row in itertools.chain(pending, rows):
+        if not any(cell not in (None, '') for cell in row):
+            continue
+        row = list(row)
+        if len(row) != width:
+            # Столбец с результатом должен стоять ровно под заголовком: короткие
+            # строки дополняем, лишние ячейки («100,USD,,») отрезаем
+            del row[width:]
+            row.extend([None] * (width - len(row)))
+        amount = parse_amount(row[amount_col]) if amount_col < len(row) else None
+        code = resolve(row[currency_col]) if currency_col < len(row) else None
+        if amount is None or code is None:
+            # Такая строка выйдет с пустой суммой и попадёт в ошибки
+            amount, code = 0.0, None
+        batch.append(row)
+        amounts.append(amount)
+        codes.append(code)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    total_row = [None] * width
+    total_row[0] = "Итого"
+    writer.write([total_row + [round(stats.total, 2)]])
+    stats.seconds = time.perf_counter() - started
+    _ROWS.inc(stats.rows)
+    _SECONDS.observe(stats.seconds)
+    return stats
+
+
+def convert_file(src_path, dst_path, kind, rates_data, to_code):
+    """Сконвертировать таблицу с диска в новый файл того же формата."""
+    if kind == 'xlsx':
+        if openpyxl is None:
+            raise BulkError("Таблицы .xlsx не поддерживаются на этом сервере, пришлите CSV.")
+        try:
+            workbook = openpyxl.load_workbook(src_path, read_only=True, data_only=True)
+        except Exception as e:
+            raise BulkError(f"Не удалось открыть таблицу: {e}")
+        writer = _XlsxWriter(dst_path)
+        try:
+            return convert_rows(_xlsx_rows(workbook), writer, rates_data, to_code)
+        finally:
+            workbook.close()
+            writer.close()
+
+    f, reader, delimiter = _open_csv(src_path)
+    writer = _CsvWriter(dst_path, delimiter)
+    try:
+        return convert_rows(reader, writer, rates_data, to_code)
+    except csv.Error as e:
+        raise BulkError(f"Не удалось прочитать CSV: {e}")
+    finally:
+        f.close()
+        writer.close()
+
+
+def format_summary(stats):
+    return (
+        f"✅ Строк: {stats.rows}, сконвертировано: {stats.converted}, "
+        f"с ошибками: {stats.errors}\n"
+        f"📊 Итого: {stats.total:.2f} {stats.to_code} "
+        f"({f'курсы на {stats.rates_date}' if stats.rates_date else 'по текущим курсам'})\n"
+        f"⏱ {stats.seconds:.1f} с, {stats.rows_per_sec:.0f} строк/с"
+    )
@@ -0,0 +1,330 @@
+"""Несколько процессов-воркеров за одним вебхуком.
+
+    python cluster.py              — ведущий процесс: принимает вебхук, раздаёт
+                                     обновления воркерам, обновляет курсы
+    python cluster.py worker N     — воркер N (запускается ведущим)
+
+Обновления одного чата всегда попадают к одному воркеру (консистентное
+хеширование id чата), поэтому user_data и состояние ConversationHandler
+остаются внутри процесса. Курсы получает только ведущий: он пишет снимок
+в RATES_SNAPSHOT_PATH и историю в HISTORY_DIR, воркеры их только читают.
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+from http import HTTPStatus
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Bot, Update
+
+from config import (
+    TOKEN, CLUSTER_WORKERS, CLUSTER_BASE_PORT, RATES_SNAPSHOT_PATH, ALERTS_PATH, PERSISTENCE_PATH,
+    DISPATCH_GLOBAL_RATE, WEBHOOK_REPLY, WEBHOOK_REPLY_TIMEOUT, TELEGRAM_API_URL, METRICS_PATH,
+    METRICS_TOKEN
+)
+from metrics import metrics
+from webhook_server import check_metrics_token
+
+logger = logging.getLogger(__name__)
+
+WORKER_PATH = 'update'
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Консистентное хеширование: при смене числа воркеров переезжает
+    лишь ~1/N чатов, а не почти все, как при chat_id % N."""
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        pos = bisect.bisect(self._keys, _hash(str(key)))
+        return self._nodes[pos % len(self._nodes)]
+
+
+def routing_key(data):
+    """Чат обновления, а если его нет — пользователь (как в ChatOrderedUpdateProcessor)."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+    return data.get('update_id', 0)
+
+
+class ForwardHandler(tornado.web.RequestHandler):
+    """Пересылает обновление воркеру и возвращает Telegram его ответ."""
+
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, ring, client):
+        self.ring = ring
+        self.client = client
+
+    async def post(self):
+        if self.request.headers.get('Content-Type') != 'application/json':
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+        url = self.ring.node(routing_key(data))
+        try:
+            response = await self.client.post(
+                url, content=self.request.body, headers={'Content-Type': 'application/json'}
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"Воркер {url} недоступен: {e}")
+            # Telegram повторит доставку обновления
+            raise tornado.web.HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.set_status(response.status_code)
+        if response.content:
+            # Ответ в теле вебхука (WEBHOOK_REPLY) проходит насквозь
+            self.set_header('Content-Type', 'application/json')
+            self.write(response.content)
+
+
+def _merge_metrics(texts):
+    """Слить выгрузки Prometheus нескольких процессов, пометив их меткой worker.
+
+    texts — [(worker, текст)]; строки одной метрики должны идти подряд.
+    """
+    families = {}
+    for worker, text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('# '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, [[], []])
+                if len(family[0]) < 2:
+                    family[0].append(line)
+                continue
+            if family is None:
+                continue
+            series, value = line.rsplit(' ', 1)
+            if series.endswith('}'):
+                series = f'{series[:-1]},worker="{worker}"}}'
+            else:
+                series = f'{series}{{worker="{worker}"}}'
+            family[1].append(f'{series} {value}')
+    return '\n'.join(line for header, samples in families.values()
+                     for line in (*header, *samples)) + '\n'
+
+
+class ClusterMetricsHandler(tornado.web.RequestHandler):
+    """Метрики ведущего и всех воркеров одной выгрузкой."""
+
+    SUPPORTED_METHODS = ('GET',)
+
+    def initialize(self, urls, client, token=METRICS_TOKEN):
+        self.urls = urls
+        self.client = client
+        self.token = token
+
+    def prepare(self):
+        check_metrics_token(self.request, self.token)
+
+    async def get(self):
+        # Воркеры получают тот же METRICS_TOKEN через окружение
+        headers = {'Authorization': f'Bearer {self.token}'} if self.token else None
+        responses = await asyncio.gather(
+            *(self.client.get(url, headers=headers, timeout=5) for url in self.urls),
+            return_exceptions=True
+        )
+        texts = [('front', metrics.render())]
+        for index, response in enumerate(responses):
+            if isinstance(response, Exception) or response.status_code != HTTPStatus.OK:
+                # Упавший воркер просто пропадает из выгрузки
+                continue
+            texts.append((str(index), response.text))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(_merge_metrics(texts))
+
+
+def _worker_path(path, index):
+    # У каждого воркера свои файлы: их чаты к другим воркерам не попадают
+    if not path:
+        return ''
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+def _worker_env(index, count):
+    env = dict(os.environ)
+    env.update({
+        'RATES_FOLLOW': '1',
+        'ALERTS_PATH': _worker_path(ALERTS_PATH, index),
+        'PERSISTENCE_PATH': _worker_path(PERSISTENCE_PATH, index),
+        # Общий лимит Bot API делится между воркерами
+        'DISPATCH_GLOBAL_RATE': str(DISPATCH_GLOBAL_RATE / count),
+    })
+    return env
+
+
+class WorkerPool:
+    """Процессы-воркеры; упавший воркер перезапускается."""
+
+    def __init__(self, count=CLUSTER_WORKERS, base_port=CLUSTER_BASE_PORT):
+        self.count = count
+        self.urls = [f"http://127.0.0.1:{base_port + i}/{WORKER_PATH}" for i in range(count)]
+        self.metrics_urls = [
+            f"http://127.0.0.1:{base_port + i}/{METRICS_PATH.strip('/')}" for i in range(count)
+        ]
+        self._processes = [None] * count
+        self._stopping = False
+
+    def _spawn(self, index):
+        self._processes[index] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'worker', str(index)],
+            env=_worker_env(index, self.count),
+        )
+        logger.info(f"Запущен воркер {index} (pid {self._processes[index].pid})")
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+
+    async def supervise(self, interval=1):
+        while not self._stopping:
+            for index, process in enumerate(self._processes):
+                if process.poll() is not None and not self._stopping:
+                    logger.error(f"Воркер {index} завершился с кодом {process.returncode}")
+                    self._spawn(index)
+            await asyncio.sleep(interval)
+
+    async def stop(self, timeout=10):
+        self._stopping = True
+        for process in self._processes:
+            if process.poll() is None:
+                process.terminate()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for process in self._processes:
+            while process.poll() is None and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+
+
+async def _refresh_loop(currency_api):
+    failures = 0
+    while True:
+        if await currency_api.refresh():
+            failures = 0
+        else:
+            failures += 1
+        delay = currency_api.next_refresh_delay(failures)
+        logger.info(f"Следующее обновление курсов через {delay:.0f} с (ошибок подряд: {failures})")
+        await asyncio.sleep(delay)
+
+
+async def run_front(listen, port, url_path, webhook_url=None, workers=CLUSTER_WORKERS):
+    """Ведущий процесс: вебхук, маршрутизация и единственный источник курсов."""
+    if not RATES_SNAPSHOT_PATH:
+        raise SystemExit("Для cluster.py нужен RATES_SNAPSHOT_PATH: через него воркеры получают курсы")
+    from currency_api import CurrencyAPI
+    from history import HistoryStore
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    currency_api = CurrencyAPI()
+    currency_api.background_refresh = True
+    currency_api.load_snapshot()
+    history_store = HistoryStore()
+    currency_api.add_listener(lambda old, new: history_store.append(new))
+    refresh_task = asyncio.create_task(_refresh_loop(currency_api))
+
+    pool = WorkerPool(workers)
+    pool.start()
+    supervise_task = asyncio.create_task(pool.supervise())
+
+    client = httpx.AsyncClient(
+        timeout=WEBHOOK_REPLY_TIMEOUT + 30,
+        limits=httpx.Limits(max_connections=64 * workers, max_keepalive_connections=16 * workers),
+    )
+    routes = [
+        (rf"/{url_path.strip('/')}/?", ForwardHandler,
+         {'ring': HashRing(pool.urls), 'client': client}),
+    ]
+    if METRICS_PATH:
+        routes.append((rf"/{METRICS_PATH.strip('/')}/?", ClusterMetricsHandler,
+                       {'urls': pool.metrics_urls, 'client': client}))
+    server = HTTPServer(tornado.web.Application(routes))
+    try:
+        server.listen(port, address=listen)
+        logger.info(f"Кластер из {workers} воркеров слушает {listen}:{port}")
+
+        if webhook_url:
+            bot = Bot(TOKEN, base_url=TELEGRAM_API_URL) if TELEGRAM_API_URL else Bot(TOKEN)
+            async with bot:
+                await bot.set_webhook(webhook_url, allowed_updates=Update.ALL_TYPES)
+
+        await stop_event.wait()
+    finally:
+        server.stop()
+        refresh_task.cancel()
+        supervise_task.cancel()
+        await pool.stop()
+        await client.aclose()
+        await currency_api.close()
+        history_store.close()
+
+
+def run_worker(index):
+    import bot
+    import webhook_server
+
+    application = bot.build_application(updater=False)
+    asyncio.run(webhook_server.run_webhook(
+        application,
+        listen='127.0.0.1',
+        port=CLUSTER_BASE_PORT + index,
+        url_path=WORKER_PATH,
+        reply_timeout=WEBHOOK_REPLY_TIMEOUT if WEBHOOK_REPLY else 0,
+    ))
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == 'worker':
+        run_worker(int(sys.argv[2]))
+        return
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    webhook_url = os.environ.get("WEBHOOK_URL")
+    port = int(os.environ.get("PORT", "8443"))
+    secret_path = os.environ.get("SECRET_PATH", TOKEN)
+    asyncio.run(run_front(
+        "0.0.0.0", port, secret_path,
+        webhook_url=f"{webhook_url}/{secret_path}" if webhook_url else None,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,132 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Другой адрес Bot API (локальный сервер, стенд для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Откуда скачивать файлы; по умолчанию — с того же сервера (…/bot → …/file/bot)
+TELEGRAM_FILE_URL = os.getenv('TELEGRAM_FILE_URL') or (
+    TELEGRAM_API_URL[:-len('bot')] + 'file/bot'
+    if TELEGRAM_API_URL and TELEGRAM_API_URL.endswith('/bot') else None
+)
 
 EXCHANGE_API_URL = "https://open.er-api.com/v6/latest/RUB"
+CBR_API_URL = "https://www.cbr.ru/scripts/XML_daily.asp"
+# Локальный JSON в формате open.er-api для провайдера 'file'
+RATES_FILE_PATH = os.getenv('RATES_FILE_PATH', 'rates.json')
+
+# Провайдеры курсов в порядке приоритета: имя[=url], через запятую
+RATE_PROVIDERS = os.getenv('RATE_PROVIDERS', 'open.er-api,cbr')
+# Задержка перед запуском резервного провайдера (по p95 основного), секунды
+HEDGE_DELAY_MIN = float(os.getenv('HEDGE_DELAY_MIN', '0.5'))
+HEDGE_DELAY_MAX = float(os.getenv('HEDGE_DELAY_MAX', '3'))
+# Автомат-предохранитель: ошибок подряд до отключения и пауза до пробного запроса
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_COOLDOWN = int(os.getenv('CIRCUIT_COOLDOWN', '60'))
+
+# Время жизни кэша курсов, секунды
+CACHE_TIMEOUT = int(os.getenv('CACHE_TIMEOUT', '300'))
+# Отдавать устаревшие курсы сразу, обновляя их в фоне
+STALE_WHILE_REVALIDATE = os.getenv('STALE_WHILE_REVALIDATE', '1') == '1'
+# Жёсткий предел устаревания: после него запросы ждут обновления
+MAX_STALENESS = int(os.getenv('MAX_STALENESS', '3600'))
+
+# Фоновое обновление курсов по time_next_update_unix провайдера
+REFRESH_MIN_INTERVAL = int(os.getenv('REFRESH_MIN_INTERVAL', '60'))
+REFRESH_JITTER = int(os.getenv('REFRESH_JITTER', '30'))
+REFRESH_RETRY_BASE = int(os.getenv('REFRESH_RETRY_BASE', '5'))
+REFRESH_RETRY_MAX = int(os.getenv('REFRESH_RETRY_MAX', '600'))
+
+# Снимок последних курсов на диске для тёплого старта (пусто — не сохранять)
+RATES_SNAPSHOT_PATH = os.getenv('RATES_SNAPSHOT_PATH', 'rates_snapshot.json')
+
+# Только читать курсы из снимка, который пишет другой процесс (воркеры
+# cluster.py), и проверять его обновление раз в SNAPSHOT_POLL_INTERVAL секунд
+RATES_FOLLOW = os.getenv('RATES_FOLLOW', '0') == '1'
+SNAPSHOT_POLL_INTERVAL = float(os.getenv('SNAPSHOT_POLL_INTERVAL', '5'))
+
+# Каталог колоночного хранилища истории курсов
+HISTORY_DIR = os.getenv('HISTORY_DIR', 'history')
+
+# Подписки на пересечение курсом порога (/alert)
+ALERTS_PATH = os.getenv('ALERTS_PATH', 'alerts.json')
+MAX_ALERTS_PER_CHAT = int(os.getenv('MAX_ALERTS_PER_CHAT', '20'))
+ALERTS_SAVE_INTERVAL = int(os.getenv('ALERTS_SAVE_INTERVAL', '60'))
+
+# Состояние пользователей (выбранные валюты, незавершённый /convert) в SQLite
+# (пусто — только в памяти) и как часто сбрасывать изменения на диск, секунды
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'state.sqlite3')
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', '10'))
+# Данные пользователя, молчащего дольше USER_STATE_TTL секунд, выгружаются
+# из памяти (проверка раз в USER_STATE_EVICT_INTERVAL секунд)
+USER_STATE_TTL = int(os.getenv('USER_STATE_TTL', '3600'))
+USER_STATE_EVICT_INTERVAL = int(os.getenv('USER_STATE_EVICT_INTERVAL', '300'))
+# Брошенный /convert сбрасывается через столько секунд
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', '900'))
+
+# Очередь массовых рассылок: лимиты Bot API (сообщений в секунду)
+DISPATCH_GLOBAL_RATE = float(os.getenv('DISPATCH_GLOBAL_RATE', '25'))
+DISPATCH_CHAT_RATE = float(os.getenv('DISPATCH_CHAT_RATE', '1'))
+DISPATCH_CHAT_BURST = int(os.getenv('DISPATCH_CHAT_BURST', '1'))
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', '10'))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv('DISPATCH_MAX_ATTEMPTS', '3'))
+
+# Кэш готовых ответов на популярные запросы (записей)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1024'))
+
+# Правки сообщений по кнопкам: сколько сообщений помнить и пауза,
+# за которую серия нажатий «выбрать валюту» собирается в одну правку, секунды
+EDIT_GUARD_SIZE = int(os.getenv('EDIT_GUARD_SIZE', '10000'))
+EDIT_DEBOUNCE = float(os.getenv('EDIT_DEBOUNCE', '0.3'))
+
+# cluster.py: число процессов-воркеров и первый из их локальных портов
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', str(os.cpu_count() or 2)))
+CLUSTER_BASE_PORT = int(os.getenv('CLUSTER_BASE_PORT', '18500'))
+
+# Сколько обновлений разных чатов обрабатывать одновременно
+# (внутри одного чата обновления всегда идут по порядку)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+
+# Допуск входящих обновлений: лимит на пользователя и на групповой чат
+# (обновлений в секунду и запас на всплеск), предел принятых, но ещё не
+# обработанных обновлений (0 — без предела) и как часто отвечать
+# пользователю «слишком часто». ADMISSION_USER_RATE=0 отключает допуск
+ADMISSION_USER_RATE = float(os.getenv('ADMISSION_USER_RATE', '3'))
+ADMISSION_USER_BURST = int(os.getenv('ADMISSION_USER_BURST', '15'))
+ADMISSION_CHAT_RATE = float(os.getenv('ADMISSION_CHAT_RATE', '10'))
+ADMISSION_CHAT_BURST = int(os.getenv('ADMISSION_CHAT_BURST', '30'))
+ADMISSION_MAX_PENDING = int(os.getenv('ADMISSION_MAX_PENDING', '2000'))
+ADMISSION_NOTICE_INTERVAL = float(os.getenv('ADMISSION_NOTICE_INTERVAL', '10'))
+
+# Ответ прямо в теле HTTP-ответа на вебхук (экономит запрос к Bot API)
+# и сколько секунд ждать такой ответ от обработчика
+WEBHOOK_REPLY = os.getenv('WEBHOOK_REPLY', '0') == '1'
+WEBHOOK_REPLY_TIMEOUT = float(os.getenv('WEBHOOK_REPLY_TIMEOUT', '2'))
+
+# Путь выгрузки метрик Prometheus на сервере вебхука: по умолчанию пусто —
+# не отдавать, порт вебхука открыт всему интернету. METRICS_TOKEN — если
+# задан, выгрузка только с заголовком «Authorization: Bearer <токен>».
+# ADMIN_IDS — id администраторов, которым доступна команда /stats
+METRICS_PATH = os.getenv('METRICS_PATH', '')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+ADMIN_IDS = frozenset(int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip())
+
+# Пределы для выражений вида «(50 eur + 30 usd) * 3 в rub»
+EXPRESSION_MAX_TOKENS = int(os.getenv('EXPRESSION_MAX_TOKENS', '64'))
+EXPRESSION_MAX_DEPTH = int(os.getenv('EXPRESSION_MAX_DEPTH', '8'))
+
+# Inline-режим: сколько вариантов показывать, сколько разных запросов помнить
+# и в каких пределах держать cache_time для Telegram (до смены курсов), секунды
+INLINE_MAX_RESULTS = int(os.getenv('INLINE_MAX_RESULTS', '5'))
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', '4096'))
+INLINE_CACHE_TIME_MIN = int(os.getenv('INLINE_CACHE_TIME_MIN', '10'))
+INLINE_CACHE_TIME_MAX = int(os.getenv('INLINE_CACHE_TIME_MAX', '3600'))
+
+# Пакетная конвертация загруженных таблиц CSV/XLSX: строк в пачке, предел
+# размера файла (Bot API отдаёт боту файлы до 20 МБ) и сколько таблиц
+# обрабатывать одновременно
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', '4096'))
+BULK_MAX_FILE_SIZE = int(os.getenv('BULK_MAX_FILE_SIZE', str(20 * 1024 * 1024)))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '1'))
 
 MAIN_CURRENCIES = ['USD', 'EUR', 'CNY', 'BYN', 'KZT']
 
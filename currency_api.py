@@ -1,109 +1,372 @@
-import requests
+import asyncio
+import httpx
+import inspect
+import itertools
+import json
 import logging
+import os
+import random
+import time
+from array import array
 from datetime import datetime
-from config import EXCHANGE_API_URL
+from types import MappingProxyType
+from config import (
+    CACHE_TIMEOUT, STALE_WHILE_REVALIDATE, MAX_STALENESS,
+    REFRESH_MIN_INTERVAL, REFRESH_JITTER, REFRESH_RETRY_BASE, REFRESH_RETRY_MAX,
+    RATES_SNAPSHOT_PATH, CURRENCY_NAMES
+)
+from metrics import metrics
+from providers import NOT_MODIFIED, ProviderError, ProviderPool, build_providers
 
 logger = logging.getLogger(__name__)
 
+# Валюты с предрасчитанной таблицей кросс-курсов и их индексы
+SUPPORTED_CODES = tuple(CURRENCY_NAMES)
+CODE_INDEX = {code: i for i, code in enumerate(SUPPORTED_CODES)}
+
+_snapshot_versions = itertools.count(1)
+
+
+class RateSnapshot:
+    """Неизменяемый снимок курсов (RUB за 1 единицу валюты) с номером версии."""
+
+    __slots__ = ('version', 'rates', 'timestamp', 'date', 'next_update', 'stale',
+                 '_values', '_cross')
+
+    def __init__(self, rates, timestamp, date='', next_update=None, stale=False):
+        n = len(SUPPORTED_CODES)
+        nan = float('nan')
+        values = array('d', (rates.get(code, nan) for code in SUPPORTED_CODES))
+        # cross[i * n + j] — сколько единиц валюты j даёт 1 единица валюты i
+        cross = array('d', bytes(8 * n * n))
+        for i in range(n):
+            row = i * n
+            for j in range(n):
+                cross[row + j] = values[i] / values[j]
+
+        setattr_ = object.__setattr__
+        setattr_(self, 'version', next(_snapshot_versions))
+        setattr_(self, 'rates', MappingProxyType(dict(rates)))
+        setattr_(self, 'timestamp', timestamp)
+        setattr_(self, 'date', date)
+        setattr_(self, 'next_update', next_update)
+        setattr_(self, 'stale', stale)
+        setattr_(self, '_values', values)
+        setattr_(self, '_cross', cross)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RateSnapshot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("RateSnapshot is immutable")
+
+    def __repr__(self):
+        return f"RateSnapshot(version={self.version}, date={self.date!r}, stale={self.stale})"
+
+    def to_dict(self):
+        return {
+            'rates': dict(self.rates),
+            'timestamp': self.timestamp,
+            'date': self.date,
+            'next_update': self.next_update,
+        }
+
+    @classmethod
+    def from_dict(cls, data, stale=False):
+        return cls(data['rates'], data['timestamp'], data.get('date', ''),
+                   data.get('next_update'), stale)
+
+    def cross_rate(self, from_currency, to_currency):
+        i = CODE_INDEX.get(from_currency)
+        j = CODE_INDEX.get(to_currency)
+        if i is not None and j is not None:
+            rate = self._cross[i * len(SUPPORTED_CODES) + j]
+            # NaN — валюты нет в ответе провайдера
+            return rate if rate == rate else None
+        rates = self.rates
+        if from_currency not in rates or to_currency not in rates:
+            return None
+        return rates[from_currency] / rates[to_currency]
+
+    def convert(self, amount, from_currency, to_currency):
+        rate = self.cross_rate(from_currency, to_currency)
+        if rate is None:
+            return None
+        return round(amount * rate, 4)
+
+    def convert_many(self, items, to_currency):
+        """Конвертировать [(сумма, код), ...] в одну валюту по этому снимку.
+
+        Для валют, которых нет в снимке, на месте результата стоит None.
+        """
+        results = []
+        for amount, from_currency in items:
+            rate = self.cross_rate(from_currency, to_currency)
+            results.append(None if rate is None else round(amount * rate, 4))
+        return results
+
+    def convert_batch(self, amounts, codes, to_currency):
+        """Конвертировать столбец сумм по столбцу кодов (None — валюты нет в снимке).
+
+        Курс к to_currency ищется один раз на каждый код пачки.
+        """
+        factors = {code: self.cross_rate(code, to_currency) for code in set(codes)}
+        return [
+            None if factor is None else round(amount * factor, 4)
+            for amount, factor in zip(amounts, map(factors.__getitem__, codes))
+        ]
+
+
+# Откуда отдан ответ get_rates: кэш, устаревший кэш (обновление в фоне), сеть
+_SERVED = {
+    source: metrics.counter('bot_rates_requests_total', 'Запросы курсов по источнику ответа',
+                            source=source)
+    for source in ('cache', 'stale', 'network')
+}
+_FETCH_SECONDS = metrics.histogram('bot_rates_fetch_seconds', 'Время обновления курсов у провайдеров')
+_FETCH_ERRORS = metrics.counter('bot_rates_fetch_errors_total', 'Неудачные обновления курсов')
+
+
 class CurrencyAPI:
-    def __init__(self):
+    def __init__(self, providers=None):
         self.cache = {'data': None, 'timestamp': None}
-        self.cache_timeout = 300
+        self.cache_timeout = CACHE_TIMEOUT
+        # Отдаём устаревшие курсы, пока в фоне идёт обновление,
+        # но не старше max_staleness секунд
+        self.stale_while_revalidate = STALE_WHILE_REVALIDATE
+        self.max_staleness = MAX_STALENESS
+        # Один пул keep-alive соединений на весь процесс
+        self._client = None
+        self.providers = ProviderPool(providers if providers is not None else build_providers())
+        # Единственный запрос к API, которого ждут все конкурентные вызовы
+        self._refresh_task = None
+        # Полные обновления и ответы «не изменилось»
+        self.stats = {'full_refreshes': 0, 'not_modified': 0}
+        # Подписчики на новые снимки: callback(old, new), можно async
+        self._listeners = []
+        # Курсы обновляет фоновая задача: запросы пользователей
+        # никогда не ходят в API, пока в кэше есть данные
+        self.background_refresh = False
+        self.snapshot_path = RATES_SNAPSHOT_PATH
+        # Курсы только читаются из снимка, который пишет другой процесс
+        self.follow_only = False
+        self._snapshot_mtime = None
 
-    def get_rates(self):
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=10,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def current(self):
+        """Текущий снимок без обращения к сети (None — курсов ещё нет)."""
+        return self.cache['data']
+
+    async def get_rates(self):
         current_time = datetime.now().timestamp()
-        if (self.cache['data'] and self.cache['timestamp'] and 
-            current_time - self.cache['timestamp'] < self.cache_timeout):
+        if self.follow_only:
+            _SERVED['cache'].inc()
             return self.cache['data']
-        
+        if self.cache['data'] and self.cache['timestamp']:
+            if self.background_refresh:
+                _SERVED['cache'].inc()
+                return self.cache['data']
+            age = current_time - self.cache['timestamp']
+            if age < self.cache_timeout:
+                _SERVED['cache'].inc()
+                return self.cache['data']
+            if self.stale_while_revalidate and age < self.max_staleness:
+                _SERVED['stale'].inc()
+                self._start_refresh()
+                return self.cache['data']
+
+        _SERVED['network'].inc()
+        self._start_refresh()
+        # shield: отмена одного обработчика не должна отменять общий запрос
+        return await asyncio.shield(self._refresh_task)
+
+    def load_snapshot(self, stale=True):
+        """Загрузить сохранённые курсы с диска (тёплый старт)."""
+        if not self.snapshot_path:
+            return False
+        started = time.perf_counter()
         try:
-            response = requests.get(EXCHANGE_API_URL, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('result') != 'success':
-                logger.error(f"API вернул ошибку: {data.get('error-type', 'unknown')}")
-                if self.cache['data']:
-                    logger.info("Использую устаревшие данные из кэша")
-                    return self.cache['data']
-                return None
-            
-            api_rates = data['rates']
-            rates = {'RUB': 1.0}
-            
-            for currency, rub_to_currency in api_rates.items():
-                if currency != 'RUB' and rub_to_currency > 0:
-                    rates[currency] = 1.0 / rub_to_currency
-            
-            result = {
-                'rates': rates,
-                'timestamp': data.get('time_last_update_unix', current_time),
-                'date': data.get('time_last_update_utc', ''),
-            }
-            
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            result = RateSnapshot.from_dict(snapshot['data'], stale=stale)
+            self.cache['data'] = result
+            self.cache['timestamp'] = snapshot['fetched_at']
+        except FileNotFoundError:
+            return False
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            logger.error(f"Не удалось загрузить снимок курсов: {e}")
+            return False
+        logger.info(
+            f"Загружен снимок курсов от {result.date} "
+            f"за {(time.perf_counter() - started) * 1000:.1f} мс"
+        )
+        return True
+
+    async def sync_snapshot(self):
+        """Подхватить снимок, если его переписал другой процесс. True — обновился."""
+        try:
+            mtime = os.stat(self.snapshot_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._snapshot_mtime:
+            return False
+        old = self.cache['data']
+        if not self.load_snapshot(stale=False):
+            return False
+        self._snapshot_mtime = mtime
+        await self._notify_listeners(old, self.cache['data'])
+        return True
+
+    def _save_snapshot(self, result, fetched_at):
+        if not self.snapshot_path:
+            return
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': fetched_at, 'data': result.to_dict()}, f,
+                          separators=(',', ':'))
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить снимок курсов: {e}")
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    async def _notify_listeners(self, old, new):
+        for callback in self._listeners:
+            try:
+                result = callback(old, new)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике обновления курсов: {e}", exc_info=e)
+
+    async def refresh(self):
+        """Принудительно обновить курсы. Возвращает True при успехе."""
+        previous = self.cache['timestamp']
+        self._start_refresh()
+        await asyncio.shield(self._refresh_task)
+        return self.cache['timestamp'] != previous
+
+    def next_refresh_delay(self, failures=0):
+        """Через сколько секунд обновлять курсы в следующий раз."""
+        if failures:
+            delay = min(REFRESH_RETRY_BASE * 2 ** (failures - 1), REFRESH_RETRY_MAX)
+        else:
+            data = self.cache['data']
+            next_update = data.next_update if data else None
+            if next_update:
+                delay = max(next_update - datetime.now().timestamp(), REFRESH_MIN_INTERVAL)
+            else:
+                delay = self.cache_timeout
+        return delay + random.uniform(0, REFRESH_JITTER)
+
+    def _start_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch_rates())
+        return self._refresh_task
+
+    async def _fetch_rates(self):
+        current_time = datetime.now().timestamp()
+        started = time.perf_counter()
+        try:
+            data = await self.providers.fetch(
+                self._get_client(), conditional=self.cache['data'] is not None
+            )
+            if data is NOT_MODIFIED:
+                # Снимок и всё, что из него посчитано, остаются прежними
+                self.stats['not_modified'] += 1
+                self.cache['timestamp'] = current_time
+                return self.cache['data']
+
+            self.stats['full_refreshes'] += 1
+            result = RateSnapshot(
+                data['rates'], data['timestamp'], data['date'], data['next_update']
+            )
+
+            old = self.cache['data']
             self.cache['data'] = result
             self.cache['timestamp'] = current_time
+            self._save_snapshot(result, current_time)
+            await self._notify_listeners(old, result)
             return result
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка сети при запросе к API: {e}")
-            if self.cache['data']:
-                logger.info("Использую устаревшие данные из кэша (ошибка сети)")
-                return self.cache['data']
-            return None
-        except (KeyError, ValueError) as e:
-            logger.error(f"Ошибка парсинга ответа API: {e}")
+        except Exception as e:
+            # Задачу обновления в фоне никто не ждёт: любая ошибка должна
+            # попасть в лог и метрики здесь, а не в «Task exception was never retrieved»
+            _FETCH_ERRORS.inc()
+            if isinstance(e, ProviderError):
+                logger.error(f"Не удалось получить курсы: {e}")
+            else:
+                logger.error(f"Ошибка при обновлении курсов: {e}", exc_info=e)
             if self.cache['data']:
-                logger.info("Использую устаревшие данные из кэша (ошибка парсинга)")
+                logger.info("Использую устаревшие данные из кэша")
                 return self.cache['data']
             return None
+        finally:
+            _FETCH_SECONDS.observe(time.perf_counter() - started)
 
-    def get_currency_rate(self, currency_code):
-        data = self.get_rates()
+    async def get_currency_rate(self, currency_code):
+        data = await self.get_rates()
         if not data:
             return None
-        
+
         code = currency_code.upper()
-        if code in data['rates']:
+        if code in data.rates:
             return {
-                'rate': data['rates'][code],
-                'timestamp': data['timestamp'],
-                'date': data['date']
+                'rate': data.rates[code],
+                'timestamp': data.timestamp,
+                'date': data.date
             }
         return None
 
-    def convert_currency(self, amount, from_currency, to_currency):
-        data = self.get_rates()
+    async def convert_currency(self, amount, from_currency, to_currency):
+        data = await self.get_rates()
         if not data:
             return None
 
         from_curr = from_currency.upper()
         to_curr = to_currency.upper()
 
-        if from_curr not in data['rates']:
+        if from_curr not in data.rates:
             logger.error(f"Валюта {from_curr} отсутствует в данных")
             return None
-        if to_curr not in data['rates']:
+        if to_curr not in data.rates:
             logger.error(f"Валюта {to_curr} отсутствует в данных")
             return None
 
-        try:
-            rub_total = amount * data['rates'][from_curr]
-            result = rub_total / data['rates'][to_curr]
-            return round(result, 4)
-        except Exception as e:
-            logger.error(f"Ошибка в convert_currency: {e}")
+        return data.convert(amount, from_curr, to_curr)
+
+    async def convert_many(self, items, to_currency):
+        """Конвертировать все позиции по одному и тому же снимку курсов."""
+        data = await self.get_rates()
+        if not data:
             return None
-        
-    def get_multiple_currencies(self, currencies_list):
+        return data.convert_many(
+            [(amount, code.upper()) for amount, code in items], to_currency.upper()
+        )
+
+    async def get_multiple_currencies(self, currencies_list):
             """Получить курсы нескольких валют."""
-            data = self.get_rates()
+            data = await self.get_rates()
             if not data:
                 return None
-            
+
             result = {}
             for curr in currencies_list:
                 code = curr.upper()
-                if code in data['rates']:
-                    result[code] = data['rates'][code]
-            return result or None
\ No newline at end of file
+                if code in data.rates:
+                    result[code] = data.rates[code]
+            return result or None
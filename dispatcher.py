@@ -0,0 +1,278 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from telegram.constants import MessageLimit
+from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter, TelegramError
+
+from config import (
+    DISPATCH_GLOBAL_RATE, DISPATCH_CHAT_RATE, DISPATCH_CHAT_BURST,
+    DISPATCH_CONCURRENCY, DISPATCH_MAX_ATTEMPTS
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# За сколько последних секунд считается скорость отправки
+THROUGHPUT_WINDOW = 60
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now=None):
+        """Сколько секунд ждать до появления токена (0 — можно сейчас)."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        """Взять токен, если он есть. True — удалось."""
+        if self.delay(now) > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outgoing:
+    __slots__ = ('chat_id', 'parse_mode', 'texts', 'priority', 'seq', 'attempts', 'done')
+
+    def __init__(self, chat_id, parse_mode, text, priority, seq):
+        self.chat_id = chat_id
+        self.parse_mode = parse_mode
+        self.texts = [text]
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.done = False
+
+    @property
+    def key(self):
+        return self.chat_id, self.parse_mode
+
+    def can_merge(self, texts):
+        length = sum(len(t) + 2 for t in self.texts) + sum(len(t) + 2 for t in texts)
+        return length <= MessageLimit.MAX_TEXT_LENGTH
+
+
+class MessageDispatcher:
+    """Очередь исходящих сообщений для массовых рассылок (уведомления, дайджесты).
+
+    Отправка идёт по приоритету с учётом общего лимита Bot API и лимита на
+    чат (token bucket). Несколько ожидающих сообщений одному чату склеиваются
+    в одно, ответы 429 откладывают отправку на retry_after.
+    """
+
+    def __init__(self, global_rate=DISPATCH_GLOBAL_RATE, chat_rate=DISPATCH_CHAT_RATE,
+                 chat_burst=DISPATCH_CHAT_BURST, concurrency=DISPATCH_CONCURRENCY,
+                 max_attempts=DISPATCH_MAX_ATTEMPTS):
+        self.bot = None
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self._chat_buckets = {}
+        # (chat_id, parse_mode) -> ещё не отправленное сообщение, к которому
+        # можно дописывать новые тексты
+        self._pending = {}
+        self._heap = []      # (priority, seq, _Outgoing)
+        self._queued = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._paused_until = 0.0
+        self._worker = None
+        self._in_flight = set()
+        # Время отправок за последние THROUGHPUT_WINDOW секунд: не больше
+        # global_rate * THROUGHPUT_WINDOW записей
+        self._sent_times = deque()
+        self.stats = {
+            'enqueued': 0, 'sent': 0, 'failed': 0, 'retried': 0,
+            'coalesced': 0, 'rate_limited': 0,
+        }
+
+    def start(self, bot):
+        self.bot = bot
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=5):
+        """Дождаться отправки очереди (не дольше timeout) и остановиться."""
+        deadline = time.monotonic() + timeout
+        while (self._queued or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if self._queued:
+            logger.warning(f"Не отправлено сообщений при остановке: {self._queued}")
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL, parse_mode=None):
+        self.stats['enqueued'] += 1
+        key = (chat_id, parse_mode)
+        message = self._pending.get(key)
+        if message is not None and message.can_merge([text]):
+            message.texts.append(text)
+            self.stats['coalesced'] += 1
+            if priority < message.priority:
+                message.priority = priority
+                message.seq = next(self._seq)
+                self._push(message)
+            return
+        # Новое сообщение; если старое уже не вмещает текст, оно уйдёт первым
+        message = _Outgoing(chat_id, parse_mode, text, priority, next(self._seq))
+        self._pending[key] = message
+        self._queued += 1
+        self._push(message)
+
+    def _push(self, message):
+        if not message.done:
+            heapq.heappush(self._heap, (message.priority, message.seq, message))
+            self._wakeup.set()
+
+    def _push_later(self, message, delay):
+        asyncio.get_running_loop().call_later(delay, self._push, message)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Забываем чаты, чьи лимиты давно восстановились
+                self._chat_buckets = {
+                    cid: b for cid, b in self._chat_buckets.items() if not b.full(now)
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    def _trim_sent(self, now):
+        while self._sent_times and now - self._sent_times[0] > THROUGHPUT_WINDOW:
+            self._sent_times.popleft()
+
+    def throughput(self):
+        """Отправлено сообщений в секунду за последние THROUGHPUT_WINDOW секунд."""
+        self._trim_sent(time.monotonic())
+        return len(self._sent_times) / THROUGHPUT_WINDOW
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            _, seq, message = self._heap[0]
+            if message.done or message.seq != seq:
+                # Запись устарела: сообщение уже отправлено или переприоритизировано
+                heapq.heappop(self._heap)
+                continue
+
+            chat_wait = self._chat_bucket(message.chat_id, now).delay(now)
+            if chat_wait > 0:
+                heapq.heappop(self._heap)
+                self._push_later(message, chat_wait)
+                continue
+
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            heapq.heappop(self._heap)
+            self.global_bucket.take(now)
+            self._chat_buckets[message.chat_id].take(now)
+            self._dequeue(message)
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._deliver(message))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _deliver(self, message):
+        try:
+            message.attempts += 1
+            await self.bot.send_message(
+                message.chat_id, "\n\n".join(message.texts), parse_mode=message.parse_mode
+            )
+            self.stats['sent'] += 1
+            now = time.monotonic()
+            self._sent_times.append(now)
+            self._trim_sent(now)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            self.stats['rate_limited'] += 1
+            # 429 — притормаживаем всю отправку, а не только этот чат
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._retry(message, retry_after)
+        except (Forbidden, BadRequest) as e:
+            self.stats['failed'] += 1
+            logger.warning(f"Сообщение в чат {message.chat_id} не доставлено: {e}")
+        except NetworkError as e:
+            if message.attempts >= self.max_attempts:
+                self.stats['failed'] += 1
+                logger.error(f"Сообщение в чат {message.chat_id} не доставлено: {e}")
+            else:
+                self._retry(message, 2 ** message.attempts)
+        except TelegramError as e:
+            # Прочие ошибки Bot API (Conflict, InvalidToken...): повтор не поможет,
+            # а из задачи доставки исключение никто не заберёт
+            self.stats['failed'] += 1
+            logger.error(f"Сообщение в чат {message.chat_id} не доставлено: {e}")
+        finally:
+            self._semaphore.release()
+
+    def _dequeue(self, message):
+        message.done = True
+        self._queued -= 1
+        if self._pending.get(message.key) is message:
+            del self._pending[message.key]
+
+    def _retry(self, message, delay):
+        self.stats['retried'] += 1
+        key = message.key
+        newer = self._pending.get(key)
+        if newer is not None and message.can_merge(newer.texts):
+            # Пока ждали, в чат накопились новые сообщения — отправим всё вместе
+            message.texts.extend(newer.texts)
+            message.priority = min(message.priority, newer.priority)
+            self.stats['coalesced'] += len(newer.texts)
+            self._dequeue(newer)
+            newer = None
+        message.done = False
+        message.seq = next(self._seq)
+        self._queued += 1
+        if newer is None:
+            self._pending[key] = message
+        self._push_later(message, delay)
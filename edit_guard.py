@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.error import BadRequest, TelegramError
+
+from config import EDIT_GUARD_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class _Edit:
+    __slots__ = ('query', 'text', 'kwargs', 'fingerprint')
+
+    def __init__(self, query, text, kwargs):
+        self.query = query
+        self.text = text
+        self.kwargs = kwargs
+        self.fingerprint = (text, kwargs.get('parse_mode'), kwargs.get('reply_markup'))
+
+
+class EditGuard:
+    """Редактирование сообщений по нажатиям кнопок без лишних запросов к API.
+
+    Для каждого сообщения помнится отпечаток последнего отправленного
+    содержимого (текст, parse_mode, клавиатура): повторная правка тем же
+    содержимым не отправляется. Пока правка сообщения ждёт отправки или
+    уже идёт, новые правки того же сообщения только заменяют ожидающую —
+    уходит одна, с последним состоянием.
+    """
+
+    def __init__(self, maxsize=EDIT_GUARD_SIZE):
+        self.maxsize = maxsize
+        self._sent = OrderedDict()   # ключ сообщения -> отпечаток
+        self._pending = {}           # ключ сообщения -> _Edit
+        self._flushing = set()
+        self._tasks = set()
+        self.stats = {'edits': 0, 'suppressed': 0, 'coalesced': 0, 'not_modified': 0}
+
+    @staticmethod
+    def _key(query):
+        message = query.message
+        if message is not None:
+            return message.chat_id, message.message_id
+        return query.inline_message_id
+
+    async def edit(self, query, text, delay=0, **kwargs):
+        """Отредактировать сообщение кнопки.
+
+        delay > 0 — отложить отправку на delay секунд, собирая серию
+        быстрых нажатий в одну правку; вызов тогда возвращается сразу.
+        """
+        key = self._key(query)
+        edit = _Edit(query, text, kwargs)
+        if key in self._pending:
+            self._pending[key] = edit
+            self.stats['coalesced'] += 1
+            return
+        if key not in self._flushing and self._sent.get(key) == edit.fingerprint:
+            self.stats['suppressed'] += 1
+            return
+        self._pending[key] = edit
+        if key in self._flushing:
+            # Отправит уже работающий цикл, когда закончит текущую правку
+            return
+        if delay > 0:
+            task = asyncio.create_task(self._flush(key, delay))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            await self._flush(key)
+
+    async def _flush(self, key, delay=0):
+        self._flushing.add(key)
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            while key in self._pending:
+                edit = self._pending.pop(key)
+                if self._sent.get(key) == edit.fingerprint:
+                    self.stats['suppressed'] += 1
+                    continue
+                try:
+                    await edit.query.edit_message_text(edit.text, **edit.kwargs)
+                except TelegramError as e:
+                    if isinstance(e, BadRequest) and 'not modified' in str(e).lower():
+                        # Содержимое уже такое — запоминаем, чтобы не повторять
+                        self.stats['not_modified'] += 1
+                    else:
+                        self._forget(key)
+                        if not delay:
+                            raise
+                        logger.warning(f"Не удалось отредактировать сообщение: {e}")
+                        continue
+                else:
+                    self.stats['edits'] += 1
+                self._remember(key, edit.fingerprint)
+        finally:
+            self._flushing.discard(key)
+            # После ошибки ожидающую правку некому отправить
+            self._pending.pop(key, None)
+
+    def _remember(self, key, fingerprint):
+        self._sent[key] = fingerprint
+        self._sent.move_to_end(key)
+        if len(self._sent) > self.maxsize:
+            self._sent.popitem(last=False)
+
+    def _forget(self, key):
+        self._sent.pop(key, None)
@@ -0,0 +1,165 @@
+import logging
+import mmap
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+
+from config import HISTORY_DIR
+from currency_api import SUPPORTED_CODES
+
+logger = logging.getLogger(__name__)
+
+# Метки времени — int64, курсы — float32: 4 байта на валюту на замер
+TIMESTAMP_TYPE = 'q'
+VALUE_TYPE = 'f'
+
+
+class _MappedColumn:
+    """Файл фиксированной ширины, отображённый в память только для чтения."""
+
+    def __init__(self, path, typecode):
+        self.path = path
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self._mmap = None
+        self._size = 0
+
+    def view(self, count):
+        size = count * self.itemsize
+        if size == 0:
+            return memoryview(b'').cast(self.typecode)
+        if self._mmap is None or self._size < size:
+            # Файл вырос после дозаписи — переотображаем
+            self.close()
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._size = len(self._mmap)
+        return memoryview(self._mmap)[:size].cast(self.typecode)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Где-то ещё жив memoryview — mmap закроется вместе с ним
+                pass
+            self._mmap = None
+            self._size = 0
+
+
+class HistoryStore:
+    """Колоночное хранилище истории курсов.
+
+    timestamps.bin — отсортированные метки времени замеров, <CODE>.bin — курс
+    валюты к RUB в каждом замере (NaN, если провайдер её не вернул).
+    Диапазон по времени ищется бинарным поиском по меткам.
+
+    read_only — хранилище пишет другой процесс: файлы не трогаем, а число
+    замеров перечитываем по размеру файла меток перед каждым запросом.
+    """
+
+    def __init__(self, directory=HISTORY_DIR, codes=SUPPORTED_CODES, read_only=False):
+        self.directory = directory
+        self.codes = tuple(codes)
+        self.read_only = read_only
+        os.makedirs(directory, exist_ok=True)
+        self._timestamps = _MappedColumn(self._path('timestamps'), TIMESTAMP_TYPE)
+        self._columns = {
+            code: _MappedColumn(self._path(code), VALUE_TYPE) for code in self.codes
+        }
+        self.count = self._committed_count() if read_only else self._recover()
+        self.last_timestamp = self._read_last_timestamp()
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def _recover(self):
+        """Число целых замеров; обрезает недописанные хвосты после сбоя."""
+        itemsize = self._timestamps.itemsize
+        try:
+            count = os.path.getsize(self._timestamps.path) // itemsize
+        except FileNotFoundError:
+            count = 0
+        for column in (self._timestamps, *self._columns.values()):
+            expected = count * column.itemsize
+            if not os.path.exists(column.path):
+                # Новая валюта в списке — заполняем прошлые замеры NaN
+                with open(column.path, 'wb') as f:
+                    array(column.typecode, [float('nan')] * count).tofile(f)
+                continue
+            size = os.path.getsize(column.path)
+            if size > expected:
+                with open(column.path, 'r+b') as f:
+                    f.truncate(expected)
+            elif size < expected:
+                with open(column.path, 'ab') as f:
+                    missing = (expected - size) // column.itemsize
+                    array(column.typecode, [float('nan')] * missing).tofile(f)
+        return count
+
+    def _committed_count(self):
+        # Метка времени дописывается последней, так что колонки не короче
+        try:
+            return os.path.getsize(self._timestamps.path) // self._timestamps.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def _read_last_timestamp(self):
+        if not self.count:
+            return None
+        return self._timestamps.view(self.count)[self.count - 1]
+
+    def append(self, snapshot):
+        """Дописать замер из RateSnapshot. Повторы той же версии пропускаются."""
+        if self.read_only:
+            return False
+        timestamp = int(snapshot.timestamp)
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            return False
+        nan = float('nan')
+        # Сначала колонки, метка времени последней: она и фиксирует замер
+        for code, column in self._columns.items():
+            with open(column.path, 'ab') as f:
+                array(VALUE_TYPE, [snapshot.rates.get(code, nan)]).tofile(f)
+        with open(self._timestamps.path, 'ab') as f:
+            array(TIMESTAMP_TYPE, [timestamp]).tofile(f)
+        self.count += 1
+        self.last_timestamp = timestamp
+        return True
+
+    def range_stats(self, code, start, end):
+        """min/max/avg/изменение курса валюты за [start, end] или None."""
+        if self.read_only:
+            self.count = self._committed_count()
+        column = self._columns.get(code)
+        if column is None or not self.count:
+            return None
+        timestamps = self._timestamps.view(self.count)
+        lo = bisect_left(timestamps, int(start))
+        hi = bisect_right(timestamps, int(end))
+        values = column.view(self.count)[lo:hi].tolist()
+        total = sum(values)
+        if total != total:
+            # Есть пропуски (NaN): отбрасываем их; без пропусков этот проход не нужен
+            values = [v for v in values if v == v]
+            total = sum(values)
+        if not values:
+            return None
+        first, last = values[0], values[-1]
+        return {
+            'min': min(values),
+            'max': max(values),
+            'avg': total / len(values),
+            'first': first,
+            'last': last,
+            'change': last - first,
+            'change_pct': (last - first) / first * 100 if first else 0.0,
+            'samples': len(values),
+            'from': timestamps[lo],
+            'to': timestamps[hi - 1],
+        }
+
+    def close(self):
+        self._timestamps.close()
+        for column in self._columns.values():
+            column.close()
@@ -0,0 +1,128 @@
+import time
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent
+
+from config import (
+    CURRENCY_NAMES, MAIN_CURRENCIES, CACHE_TIMEOUT,
+    INLINE_MAX_RESULTS, INLINE_CACHE_TIME_MIN, INLINE_CACHE_TIME_MAX
+)
+from query_parser import parse_query
+from resolver import resolver
+from utils import (
+    format_conversion, format_multi_conversion, format_expression, format_multiple_currencies
+)
+
+# Куда переводить, если в запросе нет целевой валюты («100 usd»)
+DEFAULT_TARGETS = ('RUB', 'USD', 'EUR')
+
+
+def normalize_query(text):
+    """Ключ кэша: регистр, ё и лишние пробелы на ответ не влияют."""
+    return ' '.join((text or '').lower().replace('ё', 'е').split())
+
+
+def _article(result_id, title, description, message):
+    return InlineQueryResultArticle(
+        id=str(result_id),
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(message, parse_mode='Markdown'),
+    )
+
+
+def _conversion_article(result_id, result, rates_data):
+    kind = result['type']
+    to_code = result.get('to_currency', '').upper()
+    if kind == 'simple':
+        amount = float(result['amount'])
+        from_code = result['from_currency'].upper()
+        if amount <= 0 or from_code == to_code:
+            return None
+        converted = rates_data.convert(amount, from_code, to_code)
+        if converted is None:
+            return None
+        return _article(
+            result_id,
+            f"{amount:.2f} {from_code} = {converted:.2f} {to_code}",
+            f"Курс: 1 {from_code} = {converted / amount:.4f} {to_code}",
+            format_conversion(amount, from_code, to_code, converted),
+        )
+    if kind in ('multi', 'expression'):
+        items = [(float(amount), code.upper()) for amount, code in result['items']]
+        converted_list = rates_data.convert_many(items, to_code)
+        if None in converted_list:
+            return None
+        format_items = format_multi_conversion if kind == 'multi' else format_expression
+        return _article(
+            result_id,
+            f"Итого: {sum(converted_list):.2f} {to_code}",
+            ' + '.join(f"{amount:g} {code}" for amount, code in items),
+            format_items(items, converted_list, to_code),
+        )
+    if kind == 'rate_only':
+        code = result['currency'].upper()
+        rate = rates_data.rates.get(code)
+        if rate is None:
+            return None
+        return _article(
+            result_id,
+            f"{CURRENCY_NAMES.get(code, code)} ({code})",
+            f"1 {code} = {rate:.4f} RUB",
+            format_multiple_currencies({code: rate}, rates_data.stale),
+        )
+    return None
+
+
+def _candidates(query):
+    """Запрос и его варианты с дописанным последним словом («100 usd ru» → RUB)."""
+    yield query
+    words = query.split()
+    if len(words) > 1:
+        for code in resolver.suggest(words[-1], limit=3):
+            yield ' '.join(words[:-1] + [code])
+
+
+def _parsed(candidate):
+    result = parse_query(candidate)
+    if result is not None:
+        yield result
+        return
+    # «100 usd» — целевой валюты ещё нет, предлагаем основные
+    for target in DEFAULT_TARGETS:
+        result = parse_query(f"{candidate} {target}")
+        if result is not None and result['type'] != 'rate_only':
+            yield result
+
+
+def build_results(query, rates_data, limit=INLINE_MAX_RESULTS):
+    """Статьи для ответа на inline-запрос по одному снимку курсов, без сети.
+
+    Разбирает тот же парсер, что и обычные сообщения (parse_query без учёта
+    неудач: недописанные запросы здесь — норма, а не ошибка).
+    """
+    if not query:
+        rates = {code: rates_data.rates[code] for code in MAIN_CURRENCIES if code in rates_data.rates}
+        return [_article(0, "Курсы основных валют", ', '.join(rates),
+                         format_multiple_currencies(rates, rates_data.stale))]
+
+    results = []
+    seen = set()
+    for candidate in _candidates(query):
+        for result in _parsed(candidate):
+            article = _conversion_article(len(results), result, rates_data)
+            if article is None or article.title in seen:
+                continue
+            seen.add(article.title)
+            results.append(article)
+            if len(results) >= limit:
+                return results
+    return results
+
+
+def cache_time(rates_data, now=None):
+    """Сколько Telegram может отдавать ответ из своего кэша: до ожидаемой смены курсов."""
+    if rates_data.stale:
+        return INLINE_CACHE_TIME_MIN
+    now = time.time() if now is None else now
+    remaining = rates_data.next_update - now if rates_data.next_update else CACHE_TIMEOUT
+    return int(max(INLINE_CACHE_TIME_MIN, min(remaining, INLINE_CACHE_TIME_MAX)))
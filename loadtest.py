@@ -0,0 +1,595 @@
+"""Нагрузочный прогон бота без Telegram и внешних API.
+
+    python loadtest.py [--updates 5000] [--chats 200] [--mode direct|webhook]
+    python loadtest.py --replay traffic.jsonl [--speed 2]
+    python loadtest.py --url http://127.0.0.1:8443/<SECRET_PATH>   # уже запущенный бот
+    python loadtest.py anonymize raw.jsonl traffic.jsonl
+
+Поднимает локальный фейковый Bot API и заглушку open.er-api на одном порту,
+собирает Application из bot.build_application() и гоняет через него потоки
+обновлений множества чатов: текстовые конвертации, /courses, серии нажатий
+toggle_, полные разговоры /convert. В конце печатает обновления в секунду,
+перцентили задержки и число запросов к Bot API на обновление.
+Сценарий inline (включается в --mix) набирает inline-запрос по буквам.
+Сценарии flood и mash (включаются в --mix) — поток сообщений и нажатий
+одного пользователя для проверки допуска обновлений (admission.py).
+
+Задержка в режиме direct — от передачи обновления до конца его обработки
+(включая ожидание своей очереди в чате); в режиме webhook и с --url — время
+HTTP-ответа вебхука (с --reply он ждёт ответ обработчика в теле).
+Клиент, фейковый API и бот делят один процесс и одно ядро.
+
+Файл трафика — JSON lines {"t": секунды от начала, "update": {...}}; его
+пишет --record, читает --replay. anonymize переводит сырые обновления в этот
+формат, заменяя id пользователей и чатов и убирая имена.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+TOKEN = '123456:loadtest'
+
+# Курсы заглушки: сколько валюты за 1 RUB, как у open.er-api
+_STUB_RATES = {
+    'USD': 0.0108, 'EUR': 0.0099, 'CNY': 0.078, 'BYN': 0.035, 'KZT': 5.4,
+    'GBP': 0.0085, 'JPY': 1.62, 'CHF': 0.0095, 'CAD': 0.0148, 'AUD': 0.0165,
+    'TRY': 0.35, 'UAH': 0.44, 'AMD': 4.2, 'GEL': 0.029, 'AED': 0.0397,
+    'THB': 0.39, 'KRW': 14.6, 'INR': 0.9, 'BRL': 0.059,
+}
+_CODES = tuple(_STUB_RATES)
+
+# Допуск фейкового Bot API к лимиту на чат, секунды
+_LIMIT_SLACK = 0.1
+
+_TEXTS = (
+    '100 usd rub', '50 евро в рубли', '30 usd и 20 eur в rub', '1.5к cny в kzt',
+    '(50 eur + 30 usd) * 3 в rub', '250 долларов в тенге', 'usd', 'евро', 'бакс',
+    '2 млн руб в usd', '100 usd + 2500 rub - 20 eur в kzt', 'привет', 'сколько стоит',
+)
+
+
+class FakeBotApi(tornado.web.RequestHandler):
+    """Отвечает на любой метод Bot API правдоподобным результатом.
+
+    С limits в state sendMessage, как настоящий Bot API, отвечает 429 с
+    retry_after сверх global_rate сообщений в секунду всего или chat_rate —
+    в один чат; принятые и отклонённые запросы пишутся в state['log'].
+    """
+
+    SUPPORTED_METHODS = ('GET', 'POST')
+
+    def initialize(self, state):
+        self.state = state
+
+    def _params(self):
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(self.request.body or b'{}')
+        return {key: self.get_argument(key) for key in self.request.arguments}
+
+    async def post(self, method):
+        state = self.state
+        if state['latency']:
+            await asyncio.sleep(state['latency'])
+        state['calls'][method] += 1
+        params = self._params()
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            if method == 'sendMessage' and state['limits'] and self._limited(chat_id):
+                return
+            state['texts'].append(params.get('text', ''))
+            result = {
+                'message_id': next(state['message_ids']), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        self.finish({'ok': True, 'result': result})
+
+    get = post
+
+    def _limited(self, chat_id):
+        state = self.state
+        limits = state['limits']
+        now = time.monotonic()
+        sent = state['sent']
+        while sent and now - sent[0][0] > 1:
+            sent.popleft()
+        # Запросы одного чата приходят с разбросом в миллисекунды: ровно через
+        # секунду после предыдущего — ещё не нарушение
+        in_chat = sum(1 for sent_at, sent_chat in sent
+                      if sent_chat == chat_id and now - sent_at < 1 - _LIMIT_SLACK)
+        if len(sent) >= limits['global_rate'] or in_chat >= limits['chat_rate']:
+            state['log'].append((now, chat_id, 429))
+            self.set_status(429)
+            self.finish({
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {limits['retry_after']}",
+                'parameters': {'retry_after': limits['retry_after']},
+            })
+            return True
+        sent.append((now, chat_id))
+        state['log'].append((now, chat_id, 200))
+        return False
+
+
+class StubRates(tornado.web.RequestHandler):
+    """Заглушка open.er-api: курсы к RUB с обновлением через сутки."""
+
+    def get(self):
+        now = int(time.time())
+        self.finish({
+            'result': 'success', 'base_code': 'RUB', 'rates': {'RUB': 1, **_STUB_RATES},
+            'time_last_update_unix': now, 'time_next_update_unix': now + 86400,
+        })
+
+
+def start_fake_services(port, latency=0.0, limits=None):
+    """limits — {'global_rate', 'chat_rate', 'retry_after'} для ответов 429."""
+    state = {'calls': Counter(), 'latency': latency, 'message_ids': itertools.count(1000),
+             'texts': deque(maxlen=100), 'limits': limits, 'sent': deque(), 'log': []}
+    server = HTTPServer(tornado.web.Application([
+        (rf"/bot{TOKEN}/(\w+)", FakeBotApi, {'state': state}),
+        (r"/rates", StubRates),
+    ]))
+    server.listen(port, address='127.0.0.1')
+    return server, state
+
+
+class UpdateFactory:
+    """Обновления от имени симулированных пользователей (личные чаты)."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': 'User', 'language_code': 'ru'}
+
+    def message(self, chat_id, text):
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'from': self._user(chat_id), 'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [
+                {'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}
+            ]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def callback(self, chat_id, data, message_id=1):
+        update_id = next(self._update_ids)
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': str(chat_id), 'data': data,
+            'from': self._user(chat_id),
+            'message': {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': '…',
+            },
+        }}
+
+    # --- сценарии: список обновлений одной «сессии» пользователя ---
+
+    def text_session(self, chat_id, rng):
+        return [self.message(chat_id, rng.choice(_TEXTS))]
+
+    def courses_session(self, chat_id, rng):
+        if rng.random() < 0.5:
+            return [self.message(chat_id, '/courses')]
+        codes = ' '.join(rng.sample(_CODES, rng.randint(1, 3)))
+        return [self.message(chat_id, f'/courses {codes}')]
+
+    def toggle_session(self, chat_id, rng):
+        updates = [self.message(chat_id, '/courses'), self.callback(chat_id, 'select_currencies')]
+        for code in rng.choices(_CODES, k=rng.randint(3, 10)):
+            updates.append(self.callback(chat_id, f'toggle_{code}'))
+        updates.append(self.callback(chat_id, 'get_selected_courses'))
+        return updates
+
+    def convert_session(self, chat_id, rng):
+        updates = [self.message(chat_id, '/convert')]
+        for i in range(rng.randint(1, 3)):
+            if i:
+                updates.append(self.callback(chat_id, 'conv_add_more'))
+            updates.append(self.callback(chat_id, f'conv_from_{rng.choice(_CODES)}'))
+            updates.append(self.message(chat_id, str(rng.randint(1, 5000))))
+        updates.append(self.callback(chat_id, 'conv_select_to'))
+        updates.append(self.callback(chat_id, f'conv_to_{rng.choice(_CODES)}'))
+        updates.append(self.callback(chat_id, 'conv_do'))
+        return updates
+
+
+    def inline_query(self, user_id, text):
+        update_id = next(self._update_ids)
+        return {'update_id': update_id, 'inline_query': {
+            'id': str(update_id), 'from': self._user(user_id), 'query': text, 'offset': '',
+        }}
+
+    def inline_session(self, chat_id, rng):
+        """Набор «@bot 100 usd rub» по буквам: inline-запрос на каждое нажатие."""
+        text = rng.choice(_TEXTS)
+        return [self.inline_query(chat_id, text[:i]) for i in range(1, len(text) + 1)]
+
+    # --- флуд: проверка допуска обновлений (admission.py) ---
+
+    def flood_session(self, chat_id, rng):
+        return [self.message(chat_id, rng.choice(_TEXTS)) for _ in range(rng.randint(20, 40))]
+
+    def mash_session(self, chat_id, rng):
+        updates = [self.message(chat_id, '/courses'), self.callback(chat_id, 'select_currencies')]
+        codes = rng.sample(_CODES, 2)
+        for _ in range(rng.randint(10, 30)):
+            updates.append(self.callback(chat_id, f'toggle_{rng.choice(codes)}'))
+        return updates
+
+
+SCENARIOS = {
+    'text': UpdateFactory.text_session,
+    'courses': UpdateFactory.courses_session,
+    'toggles': UpdateFactory.toggle_session,
+    'convert': UpdateFactory.convert_session,
+    'inline': UpdateFactory.inline_session,
+    'flood': UpdateFactory.flood_session,
+    'mash': UpdateFactory.mash_session,
+}
+
+
+def parse_mix(spec):
+    """'text=60,courses=10' → {'text': 60, 'courses': 10}"""
+    mix = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"Неизвестный сценарий: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _percentile(ordered, percentile):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class LoadRun:
+    """Отправка обновлений и сбор задержек одного прогона."""
+
+    def __init__(self, deliver, record_path=None):
+        self.deliver = deliver
+        self.latencies = []
+        self.failures = 0
+        self.sent = 0
+        self.scenarios = Counter()
+        self.started = None
+        self._record = open(record_path, 'w', encoding='utf-8') if record_path else None
+
+    async def send(self, update):
+        if self._record is not None:
+            self._record.write(json.dumps(
+                {'t': round(time.perf_counter() - self.started, 4), 'update': update},
+                ensure_ascii=False
+            ) + '\n')
+        self.sent += 1
+        begin = time.perf_counter()
+        try:
+            await self.deliver(update)
+        except Exception as e:
+            self.failures += 1
+            logging.getLogger(__name__).warning(f"Обновление не доставлено: {e}")
+        self.latencies.append(time.perf_counter() - begin)
+
+    async def generate(self, total, chats, mix, think, seed, keystroke=0.0):
+        factory = UpdateFactory()
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        budget = itertools.count()
+
+        async def chat(chat_id):
+            rng = random.Random(seed * 1_000_003 + chat_id)
+            while next(budget) < total:
+                scenario = rng.choices(names, weights)[0]
+                self.scenarios[scenario] += 1
+                for update in SCENARIOS[scenario](factory, chat_id, rng):
+                    await self.send(update)
+                    if keystroke and 'inline_query' in update:
+                        await asyncio.sleep(rng.uniform(0.5, 1.5) * keystroke)
+                if think:
+                    await asyncio.sleep(rng.expovariate(1 / think))
+
+        self.started = time.perf_counter()
+        await asyncio.gather(*(chat(100_000 + i) for i in range(chats)))
+
+    async def replay(self, path, speed):
+        from cluster import routing_key
+
+        per_chat = defaultdict(list)
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    per_chat[routing_key(item['update'])].append((item['t'], item['update']))
+
+        async def chat(items):
+            for offset, update in items:
+                delay = self.started + offset / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.send(update)
+
+        self.started = time.perf_counter()
+        await asyncio.gather(*(chat(items) for items in per_chat.values()))
+
+    def close(self):
+        if self._record is not None:
+            self._record.close()
+
+    def report(self, elapsed, calls, extra=None):
+        ordered = sorted(self.latencies)
+        outbound = sum(calls.values())
+        result = {
+            'updates': self.sent,
+            'failed': self.failures,
+            'seconds': round(elapsed, 3),
+            'updates_per_sec': round(self.sent / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': {
+                f'p{p}': round(_percentile(ordered, p) * 1000, 2) for p in (50, 90, 99)
+            },
+            'outbound_calls': outbound,
+            'outbound_per_update': round(outbound / self.sent, 3) if self.sent else 0.0,
+            'calls_by_method': dict(calls.most_common()),
+            'scenarios': dict(self.scenarios),
+        }
+        result['latency_ms']['max'] = round(ordered[-1] * 1000, 2) if ordered else 0.0
+        result.update(extra or {})
+        return result
+
+
+def _format_report(report):
+    latency = report['latency_ms']
+    lines = [
+        f"Обновлений: {report['updates']} за {report['seconds']} с "
+        f"({report['updates_per_sec']} в секунду), не доставлено: {report['failed']}",
+        f"Задержка, мс: p50 {latency['p50']}, p90 {latency['p90']}, "
+        f"p99 {latency['p99']}, max {latency['max']}",
+        f"Запросов к Bot API: {report['outbound_calls']} "
+        f"({report['outbound_per_update']} на обновление)",
+    ]
+    lines.extend(f"  {method}: {count}" for method, count in report['calls_by_method'].items())
+    if report.get('inline_replies'):
+        lines.append(f"Ответов в теле вебхука: {report['inline_replies']}")
+    if report.get('handler_errors'):
+        lines.append(f"Исключений в обработчиках: {report['handler_errors']}")
+    if report.get('shed'):
+        lines.append(f"Принято: {report['admitted']}, отброшено: " +
+                     ', '.join(f"{k}={v}" for k, v in report['shed'].items()))
+    if report['scenarios']:
+        lines.append("Сценарии: " + ', '.join(f"{k}={v}" for k, v in report['scenarios'].items()))
+    return '\n'.join(lines)
+
+
+def _prepare_environment(args, workdir):
+    # Конфигурация бота читается при импорте, поэтому окружение — до import bot
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{args.api_port}/bot",
+        'RATE_PROVIDERS': f"open.er-api=http://127.0.0.1:{args.api_port}/rates",
+        'RATES_SNAPSHOT_PATH': '',
+        'HISTORY_DIR': os.path.join(workdir, 'history'),
+        'ALERTS_PATH': '',
+        'PERSISTENCE_PATH': os.path.join(workdir, 'state.sqlite3') if args.persistence else '',
+        'METRICS_PATH': '',
+    })
+    if args.reply:
+        os.environ['WEBHOOK_REPLY'] = '1'
+
+
+async def _run_in_process(args, run):
+    import bot
+    import webhook_server
+    from telegram import Update
+    from metrics import metrics
+
+    application = bot.build_application(updater=False)
+    await application.initialize()
+    await application.start()
+    for _ in range(100):
+        if bot.currency_api.cache['data'] is not None:
+            break
+        await asyncio.sleep(0.05)
+    else:
+        raise SystemExit("Курсы из заглушки так и не загрузились")
+
+    server = None
+    inline = Counter()
+    if args.mode == 'direct':
+        async def deliver(data):
+            update = Update.de_json(data, application.bot)
+            await application.update_processor.process_update(
+                update, application.process_update(update)
+            )
+    else:
+        import httpx
+
+        server = webhook_server.WebhookServer(
+            application, 'loadtest', timeout=args.reply_timeout if args.reply else 0
+        )
+        server.start('127.0.0.1', args.webhook_port)
+        client = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.chats))
+        url = f"http://127.0.0.1:{args.webhook_port}/loadtest"
+
+        async def deliver(data):
+            response = await client.post(url, json=data)
+            response.raise_for_status()
+            if response.content:
+                inline[response.json().get('method')] += 1
+
+    run.deliver = deliver
+    return application, server, inline, metrics
+
+
+async def main_async(args):
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=getattr(logging, args.log_level)
+    )
+    api_server, api_state = start_fake_services(args.api_port, args.api_latency / 1000)
+    run = LoadRun(None, args.record)
+    application = server = None
+    inline = Counter()
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+        if args.url:
+            import httpx
+
+            client = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.chats))
+
+            async def deliver(data):
+                response = await client.post(args.url, json=data)
+                response.raise_for_status()
+                if response.content:
+                    inline[response.json().get('method')] += 1
+            run.deliver = deliver
+        else:
+            _prepare_environment(args, workdir)
+            application, server, inline, registry = await _run_in_process(args, run)
+
+        api_state['calls'].clear()
+        started = time.perf_counter()
+        try:
+            if args.replay:
+                await run.replay(args.replay, args.speed)
+            else:
+                await run.generate(args.updates, args.chats, parse_mix(args.mix),
+                                   args.think / 1000, args.seed, args.keystroke / 1000)
+        finally:
+            run.close()
+        elapsed = time.perf_counter() - started
+        if application is not None:
+            # Дождаться отложенных правок (EDIT_DEBOUNCE) и фоновой обработки
+            processor = application.update_processor
+            while processor.waiting or processor.active:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.5)
+
+        extra = {'inline_replies': sum(inline.values())}
+        if application is not None:
+            families = dict(registry.families())
+            extra['handler_errors'] = sum(
+                metric.value for metric in families['bot_handler_errors_total'][2].values()
+            )
+            if 'bot_updates_shed_total' in families:
+                extra['admitted'] = sum(
+                    metric.value for metric in families['bot_updates_admitted_total'][2].values()
+                )
+                extra['shed'] = {
+                    dict(labels)['reason']: metric.value
+                    for labels, metric in families['bot_updates_shed_total'][2].items()
+                    if metric.value
+                }
+        report = run.report(elapsed, api_state['calls'], extra)
+
+        if server is not None:
+            await server.stop()
+        if application is not None:
+            await application.stop()
+            await application.shutdown()
+    api_server.stop()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(_format_report(report))
+
+
+def anonymize(source, target):
+    """Сырые обновления (по одному JSON в строке) → файл трафика для --replay."""
+    ids = {}
+
+    def new_id(value):
+        if value not in ids:
+            ids[value] = 100_000 + len(ids)
+        return ids[value]
+
+    def scrub(node):
+        if isinstance(node, dict):
+            for key in ('first_name', 'last_name', 'username', 'title', 'phone_number'):
+                if key in node:
+                    node[key] = 'user' if key == 'first_name' else None
+            for key in ('chat', 'from', 'user'):
+                if isinstance(node.get(key), dict) and 'id' in node[key]:
+                    node[key]['id'] = new_id(node[key]['id'])
+            for key, value in list(node.items()):
+                if value is None:
+                    del node[key]
+                else:
+                    scrub(value)
+        elif isinstance(node, list):
+            for value in node:
+                scrub(value)
+
+    first = None
+    count = 0
+    with open(source, encoding='utf-8') as src, open(target, 'w', encoding='utf-8') as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            update = item.get('update', item)
+            offset = item.get('t')
+            if offset is None:
+                message = next((v for v in update.values() if isinstance(v, dict)), {})
+                date = message.get('date') or (message.get('message') or {}).get('date') or 0
+                first = date if first is None else first
+                offset = date - first
+            scrub(update)
+            dst.write(json.dumps({'t': offset, 'update': update}, ensure_ascii=False) + '\n')
+            count += 1
+    print(f"Записано {count} обновлений, {len(ids)} разных пользователей и чатов")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'anonymize':
+        if len(sys.argv) != 4:
+            raise SystemExit("python loadtest.py anonymize <сырые.jsonl> <трафик.jsonl>")
+        anonymize(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на фейковом Bot API")
+    parser.add_argument('--updates', type=int, default=5000, help="сколько сессий начать (не меньше обновлений)")
+    parser.add_argument('--chats', type=int, default=200, help="одновременных чатов")
+    parser.add_argument('--mix', default='text=60,courses=10,toggles=15,convert=15',
+                        help="веса сценариев")
+    parser.add_argument('--think', type=float, default=0, help="средняя пауза между сессиями чата, мс")
+    parser.add_argument('--keystroke', type=float, default=120,
+                        help="средняя пауза между буквами inline-запроса, мс")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mode', choices=('direct', 'webhook'), default='direct')
+    parser.add_argument('--reply', action='store_true', help="ответы в теле вебхука (WEBHOOK_REPLY)")
+    parser.add_argument('--reply-timeout', type=float, default=2)
+    parser.add_argument('--persistence', action='store_true', help="с SqlitePersistence во временном каталоге")
+    parser.add_argument('--url', help="слать обновления в уже запущенный бот (его TELEGRAM_API_URL — наш фейк)")
+    parser.add_argument('--replay', help="воспроизвести файл трафика")
+    parser.add_argument('--speed', type=float, default=1.0, help="ускорение воспроизведения")
+    parser.add_argument('--record', help="записать отправленные обновления в файл трафика")
+    parser.add_argument('--api-port', type=int, default=18080)
+    parser.add_argument('--webhook-port', type=int, default=18081)
+    parser.add_argument('--api-latency', type=float, default=0, help="задержка фейкового Bot API, мс")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true', help="отчёт в JSON для сравнения версий")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import functools
+import time
+from bisect import bisect_left
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """Счётчики по корзинам; накопленные суммы считаются только при выгрузке."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля сверху: граница корзины, в которую он попал."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield f'{name}_bucket', labels + (('le', _format_value(float(bound))),), total
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+class _Callback:
+    """Значение, которое вычисляется только при выгрузке метрик."""
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func()
+
+    def samples(self, name, labels):
+        yield name, labels, self.func()
+
+
+class MetricsRegistry:
+    """Метрики процесса и их выгрузка в текстовом формате Prometheus."""
+
+    def __init__(self):
+        # name → [тип, описание, {метки: метрика}]
+        self._families = {}
+        self.started = time.time()
+
+    def _get(self, kind, name, help_text, labels, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [kind, help_text, {}]
+        elif family[0] != kind:
+            raise ValueError(f"Метрика {name} уже зарегистрирована как {family[0]}")
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = factory()
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        return self._get('counter', name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        return self._get('histogram', name, help_text, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, help_text, func, **labels):
+        family = self._families.setdefault(name, ['gauge', help_text, {}])
+        family[2][tuple(sorted(labels.items()))] = _Callback(func)
+
+    def counter_func(self, name, help_text, func, **labels):
+        family = self._families.setdefault(name, ['counter', help_text, {}])
+        family[2][tuple(sorted(labels.items()))] = _Callback(func)
+
+    def register_stats(self, prefix, stats, help_text):
+        """Выгружать счётчики из словаря stats компонента как {prefix}_{ключ}_total."""
+        for key in stats:
+            self.counter_func(f'{prefix}_{key}_total', f'{help_text}: {key}',
+                              lambda key=key: stats[key])
+
+    def families(self):
+        return self._families.items()
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, metrics) in self._families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics.items():
+                try:
+                    samples = list(metric.samples(name, labels))
+                except Exception:
+                    # Сломанный источник не должен ронять всю выгрузку
+                    continue
+                for sample_name, sample_labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f'{sample_name}{_format_labels(sample_labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+def timed(callback, histogram, errors):
+    """Обернуть async-обработчик замером времени и подсчётом исключений."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    wrapper.__wrapped_handler__ = True
+    return wrapper
+
+
+def _handler_name(callback):
+    return getattr(callback, '__name__', type(callback).__name__)
+
+
+def instrument_handler(handler, registry=metrics):
+    """Обернуть callback обработчика; у ConversationHandler — всех вложенных."""
+    nested = getattr(handler, 'entry_points', None)
+    if nested is not None:
+        for inner in (*handler.entry_points, *handler.fallbacks,
+                      *(h for handlers in handler.states.values() for h in handlers)):
+            instrument_handler(inner, registry)
+        return
+    callback = getattr(handler, 'callback', None)
+    if callback is None or getattr(callback, '__wrapped_handler__', False):
+        return
+    name = _handler_name(callback)
+    handler.callback = timed(
+        callback,
+        registry.histogram('bot_handler_seconds', 'Время работы обработчиков', handler=name),
+        registry.counter('bot_handler_errors_total', 'Исключения в обработчиках', handler=name),
+    )
+
+
+def instrument_application(application, registry=metrics):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument_handler(handler, registry)
+    registry.gauge('bot_users_in_memory', 'Пользователей с user_data в памяти',
+                   lambda: len(application.user_data))
+
+
+def format_stats(registry=metrics):
+    """Краткая сводка для команды /stats (обычный текст: в именах метрик есть «_»)."""
+    uptime = time.time() - registry.started
+    lines = [f"📊 Статистика (работает {uptime / 3600:.1f} ч)", ""]
+    handler_lines = []
+    other_lines = []
+    for name, (kind, _, family) in registry.families():
+        for labels, metric in family.items():
+            label = ','.join(value for _, value in labels)
+            title = f"{name}[{label}]" if label else name
+            if kind == 'histogram':
+                if metric.count:
+                    handler_lines.append(
+                        f"• {label or name}: {metric.count}, "
+                        f"p50 ≤ {metric.quantile(0.5) * 1000:g} мс, "
+                        f"p95 ≤ {metric.quantile(0.95) * 1000:g} мс"
+                    )
+                continue
+            try:
+                value = metric.value
+            except Exception:
+                continue
+            if value:
+                shown = f"{value:.2f}" if isinstance(value, float) else value
+                other_lines.append(f"• {title}: {shown}")
+    if handler_lines:
+        lines.append("Задержки:")
+        lines.extend(handler_lines)
+        lines.append("")
+    lines.extend(other_lines)
+    return '\n'.join(lines)
@@ -0,0 +1,369 @@
+import asyncio
+import logging
+import math
+import pickle
+import sqlite3
+import struct
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import PERSISTENCE_PATH, PERSISTENCE_FLUSH_INTERVAL, USER_STATE_TTL
+from render import SELECTABLE_CODES
+
+logger = logging.getLogger(__name__)
+
+# Упакованная запись user_data: версия, маска выбранных валют, индекс валюты
+# «в» (0xFF — нет), число пунктов; затем индексы валют «из» и суммы (NaN — не
+# введена). Всё, что так не укладывается, сохраняется через pickle.
+_PACKED = 1
+_PICKLED = 0
+_HEADER = struct.Struct('<BIBB')
+_NO_CODE = 0xFF
+_CODE_INDEX = {code: i for i, code in enumerate(SELECTABLE_CODES)}
+_PACKED_KEYS = frozenset(('selected_currencies', 'conv_to', 'conv_items'))
+
+
+def _pack(data):
+    if not data.keys() <= _PACKED_KEYS:
+        return None
+    mask = data.get('selected_currencies', 0)
+    to_code = data.get('conv_to')
+    items = data.get('conv_items', [])
+    if not isinstance(mask, int) or not 0 <= mask < 2 ** 32:
+        return None
+    if to_code is not None and to_code not in _CODE_INDEX:
+        return None
+    if not isinstance(items, list) or len(items) > 255:
+        return None
+    codes = bytearray()
+    amounts = array('d')
+    for item in items:
+        amount = item.get('amount') if isinstance(item, dict) else None
+        if (not isinstance(item, dict) or item.keys() != {'from', 'amount'}
+                or item['from'] not in _CODE_INDEX
+                or not (amount is None or isinstance(amount, float) and not math.isnan(amount))):
+            return None
+        codes.append(_CODE_INDEX[item['from']])
+        amounts.append(float('nan') if amount is None else amount)
+    header = _HEADER.pack(
+        _PACKED, mask, _NO_CODE if to_code is None else _CODE_INDEX[to_code], len(items)
+    )
+    return header + bytes(codes) + amounts.tobytes()
+
+
+def encode_user_data(data):
+    """user_data → компактный BLOB; None — хранить нечего."""
+    if not any(data.values()):
+        return None
+    packed = _pack(data)
+    if packed is not None:
+        return packed
+    return bytes((_PICKLED,)) + pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_user_data(blob):
+    if blob[0] == _PICKLED:
+        return pickle.loads(blob[1:])
+    _, mask, to_index, count = _HEADER.unpack_from(blob)
+    offset = _HEADER.size
+    codes = blob[offset:offset + count]
+    amounts = array('d')
+    amounts.frombytes(blob[offset + count:offset + count + 8 * count])
+    data = {}
+    if mask:
+        data['selected_currencies'] = mask
+    if to_index != _NO_CODE:
+        data['conv_to'] = SELECTABLE_CODES[to_index]
+    if count:
+        data['conv_items'] = [
+            {'from': SELECTABLE_CODES[code], 'amount': None if math.isnan(amount) else amount}
+            for code, amount in zip(codes, amounts)
+        ]
+    return data
+
+
+def _conversation_key(key):
+    return struct.pack(f'<{len(key)}q', *key)
+
+
+def _conversation_key_from_blob(blob):
+    return struct.unpack(f'<{len(blob) // 8}q', blob)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_data_updated_at ON user_data (updated_at);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key BLOB NOT NULL,
+    state INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+
+
+class SqlitePersistence(BasePersistence):
+    """user_data и состояния ConversationHandler в SQLite (WAL).
+
+    Записи копятся в памяти и пишутся одной транзакцией в отдельном потоке
+    (он же единственный владелец соединения). В памяти держатся только
+    пользователи, активные за последние ttl секунд: остальных evict_idle()
+    выгружает, сбрасывая брошенный /convert, а refresh_user_data() поднимает
+    из базы при следующем обращении.
+    """
+
+    def __init__(self, path=PERSISTENCE_PATH, update_interval=PERSISTENCE_FLUSH_INTERVAL,
+                 ttl=USER_STATE_TTL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                        callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._connection = None
+        # Ещё не записанные изменения: user_id → BLOB (None — удалить)
+        self._pending_users = {}
+        self._pending_conversations = {}
+        # Пачка, которая пишется прямо сейчас (её тоже видно при чтении)
+        self._writing_users = {}
+        # Удалить разговоры, не менявшиеся с этого момента (при следующей записи)
+        self._cleanup_cutoff = None
+        self._commit_task = None
+        # Пользователи в памяти по времени последнего обращения
+        self._last_seen = OrderedDict()
+        # Выгруженные из памяти: drop_user_data для них не удаляет запись
+        self._evicted = set()
+        self._revived = {}
+        self.stats = {'commits': 0, 'rows_written': 0, 'loaded': 0, 'evicted': 0}
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _db(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+    # --- чтение ---
+
+    def _load_users(self, since):
+        rows = self._db().execute(
+            'SELECT user_id, data, updated_at FROM user_data WHERE updated_at >= ?', (since,)
+        ).fetchall()
+        return rows
+
+    async def get_user_data(self):
+        # При старте поднимаем только недавно активных, остальных — по требованию
+        rows = await self._run(self._load_users, int(time.time() - self.ttl))
+        users = {}
+        for user_id, blob, updated_at in sorted(rows, key=lambda row: row[2]):
+            users[user_id] = decode_user_data(blob)
+            self._last_seen[user_id] = updated_at
+        logger.info(f"Загружены данные {len(users)} активных пользователей из {self.path}")
+        return users
+
+    def _load_user(self, user_id):
+        row = self._db().execute(
+            'SELECT data FROM user_data WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def refresh_user_data(self, user_id, user_data):
+        # В _last_seen — те, чьи данные уже в памяти (или точно отсутствуют)
+        known = user_id in self._last_seen
+        self._last_seen[user_id] = time.time()
+        self._last_seen.move_to_end(user_id)
+        if known or user_data:
+            return
+        # Новый пользователь или выгруженный из памяти
+        if user_id in self._pending_users:
+            blob = self._pending_users[user_id]
+        elif user_id in self._writing_users:
+            blob = self._writing_users[user_id]
+        else:
+            blob = await self._run(self._load_user, user_id)
+        if blob is not None and not user_data:
+            user_data.update(decode_user_data(blob))
+            self.stats['loaded'] += 1
+        if user_id in self._evicted:
+            self._revived[user_id] = user_data
+
+    def _load_conversations(self, name, since):
+        return self._db().execute(
+            'SELECT key, state FROM conversations WHERE name = ? AND updated_at >= ?',
+            (name, since)
+        ).fetchall()
+
+    async def get_conversations(self, name):
+        # Разговоры старше ttl брошены: их не восстанавливаем
+        rows = await self._run(self._load_conversations, name, int(time.time() - self.ttl))
+        return {_conversation_key_from_blob(key): state for key, state in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- запись ---
+
+    def _stage_user(self, user_id, user_data):
+        self._pending_users[user_id] = encode_user_data(user_data)
+        self._schedule_commit()
+
+    async def update_user_data(self, user_id, data):
+        self._stage_user(user_id, data)
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicted:
+            # Выгрузка из памяти, а не удаление; если пользователь успел
+            # вернуться, сохраняем его текущие данные
+            self._evicted.discard(user_id)
+            revived = self._revived.pop(user_id, None)
+            if revived is not None:
+                self._stage_user(user_id, revived)
+            return
+        self._pending_users[user_id] = None
+        self._schedule_commit()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, _conversation_key(key))] = new_state
+        self._schedule_commit()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_commit(self):
+        # Все изменения одного прохода update_persistence попадают в одну транзакцию
+        if self._commit_task is None:
+            self._commit_task = asyncio.get_running_loop().create_task(self._commit())
+
+    def _write(self, users, conversations, cutoff):
+        now = int(time.time())
+        db = self._db()
+        db.execute('BEGIN')
+        try:
+            db.executemany(
+                'INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)',
+                [(user_id, blob, now) for user_id, blob in users.items() if blob is not None]
+            )
+            db.executemany(
+                'DELETE FROM user_data WHERE user_id = ?',
+                [(user_id,) for user_id, blob in users.items() if blob is None]
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO conversations (name, key, state, updated_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(name, key, state, now) for (name, key), state in conversations.items()
+                 if state is not None]
+            )
+            db.executemany(
+                'DELETE FROM conversations WHERE name = ? AND key = ?',
+                [key for key, state in conversations.items() if state is None]
+            )
+            if cutoff is not None:
+                db.execute('DELETE FROM conversations WHERE updated_at < ?', (cutoff,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    async def _commit(self):
+        try:
+            while (self._pending_users or self._pending_conversations
+                   or self._cleanup_cutoff is not None):
+                users, self._pending_users = self._pending_users, {}
+                conversations, self._pending_conversations = self._pending_conversations, {}
+                cutoff, self._cleanup_cutoff = self._cleanup_cutoff, None
+                self._writing_users = users
+                try:
+                    await self._run(self._write, users, conversations, cutoff)
+                except Exception as e:
+                    logger.error(f"Не удалось сохранить состояние пользователей: {e}")
+                    # Вернём несохранённое: свежие изменения важнее
+                    self._pending_users = {**users, **self._pending_users}
+                    self._pending_conversations = {**conversations, **self._pending_conversations}
+                    return
+                finally:
+                    self._writing_users = {}
+                self.stats['commits'] += 1
+                self.stats['rows_written'] += len(users) + len(conversations)
+        finally:
+            self._commit_task = None
+
+    # --- вытеснение ---
+
+    async def evict_idle(self, application):
+        """Выгрузить из памяти пользователей, неактивных дольше ttl.
+
+        Незавершённый /convert таких пользователей сбрасывается, брошенные
+        разговоры удаляются из базы. Возвращает число выгруженных.
+        """
+        cutoff = time.time() - self.ttl
+        evicted = 0
+        while self._last_seen:
+            user_id, seen = next(iter(self._last_seen.items()))
+            if seen >= cutoff:
+                break
+            del self._last_seen[user_id]
+            user_data = application.user_data.get(user_id)
+            if user_data is not None:
+                for key in [key for key in user_data if key.startswith('conv_')]:
+                    del user_data[key]
+                self._stage_user(user_id, user_data)
+                self._evicted.add(user_id)
+                application.drop_user_data(user_id)
+                evicted += 1
+        self.stats['evicted'] += evicted
+        self._cleanup_cutoff = int(cutoff)
+        self._schedule_commit()
+        await self._commit_task
+        if evicted:
+            logger.info(f"Выгружены из памяти данные {evicted} неактивных пользователей")
+        return evicted
+
+    async def flush(self):
+        if self._commit_task is not None:
+            await self._commit_task
+        if self._pending_users or self._pending_conversations:
+            # Последняя попытка после ошибки записи
+            await self._commit()
+
+        def close():
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+        await self._run(close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,360 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from datetime import datetime, timezone
+
+import httpx
+
+from config import (
+    EXCHANGE_API_URL, CBR_API_URL, RATES_FILE_PATH, RATE_PROVIDERS,
+    HEDGE_DELAY_MIN, HEDGE_DELAY_MAX, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    pass
+
+
+# Данные не изменились с прошлого успешного запроса
+NOT_MODIFIED = 'not_modified'
+
+
+class RateProvider:
+    """Источник курсов. fetch() возвращает курсы в рублях за 1 единицу валюты:
+
+    {'rates': {'RUB': 1.0, 'USD': 95.2, ...}, 'timestamp': ..., 'date': ..., 'next_update': ...}
+
+    При conditional=True провайдер может вернуть NOT_MODIFIED, если данные
+    не менялись с его последнего успешного ответа.
+    """
+
+    name = 'base'
+
+    def __init__(self, url=None):
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        # Метка версии данных провайдера (time_last_update_unix, дата ЦБ, mtime)
+        self.last_version = None
+
+    async def fetch(self, client, conditional=False):
+        raise NotImplementedError
+
+    def _conditional_headers(self, conditional):
+        headers = {}
+        if conditional:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def _remember_validators(self, response):
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+    async def _get(self, client, conditional):
+        """GET с валидаторами. Возвращает None, если сервер ответил 304."""
+        response = await client.get(self.url, headers=self._conditional_headers(conditional))
+        if response.status_code == 304 and conditional:
+            return None
+        response.raise_for_status()
+        return response
+
+    def _unchanged(self, version, conditional):
+        return conditional and version is not None and version == self.last_version
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.url!r})"
+
+
+def _normalize_er_api(data):
+    """Ответ в формате open.er-api (сколько валюты за 1 RUB) → рубли за единицу."""
+    if data.get('result') != 'success':
+        raise ProviderError(f"API вернул ошибку: {data.get('error-type', 'unknown')}")
+
+    rates = {'RUB': 1.0}
+    for currency, rub_to_currency in data['rates'].items():
+        if currency != 'RUB' and rub_to_currency > 0:
+            rates[currency] = 1.0 / rub_to_currency
+
+    return {
+        'rates': rates,
+        'timestamp': data.get('time_last_update_unix', time.time()),
+        'date': data.get('time_last_update_utc', ''),
+        'next_update': data.get('time_next_update_unix'),
+    }
+
+
+_ER_API_VERSION_RE = re.compile(rb'"time_last_update_unix"\s*:\s*(\d+)')
+_CBR_VERSION_RE = re.compile(rb'<ValCurs[^>]*\sDate="([^"]*)"')
+
+
+def _find_version(pattern, content):
+    # Ищем метку версии в сыром ответе, чтобы не разбирать его целиком
+    match = pattern.search(content, 0, 4096)
+    return match.group(1) if match else None
+
+
+class OpenErApiProvider(RateProvider):
+    name = 'open.er-api'
+
+    def __init__(self, url=EXCHANGE_API_URL):
+        super().__init__(url)
+
+    async def fetch(self, client, conditional=False):
+        response = await self._get(client, conditional)
+        if response is None:
+            return NOT_MODIFIED
+        version = _find_version(_ER_API_VERSION_RE, response.content)
+        if self._unchanged(version, conditional):
+            self._remember_validators(response)
+            return NOT_MODIFIED
+        result = _normalize_er_api(response.json())
+        self.last_version = version
+        self._remember_validators(response)
+        return result
+
+
+class CbrXmlProvider(RateProvider):
+    """Ежедневные курсы ЦБ РФ (XML_daily.asp)."""
+
+    name = 'cbr'
+
+    def __init__(self, url=CBR_API_URL):
+        super().__init__(url)
+
+    async def fetch(self, client, conditional=False):
+        response = await self._get(client, conditional)
+        if response is None:
+            return NOT_MODIFIED
+        version = _find_version(_CBR_VERSION_RE, response.content)
+        if self._unchanged(version, conditional):
+            self._remember_validators(response)
+            return NOT_MODIFIED
+        try:
+            root = ET.fromstring(response.content)
+        except ET.ParseError as e:
+            raise ProviderError(f"Некорректный XML: {e}")
+
+        rates = {'RUB': 1.0}
+        for valute in root.iter('Valute'):
+            code = valute.findtext('CharCode')
+            value = valute.findtext('Value')
+            nominal = valute.findtext('Nominal') or '1'
+            if not code or not value:
+                continue
+            rate = float(value.replace(',', '.')) / float(nominal.replace(',', '.'))
+            if rate > 0:
+                rates[code] = rate
+        if len(rates) == 1:
+            raise ProviderError("В ответе ЦБ нет курсов")
+
+        date = root.get('Date', '')
+        try:
+            timestamp = datetime.strptime(date, '%d.%m.%Y').replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            timestamp = time.time()
+        self.last_version = version
+        self._remember_validators(response)
+        return {'rates': rates, 'timestamp': timestamp, 'date': date, 'next_update': None}
+
+
+class FileProvider(RateProvider):
+    """Курсы из локального JSON в формате open.er-api (для тестов и офлайна)."""
+
+    name = 'file'
+
+    def __init__(self, url=RATES_FILE_PATH):
+        super().__init__(url)
+
+    async def fetch(self, client, conditional=False):
+        def read():
+            with open(self.url, encoding='utf-8') as f:
+                return json.load(f)
+        try:
+            mtime = os.stat(self.url).st_mtime_ns
+            if self._unchanged(mtime, conditional):
+                return NOT_MODIFIED
+            data = await asyncio.to_thread(read)
+        except OSError as e:
+            raise ProviderError(f"Не удалось прочитать {self.url}: {e}")
+        result = _normalize_er_api(data)
+        self.last_version = mtime
+        return result
+
+
+PROVIDER_CLASSES = {
+    cls.name: cls for cls in (OpenErApiProvider, CbrXmlProvider, FileProvider)
+}
+
+
+def build_providers(spec=RATE_PROVIDERS):
+    """'open.er-api,cbr=https://...' → список провайдеров в порядке приоритета."""
+    providers = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, url = item.partition('=')
+        cls = PROVIDER_CLASSES.get(name)
+        if cls is None:
+            raise ValueError(f"Неизвестный провайдер курсов: {name}")
+        providers.append(cls(url) if url else cls())
+    return providers
+
+
+class ProviderHealth:
+    """Задержки, ошибки и состояние автомата-предохранителя одного провайдера."""
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=50)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened_at = None
+        # Идёт пробный запрос полуоткрытой цепи
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        # После паузы пропускаем один пробный запрос, остальные ждут его исхода
+        return state == 'closed' or state == 'half-open' and not self.probing
+
+    def begin(self):
+        if self.state == 'half-open':
+            self.probing = True
+
+    def end_probe(self):
+        self.probing = False
+
+    def p95(self):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        # В полуоткрытом состоянии одной ошибки достаточно, чтобы снова разомкнуть цепь
+        if self.consecutive_failures >= self.failure_threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+
+class ProviderPool:
+    """Опрос провайдеров по приоритету с хеджированием и автоматами-предохранителями.
+
+    Если основной провайдер не ответил за время своего p95 (в пределах
+    HEDGE_DELAY_MIN..HEDGE_DELAY_MAX), параллельно запускается следующий;
+    побеждает первый успешный ответ. Условный запрос (NOT_MODIFIED) уходит
+    только провайдеру, чьи данные сейчас в кэше: резервный не может
+    подтвердить, что не изменились данные, которых он не присылал.
+    """
+
+    def __init__(self, providers, hedge_delay_min=HEDGE_DELAY_MIN, hedge_delay_max=HEDGE_DELAY_MAX):
+        self.providers = list(providers)
+        self.hedge_delay_min = hedge_delay_min
+        self.hedge_delay_max = hedge_delay_max
+        self.health = {provider: ProviderHealth() for provider in self.providers}
+        # Провайдер последнего полного ответа
+        self.source = None
+
+    def hedge_delay(self, provider):
+        p95 = self.health[provider].p95()
+        if p95 is None:
+            return self.hedge_delay_max
+        return min(max(p95, self.hedge_delay_min), self.hedge_delay_max)
+
+    async def _fetch_one(self, provider, client, conditional):
+        started = time.monotonic()
+        result = await provider.fetch(client, conditional)
+        return result, time.monotonic() - started
+
+    async def fetch(self, client, conditional=False):
+        candidates = [p for p in self.providers if self.health[p].allow()]
+        if not candidates:
+            raise ProviderError("Все провайдеры курсов временно отключены")
+
+        tasks = {}
+        last_error = None
+        next_index = 0
+        try:
+            while True:
+                if next_index < len(candidates) and (not tasks or last_error is not None):
+                    provider = candidates[next_index]
+                    next_index += 1
+                    last_error = None
+                    self.health[provider].begin()
+                    tasks[asyncio.create_task(self._fetch_one(
+                        provider, client, conditional and provider is self.source
+                    ))] = provider
+                if not tasks:
+                    raise ProviderError(f"Ни один провайдер не ответил: {last_error}")
+
+                timeout = None
+                if next_index < len(candidates):
+                    timeout = self.hedge_delay(candidates[next_index - 1])
+                done, _ = await asyncio.wait(tasks, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Хедж: основной провайдер медлит, подключаем следующий
+                    logger.info(f"Провайдер {candidates[next_index - 1].name} медлит, запускаю резервный")
+                    last_error = 'timeout'
+                    continue
+
+                for task in done:
+                    provider = tasks.pop(task)
+                    health = self.health[provider]
+                    try:
+                        result, latency = task.result()
+                    except (ProviderError, httpx.HTTPError, KeyError, TypeError, ValueError) as e:
+                        logger.error(f"Провайдер {provider.name} вернул ошибку: {e}")
+                        health.record_failure()
+                        last_error = e
+                        continue
+                    finally:
+                        health.end_probe()
+                    health.record_success(latency)
+                    if result is not NOT_MODIFIED:
+                        self.source = provider
+                    return result
+        finally:
+            for task, provider in tasks.items():
+                task.cancel()
+                # Отменённая проба ничего не показала — следующий запрос попробует снова
+                self.health[provider].end_probe()
+
+    def stats(self):
+        return {
+            provider.name: {
+                'state': health.state,
+                'successes': health.successes,
+                'failures': health.failures,
+                'p95': health.p95(),
+            }
+            for provider, health in self.health.items()
+        }
@@ -0,0 +1,396 @@
+import math
+import re
+
+from config import EXPRESSION_MAX_TOKENS, EXPRESSION_MAX_DEPTH
+from resolver import resolver
+
+# Типы токенов
+NUM = 'num'
+WORD = 'word'
+SEP = 'sep'        # «и», «,», «+», «&»
+TO = 'to'          # «в», «to», «=», «->»
+MINUS = 'minus'
+OP = 'op'          # прочие операторы и скобки
+
+# Множители сумм: «1.5к», «2 млн», «3kk»
+_MULTIPLIERS = {
+    'к': 1e3, 'k': 1e3, 'кк': 1e6, 'kk': 1e6,
+    'тыс': 1e3, 'тысяч': 1e3, 'тысячи': 1e3, 'тысяча': 1e3,
+    'м': 1e6, 'm': 1e6, 'млн': 1e6, 'mln': 1e6,
+    'млрд': 1e9, 'bn': 1e9,
+}
+# Отдельным словом после числа допустимы только многобуквенные множители:
+# одиночные «к»/«м» — это сокращения CAD/AMD
+_MULTIPLIER_WORDS = frozenset(
+    word for word in _MULTIPLIERS if len(word) > 2 or word in ('кк', 'kk')
+)
+
+
+def _variants(words):
+    return {variant: word for word in words
+            for variant in (word, word.upper(), word.capitalize())}
+
+
+# Ключевые слова во всех привычных регистрах, чтобы не вызывать lower()
+_KEYWORDS = {
+    **{variant: (SEP, word) for variant, word in _variants(('и', 'and', 'плюс', 'plus')).items()},
+    **{variant: (TO, word) for variant, word in _variants(('в', 'во', 'to', 'in', 'на')).items()},
+    **{variant: (SEP, variant) for variant in (',', '+', '&')},
+    **{variant: (TO, variant) for variant in ('->', '=>', '→', '=')},
+    **{variant: (MINUS, '-') for variant in ('-', '−')},
+    **{variant: (OP, variant) for variant in ('*', '×', '/', '÷', '(', ')')},
+}
+
+# Разбор «сложных» кусков между пробелами: «30usd», «1,5к», «(50», «eur)*3»,
+# «.5», «1e5». Дробь с ведущей точкой — число, только если перед ней нет
+# буквы или цифры («usd,5» — это «usd», «,», «5»).
+# Однобуквенные множители допустимы только слитно с числом.
+_NUMBER_RE = re.compile(r'[-−]?(?:\d+(?:[.,]\d+)?|[.,]\d+)(?:e[+-]?\d+)?', re.IGNORECASE)
+_TOKEN_RE = re.compile(r'''
+    (?P<num>(?:\d+(?:[.,]\d+)?|(?<![^\W_])[.,]\d+)(?:e[+-]?\d+)?)(?:(?P<mult>млрд|млн|mln|тыс|bn|кк|kk|[кkмm])(?![^\W\d_]))?
+  | (?P<word>[^\W\d_]+)
+  | (?P<op>->|=>|→|[=,+&*×/÷()\-−])
+  | (?P<skip>[.!?:;"\'«»]+)
+  | (?P<bad>.)
+''', re.IGNORECASE | re.VERBOSE)
+
+
+def _tokenize_chunk(chunk, tokens):
+    for match in _TOKEN_RE.finditer(chunk):
+        kind = match.lastgroup
+        if kind == 'num' or kind == 'mult':
+            amount = float(match.group('num').replace(',', '.'))
+            multiplier = match.group('mult')
+            if multiplier:
+                amount *= _MULTIPLIERS[multiplier.lower()]
+            if not math.isfinite(amount):
+                # «1e999»
+                return False
+            tokens.append((NUM, amount))
+        elif kind == 'word':
+            word = match.group()
+            tokens.append(_KEYWORDS.get(word) or (WORD, word))
+        elif kind == 'op':
+            tokens.append(_KEYWORDS[match.group()])
+        elif kind == 'bad':
+            return False
+    return True
+
+
+def tokenize(text):
+    """Разбить запрос на токены [(тип, значение), ...] или None при мусоре.
+
+    Обычные куски между пробелами («100», «usd», «в») классифицируются
+    без регулярных выражений; регулярка нужна только слитным формам.
+    """
+    tokens = []
+    multiplied = False
+    for chunk in text.split():
+        keyword = _KEYWORDS.get(chunk)
+        if keyword:
+            tokens.append(keyword)
+        elif chunk.isalpha():
+            lowered = chunk.lower()
+            if (lowered in _MULTIPLIER_WORDS and tokens and tokens[-1][0] == NUM
+                    and not multiplied):
+                # «2 млн»
+                amount = tokens[-1][1] * _MULTIPLIERS[lowered]
+                if not math.isfinite(amount):
+                    # «1e300 млрд»
+                    return None
+                tokens[-1] = (NUM, amount)
+                multiplied = True
+                continue
+            tokens.append((WORD, chunk))
+        elif chunk.isdecimal():
+            tokens.append((NUM, float(chunk)))
+        elif _NUMBER_RE.fullmatch(chunk):
+            # «1,5», «.5», «1e5», «-5» отдельным куском — без разбора на группы
+            if chunk[0] in '-−':
+                tokens.append((MINUS, '-'))
+                chunk = chunk[1:]
+            amount = float(chunk.replace(',', '.'))
+            if not math.isfinite(amount):
+                return None
+            tokens.append((NUM, amount))
+        elif not _tokenize_chunk(chunk, tokens):
+            return None
+        multiplied = False
+    return tokens
+
+
+def _resolve_words(words):
+    if len(words) == 1:
+        return resolver.resolve(words[0])
+    return resolver.resolve(' '.join(words)) if words else None
+
+
+def _group_items(tokens):
+    """[(сумма, [слова валюты]), ...] и слова до первой суммы.
+
+    None — если встретился оператор, которого простая грамматика не знает,
+    или слагаемое без валюты.
+    """
+    leading = []
+    items = []
+    current = None
+    sign = 1.0
+    for kind, value in tokens:
+        if kind == NUM:
+            current = (sign * value, [])
+            items.append(current)
+            sign = 1.0
+        elif kind == WORD:
+            if current is None:
+                leading.append(value)
+            else:
+                current[1].append(value)
+        elif kind == SEP or kind == MINUS:
+            if current is not None and not current[1]:
+                # Число без валюты перед «+»/«и»/«-» — ошибка, как и в выражениях
+                return None, None
+            current = None
+            if kind == MINUS:
+                sign = -sign
+        else:
+            return None, None
+    return leading, items
+
+
+def _build_result(items, target_code):
+    if len(items) == 1:
+        amount, from_code = items[0]
+        return {
+            'type': 'simple',
+            'amount': amount,
+            'from_currency': from_code,
+            'to_currency': target_code
+        }
+    return {
+        'type': 'multi',
+        'items': items,
+        'to_currency': target_code
+    }
+
+
+_END = (None, None)
+
+
+class _ExpressionParser:
+    """Рекурсивный спуск по токенам арифметического выражения.
+
+    Значение — список слагаемых [(сумма, код)], у чисел без валюты код None.
+    Умножать и делить можно только на число, поэтому выражение всегда
+    сводится к линейной сумме сумм в валютах.
+    """
+
+    def __init__(self, tokens, max_depth=EXPRESSION_MAX_DEPTH):
+        # Концевой токен избавляет _peek от проверки границы
+        self.tokens = tokens + [_END]
+        self.end = len(tokens)
+        self.pos = 0
+        self.depth = 0
+        self.max_depth = max_depth
+
+    def _peek(self):
+        return self.tokens[self.pos]
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        if self.pos < self.end:
+            self.pos += 1
+        return token
+
+    def parse(self):
+        value = self._expression()
+        if self.pos != self.end:
+            raise ValueError("Лишние токены")
+        return value
+
+    def _expression(self):
+        value = self._term()
+        while True:
+            kind, _ = self._peek()
+            if kind == SEP:
+                self.pos += 1
+                value = value + self._term()
+            elif kind == NUM:
+                # Суммы без разделителя, как в «30 usd 20 eur в rub»
+                value = value + self._term()
+            elif kind == MINUS:
+                self.pos += 1
+                value = value + _scale(self._term(), -1.0)
+            else:
+                return value
+
+    def _term(self):
+        value = self._factor()
+        while True:
+            kind, op = self._peek()
+            if kind != OP or op in '()':
+                return value
+            self.pos += 1
+            right = self._factor()
+            if op in '*×':
+                if _is_scalar(value):
+                    value = _scale(right, _scalar(value))
+                elif _is_scalar(right):
+                    value = _scale(value, _scalar(right))
+                else:
+                    raise ValueError("Валюту можно умножать только на число")
+            else:
+                divisor = _scalar(right) if _is_scalar(right) else 0.0
+                if not divisor:
+                    raise ValueError("Делить можно только на ненулевое число")
+                value = _scale(value, 1.0 / divisor)
+
+    def _factor(self):
+        self.depth += 1
+        if self.depth > self.max_depth:
+            raise ValueError("Слишком глубокое выражение")
+        try:
+            kind, value = self._next()
+            if kind == MINUS:
+                return _scale(self._factor(), -1.0)
+            if kind == OP and value == '(':
+                result = self._expression()
+                if self._next() != (OP, ')'):
+                    raise ValueError("Нет закрывающей скобки")
+                return result
+            if kind == NUM:
+                words = []
+                tokens = self.tokens
+                while tokens[self.pos][0] == WORD:
+                    words.append(tokens[self.pos][1])
+                    self.pos += 1
+                if not words:
+                    return [(value, None)]
+                code = _resolve_words(words)
+                if not code:
+                    raise ValueError("Неизвестная валюта")
+                return [(value, code)]
+            raise ValueError("Ожидалось число")
+        finally:
+            self.depth -= 1
+
+
+def _scale(value, factor):
+    return [(amount * factor, code) for amount, code in value]
+
+
+def _is_scalar(value):
+    return all(code is None for _, code in value)
+
+
+def _scalar(value):
+    return sum(amount for amount, _ in value)
+
+
+def _parse_expression(tokens, target_code):
+    if len(tokens) > EXPRESSION_MAX_TOKENS:
+        return None
+    try:
+        items = _ExpressionParser(tokens).parse()
+    except ValueError:
+        return None
+    if not all(code and math.isfinite(amount) for amount, code in items):
+        # Число без валюты в сумме («100 usd + 5») или переполнение
+        return None
+    return {
+        'type': 'expression',
+        'items': items,
+        'to_currency': target_code
+    }
+
+
+def parse_query(text):
+    """Разобрать запрос на конвертацию или курс.
+
+    Возвращает {'type': 'rate_only' | 'simple' | 'multi' | 'expression', ...}
+    или None.
+    """
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    result = _parse_tokens(tokens)
+    if (result is None and tokens[-1][0] in (SEP, TO) and tokens[-1][1].isalpha()
+            and (len(tokens) == 1 or len(tokens) >= 3 and tokens[-2][0] == WORD)):
+        # «100 usd в», «в»: прежний разбор брал последнее слово валютой, даже
+        # если это «в» или «и». Переразбираем только эти формы — ключевое
+        # слово в середине запроса валютой не становится, иначе «5 в rub»
+        # молча превращалось бы в 5 EUR
+        result = _parse_tokens(tokens[:-1] + [(WORD, tokens[-1][1])])
+    return result
+
+
+def _parse_tokens(tokens):
+    kinds = [kind for kind, _ in tokens]
+    if TO in kinds:
+        to_pos = kinds.index(TO)
+        # «<суммы> в <валюта>»: целевая валюта — слова после первого «в»
+        end = to_pos + 1
+        while end < len(kinds) and kinds[end] == WORD:
+            end += 1
+        if end < len(kinds) and kinds[end] != TO:
+            return None
+        target_code = _resolve_words([value for _, value in tokens[to_pos + 1:end]])
+        if not target_code:
+            return None
+        source = tokens[:to_pos]
+        source_kinds = kinds[:to_pos]
+        if OP in source_kinds or MINUS in source_kinds:
+            # «100 usd + 2500 rub - 20 eur в kzt», «(50 eur + 30 usd) * 3 в rub»
+            return _parse_expression(source, target_code)
+        _, groups = _group_items(source)
+        if not groups:
+            return None
+        items = []
+        for amount, words in groups:
+            code = _resolve_words(words)
+            if not code:
+                return None
+            items.append((amount, code))
+        return _build_result(items, target_code)
+
+    leading, groups = _group_items(tokens)
+    if groups is None:
+        return None
+    if not groups:
+        # Запрос курса: «usd», «доллар сша»
+        code = _resolve_words(leading)
+        if code:
+            return {
+                'type': 'rate_only',
+                'currency': code
+            }
+        return None
+
+    # «<сумма> <валюта> ... <валюта>»: последнее слово — целевая валюта
+    last_words = groups[-1][1]
+    if len(last_words) < 2:
+        return None
+    target_code = resolver.resolve(last_words[-1])
+    if not target_code:
+        return None
+    items = []
+    for i, (amount, words) in enumerate(groups):
+        code = _resolve_words(words[:-1] if i == len(groups) - 1 else words)
+        if not code:
+            return None
+        items.append((amount, code))
+    return _build_result(items, target_code)
+
+
+def parse_amount_currency_pairs(text):
+    """Парсит '30usd 40 eur 50byn' → [(30, 'USD'), ...]"""
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    _, groups = _group_items(tokens)
+    items = []
+    for amount, words in groups or ():
+        code = _resolve_words(words[:1])
+        if not code:
+            return None
+        items.append((amount, code))
+    return items or None
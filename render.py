@@ -0,0 +1,155 @@
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import CURRENCY_NAMES
+
+# Кнопки и тексты не зависят от пользователя: собираем их один раз.
+# InlineKeyboardMarkup после создания неизменяем, его можно отдавать всем.
+
+SELECTABLE_CODES = tuple(CURRENCY_NAMES)
+# Выбранные в /courses валюты хранятся битовой маской в порядке CURRENCY_NAMES
+CODE_BITS = {code: 1 << i for i, code in enumerate(SELECTABLE_CODES)}
+
+WELCOME_TEMPLATE = (
+    "Привет, {first_name}! 👋\n\n"
+    "🤖 *Я бот для отслеживания курсов валют*\n\n"
+    "📊 *Доступные команды:*\n"
+    "• /start - Начальное сообщение\n"
+    "• /courses - Курсы основных валют\n"
+    "• /convert - Конвертер валют\n"
+    "• /help - Помощь и инструкции\n\n"
+    "💡 *Примеры использования:*\n"
+    "`/courses USD` - курс доллара\n"
+    "`/convert 100 USD RUB` - конвертация\n"
+    "`30 USD и 40 EUR в RUB` - множественная конвертация\n\n"
+    "🔍 *Подсказка:* Можно вводить частичные названия валют.\n"
+    "Например: 'руб', 'дол', 'евр'"
+)
+
+
+def _build_help_text():
+    lines = [
+        "📖 *Справочная информация*\n\n"
+        "🔹 *Основные команды:*\n"
+        "• `/courses` :\n 1.Курсы основных валют (USD, EUR, CNY, BYN, KZT)\n 2.Курсы выбранных валют\n"
+        "• `/courses [код]` - курс конкретной валюты\n"
+        "• `/convert [сумма] [из] [в]` - конвертация\n"
+        "• `/history [код] [7|30|365]` - динамика курса за период\n"
+        "• `/alert USD > 95` - уведомить о пересечении курсом порога\n\n"
+        "🔹 *Примеры запросов:*\n"
+        "`/courses EUR`\n"
+        "`/convert 150 USD RUB`\n"
+        "`50 EUR и 100 USD в RUB`\n"
+        "`(50 EUR + 30 USD) * 3 в RUB`\n\n"
+        "🔹 *Поддерживаемые валюты:*\n"
+    ]
+    for i in range(0, len(SELECTABLE_CODES), 5):
+        lines.append(" | ".join(SELECTABLE_CODES[i:i + 5]) + "\n")
+    lines.append(
+        "\n🔹 *Быстрая конвертация:*\n"
+        "Просто отправьте сообщение вида:\n"
+        "`100 USD в RUB` или `30 EUR и 50 USD в RUB`\n\n"
+        "🔹 *Таблицы:*\n"
+        "Пришлите файл .csv или .xlsx со столбцами суммы и валюты — верну его "
+        "со столбцом в рублях и итогом. Другая валюта — в подписи к файлу: `USD`"
+    )
+    return "".join(lines)
+
+
+HELP_TEXT = _build_help_text()
+
+COURSES_MENU_TEXT = "Выберите, какие курсы показать:"
+COURSES_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Основные валюты", callback_data="main_courses")],
+    [InlineKeyboardButton("🔍 Выбрать валюты", callback_data="select_currencies")]
+])
+BACK_TO_COURSES_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_courses")]]
+)
+BACK_TO_SELECTION_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("⬅️ Назад к выбору", callback_data="select_currencies")]]
+)
+CONVERT_DO_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("✅ Конвертировать", callback_data="conv_do")]]
+)
+CONVERT_NEXT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить ещё", callback_data="conv_add_more")],
+    [InlineKeyboardButton("➡️ Выбрать 'в'", callback_data="conv_select_to")]
+])
+
+
+def _build_currency_list(mode):
+    buttons = [
+        InlineKeyboardButton(f"{code} ({name})", callback_data=f"conv_{mode}_{code}")
+        for code, name in CURRENCY_NAMES.items()
+    ]
+    return InlineKeyboardMarkup([buttons[i:i + 4] for i in range(0, len(buttons), 4)])
+
+
+CURRENCY_LIST_TEXTS = {
+    'from': "Выберите валюту *из*:",
+    'to': "Выберите валюту *в*:",
+}
+CURRENCY_LIST_MARKUPS = {mode: _build_currency_list(mode) for mode in CURRENCY_LIST_TEXTS}
+
+# Обе версии кнопки каждой валюты — обычная и отмеченная
+_TOGGLE_BUTTONS = tuple(
+    (
+        InlineKeyboardButton(f"{code} ({name})", callback_data=f"toggle_{code}"),
+        InlineKeyboardButton(f"✅ {code} ({name})", callback_data=f"toggle_{code}"),
+    )
+    for code, name in CURRENCY_NAMES.items()
+)
+_SELECTION_FOOTER = (
+    (InlineKeyboardButton("📈 Получить курс", callback_data="get_selected_courses"),),
+    (InlineKeyboardButton("⬅️ Назад", callback_data="back_to_courses"),),
+)
+
+
+def selection_mask(codes):
+    mask = 0
+    for code in codes:
+        mask |= CODE_BITS.get(code, 0)
+    return mask
+
+
+@lru_cache(maxsize=256)
+def codes_from_mask(mask):
+    return tuple(code for code, bit in CODE_BITS.items() if mask & bit)
+
+
+@lru_cache(maxsize=1024)
+def selection_view(mask):
+    """Текст и клавиатура выбора валют для маски выбранных."""
+    buttons = [pair[(mask >> i) & 1] for i, pair in enumerate(_TOGGLE_BUTTONS)]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.extend(_SELECTION_FOOTER)
+    text = f"Выберите валюты для отображения (выбрано: {bin(mask).count('1')}):"
+    return text, InlineKeyboardMarkup(rows)
+
+
+# Шаблон строки курса с уже подставленными названием и кодом валюты
+_RATE_LINE = "• {name} ({code}): *{{0:.4f}}*\n  1 {code} = {{0:.2f}} RUB\n  1 RUB = {{1:.4f}} {code}\n\n"
+_RATE_TEMPLATES = {
+    code: _RATE_LINE.format(name=name, code=code).format
+    for code, name in CURRENCY_NAMES.items()
+}
+RATES_HEADER = "📈 *Курсы валют к RUB:*\n\n"
+STALE_NOTE = "⚠️ Курсы из сохранённой копии, идёт обновление\n"
+
+
+def _rate_template(code):
+    template = _RATE_TEMPLATES.get(code)
+    if template is None:
+        template = _RATE_LINE.format(name=code, code=code).format
+    return template
+
+
+def format_rates(rates, stale=False):
+    """Список курсов к RUB: {код: курс} → текст в Markdown."""
+    parts = [RATES_HEADER]
+    parts.extend(_rate_template(code)(rate, 1 / rate) for code, rate in rates.items())
+    if stale:
+        parts.append(STALE_NOTE)
+    return "".join(parts)
@@ -0,0 +1,234 @@
+from bisect import bisect_left
+from functools import lru_cache
+
+from config import CURRENCY_NAMES, CURRENCY_SHORTCUTS
+
+# Окончания русских словоформ, от длинных к коротким: «долларов» → «доллар»
+_ENDINGS = (
+    'ами', 'ями', 'ов', 'ев', 'ей', 'ен', 'ом', 'ем', 'ах', 'ях', 'ам', 'ям',
+    'ой', 'ий', 'ый', 'ая', 'ые', 'ие', 'ых', 'их',
+    'а', 'я', 'ы', 'и', 'у', 'ю', 'е', 'о', 'ь',
+)
+# Окончания по длине: у слова не больше одного окончания каждой длины,
+# поэтому хватает одного поиска в множестве на длину
+_ENDINGS_BY_SIZE = tuple(
+    (size, frozenset(ending for ending in _ENDINGS if len(ending) == size))
+    for size in sorted({len(ending) for ending in _ENDINGS}, reverse=True)
+)
+_STRIP_CHARS = ' \t.,!?;:"\'«»()'
+
+
+def normalize(text):
+    return ' '.join(text.lower().replace('ё', 'е').strip(_STRIP_CHARS).split())
+
+
+def _stems(word):
+    for size, endings in _ENDINGS_BY_SIZE:
+        if len(word) - size >= 3 and word[-size:] in endings:
+            yield word[:-size]
+
+
+def _edit_distance(a, b, limit):
+    """Расстояние Левенштейна; при превышении limit возвращает limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # Общие начало и конец на расстояние не влияют, а таблица по остатку
+    # у опечаток — одна-две клетки
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end_a, end_b = len(a), len(b)
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    a, b = a[start:end_a], b[start:end_b]
+    if not a or not b:
+        return len(a) or len(b)
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            current.append(value)
+            row_min = min(row_min, value)
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _deletions(word, depth):
+    """word и строки из него без одной или (depth=2) двух букв, возможны повторы."""
+    found = [word]
+    for i in range(len(word)):
+        shorter = word[:i] + word[i + 1:]
+        found.append(shorter)
+        if depth > 1:
+            found.extend([shorter[:j] + shorter[j + 1:] for j in range(i, len(shorter))])
+    return found
+
+
+class CurrencyResolver:
+    """Поиск кода валюты по вводу пользователя.
+
+    Индекс строится один раз: коды, сокращения и все подстроки названий
+    (то же правило «ввод входит в название», что и раньше, но одним поиском
+    в словаре). Порядок поиска: целое слово, основа словоформы (целиком или
+    как начало слова названия), подстрока названия, нечёткий поиск. Для
+    нечёткого поиска заранее построен индекс удалений: слово словаря с
+    любыми одной-двумя удалёнными буквами → слово, так что кандидатов на
+    проверку расстояния находит пара поисков в словаре, а не перебор.
+    При неоднозначности побеждает валюта, стоящая раньше в CURRENCY_NAMES.
+    """
+
+    def __init__(self, names=CURRENCY_NAMES, shortcuts=CURRENCY_SHORTCUTS):
+        self.priority = {code: i for i, code in enumerate(names)}
+
+        exact = {}
+        for code, name in names.items():
+            lowered = normalize(name)
+            for i in range(len(lowered)):
+                for j in range(i + 1, len(lowered) + 1):
+                    exact.setdefault(lowered[i:j], code)
+        exact.update((normalize(key), code) for key, code in shortcuts.items())
+        exact.update((code.lower(), code) for code in names)
+        self.exact = exact
+        self._names = {normalize(name) for name in names.values()}
+        self._name_of = {code: normalize(name) for code, name in names.items()}
+
+        # Слова для нечёткого поиска и префиксных подсказок
+        vocabulary = {}
+        for code, name in names.items():
+            for word in normalize(name).split():
+                vocabulary.setdefault(word, code)
+        for key, code in shortcuts.items():
+            vocabulary.setdefault(normalize(key), code)
+        for code in names:
+            vocabulary.setdefault(code.lower(), code)
+        self.vocabulary = vocabulary
+        deletions = {}
+        for word in sorted(vocabulary):
+            if len(word) >= 4:
+                for variant in set(_deletions(word, 2)):
+                    deletions.setdefault(variant, []).append(word)
+        self._deletions = deletions
+        self._prefix_keys = sorted(vocabulary)
+        # Повторные запросы (а их большинство) — один поиск в кэше
+        self._cached_resolve = lru_cache(maxsize=8192)(self._resolve)
+
+    @staticmethod
+    def _fuzzy_limit(word):
+        if len(word) < 4:
+            return 0
+        return 1 if len(word) < 7 else 2
+
+    def _prefix_match(self, stem):
+        """Код для слова словаря, начинающегося с stem; при нескольких — по приоритету."""
+        codes = []
+        pos = bisect_left(self._prefix_keys, stem)
+        while pos < len(self._prefix_keys) and self._prefix_keys[pos].startswith(stem):
+            codes.append(self.vocabulary[self._prefix_keys[pos]])
+            pos += 1
+        return min(codes, key=self.priority.get) if codes else None
+
+    def _resolve_word(self, word, fuzzy=True):
+        # Целое слово (код, сокращение, слово или полное название) и основы
+        # словоформ проверяются раньше подстрок: иначе «ларей» → «лар» нашлось
+        # бы внутри «доллар», а не в «лари»
+        if word in self.vocabulary or word in self._names:
+            return self.exact[word]
+        stems = list(_stems(word))
+        for stem in stems:
+            if stem in self.vocabulary:
+                return self.exact[stem]
+        for stem in stems:
+            code = self._prefix_match(stem)
+            if code:
+                return code
+        for candidate in (word, *stems):
+            code = self.exact.get(candidate)
+            if code:
+                return code
+        return self._resolve_fuzzy([word, *stems]) if fuzzy else None
+
+    def _resolve_fuzzy(self, words):
+        matches = []
+        for word in words:
+            limit = self._fuzzy_limit(word)
+            if not limit:
+                continue
+            # Расстояние не больше limit — значит, у слов есть общая строка,
+            # полученная удалением не более limit букв из каждого
+            candidates = set()
+            for variant in _deletions(word, limit):
+                found = self._deletions.get(variant)
+                if found:
+                    candidates.update(found)
+            for candidate in candidates:
+                distance = _edit_distance(word, candidate, limit)
+                if distance <= limit:
+                    matches.append((distance, candidate))
+        if not matches:
+            return None
+        best = min(
+            matches,
+            key=lambda m: (m[0], self.priority[self.vocabulary[m[1]]], m[1])
+        )
+        return self.vocabulary[best[1]]
+
+    def resolve(self, text):
+        if not text or not isinstance(text, str):
+            return None
+        return self._cached_resolve(text)
+
+    def _resolve(self, text):
+        if text in self.vocabulary or text in self._names:
+            # Частый случай — уже нормализованное целое слово: «usd», «доллар»
+            return self.exact[text]
+        clean = normalize(text)
+        if not clean:
+            return None
+        if ' ' not in clean:
+            return self._resolve_word(clean)
+        # Фраза: сначала целиком и по словам без опечаток, нечёткий поиск —
+        # самый дорогой — только если ни одно слово не нашлось
+        words = clean.split()
+        for word in (clean, *words):
+            code = self._resolve_word(word, fuzzy=False)
+            if code:
+                return None if self._names_other(words, code) else code
+        for word in words:
+            code = self._resolve_fuzzy([word, *_stems(word)])
+            if code:
+                return None if self._names_other(words, code) else code
+        return None
+
+    def _names_other(self, words, code):
+        """Есть ли во фразе слово другой валюты («usd rub»), а не часть названия code."""
+        name = self._name_of.get(code, '')
+        for word in words:
+            other = self._resolve_word(word, fuzzy=False)
+            if other is not None and other != code and not any(
+                stem in name for stem in (word, *_stems(word))
+            ):
+                return True
+        return False
+
+    def suggest(self, prefix, limit=5):
+        """Коды валют, у которых код, название или сокращение начинается с prefix."""
+        clean = normalize(prefix)
+        if not clean:
+            return []
+        codes = []
+        pos = bisect_left(self._prefix_keys, clean)
+        while pos < len(self._prefix_keys) and self._prefix_keys[pos].startswith(clean):
+            code = self.vocabulary[self._prefix_keys[pos]]
+            if code not in codes:
+                codes.append(code)
+            pos += 1
+        codes.sort(key=self.priority.get)
+        return codes[:limit]
+
+
+resolver = CurrencyResolver()
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+from config import RESPONSE_CACHE_SIZE
+
+
+class ResponseCache:
+    """LRU готовых ответов бота: (текст, клавиатура).
+
+    Ключ — нормализованный разобранный запрос. Все записи относятся к одной
+    версии снимка курсов: при смене версии кэш очищается, так что ответ по
+    старым курсам выдать нельзя.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.version = None
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def get(self, key, version):
+        self._check_version(version)
+        response = self._entries.get(key)
+        if response is None:
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return response
+
+    def put(self, key, version, response):
+        """Запомнить ответ и вернуть его же."""
+        self._check_version(version)
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+        return response
+
+    def invalidate(self, old=None, new=None):
+        """Очистить кэш; подходит как обработчик обновления курсов."""
+        if self._entries:
+            self._entries.clear()
+            self.stats['invalidations'] += 1
+        self.version = None
+
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
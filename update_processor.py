@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_CONCURRENCY
+
+# Базовый класс ограничивает число задач своим семафором; нам нужно, чтобы
+# ждущие своей очереди в чате обновления не занимали его мест
+_UNBOUNDED = 2 ** 20
+
+
+class _ChatQueue:
+    __slots__ = ('lock', 'pending')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов со строгим порядком внутри чата.
+
+    Обновления одного чата (или пользователя, если чата нет) проходят через
+    общую блокировку чата — asyncio.Lock пропускает ожидающих по очереди, так
+    что шаги ConversationHandler и нажатия кнопок не обгоняют друг друга.
+    Одновременно обрабатывается не больше max_concurrent обновлений.
+    Если задан admission (AdmissionController), лишние обновления
+    отбрасываются ещё до очереди, а заменённые более новыми — перед обработкой.
+    """
+
+    def __init__(self, max_concurrent=UPDATE_CONCURRENCY, admission=None):
+        super().__init__(_UNBOUNDED)
+        self.max_concurrent = max_concurrent
+        self.admission = admission
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats = {}
+        self.waiting = 0
+        self.active = 0
+        # Время от получения обновления до начала обработки, секунды
+        self.wait_times = deque(maxlen=1000)
+        self.stats = {'processed': 0, 'max_waiting': 0}
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        received = time.monotonic()
+        ticket = None
+        if self.admission is not None:
+            ticket, reason = self.admission.admit(update)
+            if reason is not None:
+                coroutine.close()
+                await self.admission.notify(update, reason)
+                return
+        try:
+            superseded = await self._process_in_order(update, coroutine, received, ticket)
+        finally:
+            if ticket is not None:
+                self.admission.finish(ticket)
+        if superseded:
+            # Уже вне очереди чата: убрать «часики» с заменённого нажатия
+            await self.admission.notify(update, 'collapsed')
+
+    async def _process_in_order(self, update, coroutine, received, ticket):
+        """True — обновление заменено более новым и не обрабатывалось."""
+        key = self._chat_key(update)
+        chat = None
+        if key is not None:
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = _ChatQueue()
+            chat.pending += 1
+
+        self.waiting += 1
+        self.stats['max_waiting'] = max(self.stats['max_waiting'], self.waiting)
+        started = False
+        try:
+            if chat is not None:
+                await chat.lock.acquire()
+            try:
+                if ticket is not None and not self.admission.start(ticket):
+                    # Пока ждали, пришло более новое нажатие той же кнопки
+                    coroutine.close()
+                    return True
+                async with self._slots:
+                    started = True
+                    self.waiting -= 1
+                    self.active += 1
+                    self.wait_times.append(time.monotonic() - received)
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.stats['processed'] += 1
+            finally:
+                if chat is not None:
+                    chat.lock.release()
+        finally:
+            if not started:
+                # Отменили или заменили более новым, пока ждали очереди
+                self.waiting -= 1
+            if chat is not None:
+                chat.pending -= 1
+                if not chat.pending:
+                    del self._chats[key]
+
+    @property
+    def queue_depth(self):
+        """Обновления, ждущие своей очереди в чате или свободного места."""
+        return self.waiting
+
+    def wait_percentile(self, percentile=95):
+        if not self.wait_times:
+            return 0.0
+        ordered = sorted(self.wait_times)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -9,139 +9,26 @@ def get_multiple_currencies(self, currencies_list):
             if code in data['rates']:
                 result[code] = data['rates'][code]
         return result or None 
-import re
 from datetime import datetime
-from config import CURRENCY_NAMES, CURRENCY_SHORTCUTS
+from config import CURRENCY_NAMES
+from resolver import resolver
+from query_parser import parse_query, parse_amount_currency_pairs
+from render import format_rates
+from metrics import metrics
 
-def parse_convert_input(text):
-    if not text.strip():
-        return None
-
-    clean_text = re.sub(r'\s+', ' ', text.strip())
-    lower_text = clean_text.lower()
-    if re.search(r'\s+(в|to|in)\s+', lower_text):
-        parts = re.split(r'\s+(в|to|in)\s+', lower_text)
-        if len(parts) < 3:
-            return None
-        sources = parts[0]
-        target_str = parts[2].strip()
-        target_code = find_currency_code(target_str)
-        if not target_code:
-            return None
+_PARSE_FAILURES = metrics.counter('bot_parse_failures_total', 'Тексты, не разобранные как запрос')
 
-        tokens = sources.split()
-        items = []
-        i = 0
-        while i < len(tokens):
-            token = tokens[i]
-            if re.match(r'^-?[\d\.,]+$', token.replace(',', '.')):
-                if i + 1 >= len(tokens):
-                    return None
-                amount_str = token
-                curr_str = tokens[i + 1]
-                try:
-                    amount = float(amount_str.replace(',', '.'))
-                except ValueError:
-                    return None
-                curr_code = find_currency_code(curr_str)
-                if not curr_code:
-                    return None
-                items.append((amount, curr_code))
-                i += 2
-            else:
-                i += 1
-
-        if not items:
-            return None
-        if len(items) == 1:
-            amount, from_code = items[0]
-            return {
-                'type': 'simple',
-                'amount': amount,
-                'from_currency': from_code,
-                'to_currency': target_code
-            }
-        else:
-            return {
-                'type': 'multi',
-                'items': items,
-                'to_currency': target_code
-            }
-
-    parts = clean_text.split()
-    if len(parts) == 1:
-        # Запрос курса
-        code = find_currency_code(parts[0])
-        if code:
-            return {
-                'type': 'rate_only',
-                'currency': code
-            }
-
-    if len(parts) == 3:
-        try:
-            amount = float(parts[0].replace(',', '.'))
-        except ValueError:
-            return None
-        from_code = find_currency_code(parts[1])
-        to_code = find_currency_code(parts[2])
-        if from_code and to_code:
-            return {
-                'type': 'simple',
-                'amount': amount,
-                'from_currency': from_code,
-                'to_currency': to_code
-            }
-
-    if len(parts) >= 4 and len(parts) % 2 == 1:
-        target_code = find_currency_code(parts[-1])
-        if not target_code:
-            return None
-        items = []
-        for i in range(0, len(parts) - 1, 2):
-            try:
-                amount = float(parts[i].replace(',', '.'))
-            except (ValueError, IndexError):
-                return None
-            curr_code = find_currency_code(parts[i + 1])
-            if not curr_code:
-                return None
-            items.append((amount, curr_code))
-        if items:
-            if len(items) == 1:
-                return {
-                    'type': 'simple',
-                    'amount': items[0][0],
-                    'from_currency': items[0][1],
-                    'to_currency': target_code
-                }
-            return {
-                'type': 'multi',
-                'items': items,
-                'to_currency': target_code
-            }
-
-    return None
+def parse_convert_input(text):
+    # Однопроходный токенизатор и грамматика запросов, см. query_parser
+    result = parse_query(text)
+    if result is None:
+        _PARSE_FAILURES.inc()
+    return result
 
 
 def find_currency_code(user_input):
-    if not user_input or not isinstance(user_input, str):
-        return None
-
-    clean = user_input.lower().strip()
-    if len(clean) == 3 and clean.isalpha():
-        code = clean.upper()
-        if code in CURRENCY_NAMES:
-            return code
-
-    if clean in CURRENCY_SHORTCUTS:
-        return CURRENCY_SHORTCUTS[clean]
-
-    for code, name in CURRENCY_NAMES.items():
-        if clean in name.lower():
-            return code
-
-    return None
+    # Код, сокращение, часть названия, словоформа («долларов») или опечатка
+    return resolver.resolve(user_input)
 
 def format_currency_message(currency_data, currency_code):
     code = code.upper()
@@ -165,35 +52,94 @@ def format_currency_message(currency_data, currency_code):
     return message
 
 
-def format_multiple_currencies(rates):
+def format_multiple_currencies(rates, stale=False):
     if not rates:
         return "Нет данных о курсах валют"
-    message = "📈 *Курсы валют к RUB:*\n\n"
-    for currency, rate in rates.items():
-        name = CURRENCY_NAMES.get(currency, currency)
-        message += f"• {name} ({currency}): *{rate:.4f}*\n"
-        message += f"  1 {currency} = {rate:.2f} RUB\n"
-        message += f"  1 RUB = {1/rate:.4f} {currency}\n\n"
-    return message
+    return format_rates(rates, stale)
+
+HISTORY_PERIODS = {
+    '7': 7, 'неделя': 7, 'week': 7,
+    '30': 30, 'месяц': 30, 'month': 30,
+    '365': 365, 'год': 365, 'year': 365,
+}
+
+
+def parse_history_period(text):
+    """'7', '30д', 'месяц', 'year' → число дней (7/30/365) или None."""
+    clean = text.lower().strip()
+    if clean not in HISTORY_PERIODS and clean[-1:] in ('d', 'д'):
+        clean = clean[:-1]
+    return HISTORY_PERIODS.get(clean)
+
+
+def format_history(currency_code, days, stats):
+    if not stats:
+        return f"📉 Нет истории курса {currency_code} за {days} дн."
+    name = CURRENCY_NAMES.get(currency_code, currency_code)
+    date_from = datetime.fromtimestamp(stats['from']).strftime('%Y-%m-%d')
+    date_to = datetime.fromtimestamp(stats['to']).strftime('%Y-%m-%d')
+    sign = '+' if stats['change'] >= 0 else ''
+    return (
+        f"📉 *{name} ({currency_code}) за {days} дн.*\n"
+        f"{date_from} — {date_to}, замеров: {stats['samples']}\n\n"
+        f"• Минимум: *{stats['min']:.4f}* RUB\n"
+        f"• Максимум: *{stats['max']:.4f}* RUB\n"
+        f"• Среднее: *{stats['avg']:.4f}* RUB\n"
+        f"• Изменение: *{sign}{stats['change']:.4f}* RUB ({sign}{stats['change_pct']:.2f}%)"
+    )
+
+
+def format_alert(operator, currency_code, threshold):
+    direction = "выше" if operator == '>' else "ниже"
+    return f"{currency_code} {direction} {threshold:.4f} RUB"
+
+
+def format_alert_triggered(currency_code, operator, threshold, rate):
+    name = CURRENCY_NAMES.get(currency_code, currency_code)
+    direction = "поднялся выше" if operator == '>' else "опустился ниже"
+    return (
+        f"🔔 *{name} ({currency_code})* {direction} {threshold:.4f} RUB\n"
+        f"Текущий курс: *{rate:.4f}* RUB"
+    )
+
+
+def format_conversion(amount, from_code, to_code, converted):
+    from_name = CURRENCY_NAMES.get(from_code, from_code)
+    to_name = CURRENCY_NAMES.get(to_code, to_code)
+    return (
+        f"💱 *Результат:*\n"
+        f"• {amount:.2f} {from_name} ({from_code}) =\n"
+        f"• *{converted:.2f} {to_name} ({to_code})*\n\n"
+        f"📊 Курс: 1 {from_code} = {converted/amount:.4f} {to_code}"
+    )
+
+
+def format_multi_conversion(items, converted_list, to_code):
+    to_name = CURRENCY_NAMES.get(to_code, to_code)
+    details = []
+    for (amount, from_code), converted in zip(items, converted_list):
+        from_name = CURRENCY_NAMES.get(from_code, from_code)
+        details.append(f"• {amount:.2f} {from_name} = {converted:.2f} {to_code}")
+    return (
+        f"💱 *Множественная конвертация:*\n\n"
+        f"{chr(10).join(details)}\n\n"
+        f"📊 *Итого:* {sum(converted_list):.2f} {to_name} ({to_code})"
+    )
+
+
+def format_expression(items, converted_list, to_code):
+    to_name = CURRENCY_NAMES.get(to_code, to_code)
+    details = []
+    for (amount, from_code), converted in zip(items, converted_list):
+        from_name = CURRENCY_NAMES.get(from_code, from_code)
+        details.append(f"• {amount:.2f} {from_name} = {converted:.2f} {to_code}")
+    return (
+        f"🧮 *Выражение:*\n\n"
+        f"{chr(10).join(details)}\n\n"
+        f"📊 *Итого:* {sum(converted_list):.2f} {to_name} ({to_code})"
+    )
+
+
 def _parse_amount_currency_pairs(text):
     """Парсит '30usd 40 eur 50byn' → [(30, 'USD'), ...]"""
-    text = re.sub(r'(\d)([a-zA-Z])', r'\1 \2', text)
-    text = re.sub(r'([a-zA-Z])(\d)', r'\1 \2', text)
-    tokens = text.split()
-    items = []
-    i = 0
-    while i < len(tokens):
-        token = tokens[i].replace(',', '.')
-        if re.match(r'^-?\d+(\.\d+)?$', token):
-            if i + 1 >= len(tokens):
-                return None
-            amount = float(token)
-            currency_str = tokens[i + 1]
-            currency_code = find_currency_code(currency_str)
-            if not currency_code:
-                return None
-            items.append((amount, currency_code))
-            i += 2
-        else:
-            i += 1
-    return items if items else None
\ No newline at end of file
+    return parse_amount_currency_pairs(text)
@@ -0,0 +1,228 @@
+import asyncio
+import contextvars
+import hmac
+import json
+import logging
+import signal
+from http import HTTPStatus
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import ExtBot
+
+from config import WEBHOOK_REPLY_TIMEOUT, METRICS_PATH, METRICS_TOKEN
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Слот ответа для обрабатываемого сейчас обновления (None — вне вебхука)
+_reply_slot = contextvars.ContextVar('webhook_reply_slot', default=None)
+
+
+class _ReplySlot:
+    """Место для одного вызова метода Bot API в теле ответа на вебхук."""
+
+    __slots__ = ('future',)
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+
+    def claim(self, payload):
+        if self.future.done():
+            return False
+        self.future.set_result(payload)
+        return True
+
+    def close(self):
+        if not self.future.done():
+            self.future.cancel()
+
+
+async def reply_text(message, text, parse_mode=None, reply_markup=None):
+    """Ответить на сообщение, по возможности прямо в HTTP-ответе вебхука.
+
+    Только для обработчиков, которые отвечают ровно одним сообщением:
+    Telegram выполнит метод из тела ответа уже после всех запросов,
+    отправленных обработчиком обычным путём. Если слота нет (polling,
+    режим выключен, ответ опоздал), сообщение отправляется как обычно.
+    """
+    slot = _reply_slot.get()
+    if slot is not None:
+        payload = {'method': 'sendMessage', 'chat_id': message.chat_id, 'text': text}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        if reply_markup is not None:
+            payload['reply_markup'] = reply_markup.to_dict()
+        if slot.claim(payload):
+            return None
+    return await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+
+
+async def answer_inline_query(inline_query, results, payload, cache_time):
+    """Ответить на inline-запрос, по возможности прямо в HTTP-ответе вебхука.
+
+    payload — те же results, уже переведённые в словари (to_dict()).
+    """
+    slot = _reply_slot.get()
+    if slot is not None and slot.claim({
+        'method': 'answerInlineQuery', 'inline_query_id': inline_query.id,
+        'results': payload, 'cache_time': cache_time,
+    }):
+        return True
+    return await inline_query.answer(results, cache_time=cache_time)
+
+
+class WebhookReplyHandler(tornado.web.RequestHandler):
+    """Принимает обновление и ждёт, не ответит ли обработчик в теле ответа."""
+
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, bot_application, secret_token, timeout, tasks):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+        self.timeout = timeout
+        self.tasks = tasks
+
+    async def post(self):
+        if self.request.headers.get('Content-Type') != 'application/json':
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+        if self.secret_token and (
+            self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token
+        ):
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+
+        application = self.bot_application
+        try:
+            update = Update.de_json(json.loads(self.request.body), application.bot)
+        except Exception as e:
+            logger.error(f"Не удалось разобрать обновление из вебхука: {e}")
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+        if isinstance(application.bot, ExtBot):
+            application.bot.insert_callback_data(update)
+
+        # Без таймаута ответ в теле не ждём: обработчики отвечают обычными запросами
+        slot = _ReplySlot() if self.timeout > 0 else None
+        token = _reply_slot.set(slot)
+        try:
+            # Задача копирует контекст вместе со слотом
+            task = asyncio.create_task(application.update_processor.process_update(
+                update, application.process_update(update)
+            ))
+        finally:
+            _reply_slot.reset(token)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if slot is None:
+            self.set_status(HTTPStatus.OK)
+            self.finish()
+            return
+
+        await asyncio.wait({slot.future, task}, timeout=self.timeout,
+                           return_when=asyncio.FIRST_COMPLETED)
+        # Опоздавший ответ уйдёт обычным запросом
+        slot.close()
+        self.set_status(HTTPStatus.OK)
+        if slot.future.done() and not slot.future.cancelled():
+            self.set_header('Content-Type', 'application/json')
+            self.finish(json.dumps(slot.future.result(), ensure_ascii=False))
+        else:
+            self.finish()
+
+
+def check_metrics_token(request, token):
+    """Без заданного METRICS_TOKEN пускает всех, иначе только с этим Bearer-токеном."""
+    if not token:
+        return
+    scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(
+        given.strip().encode(), token.encode()
+    ):
+        raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Метрики процесса в текстовом формате Prometheus."""
+
+    SUPPORTED_METHODS = ('GET',)
+
+    def initialize(self, registry=metrics, token=METRICS_TOKEN):
+        self.registry = registry
+        self.token = token
+
+    def prepare(self):
+        check_metrics_token(self.request, self.token)
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(self.registry.render())
+
+
+class WebhookServer:
+    """HTTP-сервер вебхука на tornado вместо встроенного в PTB."""
+
+    def __init__(self, application, url_path, secret_token=None,
+                 timeout=WEBHOOK_REPLY_TIMEOUT):
+        self.application = application
+        self.tasks = set()
+        self.routes = [
+            (rf"/{url_path.strip('/')}/?", WebhookReplyHandler, {
+                'bot_application': application, 'secret_token': secret_token,
+                'timeout': timeout, 'tasks': self.tasks,
+            }),
+        ]
+        if METRICS_PATH:
+            self.routes.append((rf"/{METRICS_PATH.strip('/')}/?", MetricsHandler))
+        self._server = None
+
+    def start(self, listen, port):
+        self._server = HTTPServer(tornado.web.Application(self.routes))
+        self._server.listen(port, address=listen)
+
+    async def stop(self, timeout=5):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        if self.tasks:
+            # Даём доработать уже принятым обновлениям
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+
+async def run_webhook(application, listen, port, url_path, webhook_url=None,
+                      secret_token=None, reply_timeout=WEBHOOK_REPLY_TIMEOUT):
+    """Запустить бота на собственном сервере вебхука до SIGINT/SIGTERM.
+
+    Повторяет жизненный цикл Application.run_webhook: post_init, установка
+    вебхука, start; при остановке — stop, post_stop, shutdown, post_shutdown.
+    Без webhook_url вебхук не устанавливается (воркер за cluster.py).
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    server = WebhookServer(application, url_path, secret_token, reply_timeout)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        if webhook_url:
+            await application.bot.set_webhook(
+                webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=secret_token
+            )
+        await application.start()
+        server.start(listen, port)
+        logger.info(f"Вебхук слушает {listen}:{port}")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)